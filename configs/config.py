@@ -52,14 +52,51 @@ class GlobalConst:
     """
 
     max_download_file_size = 50 * 2 ** 20  # 50 MB - Maximum file size for downloading from Telegram
+    max_concurrent_downloads = 4  # Maximum number of files downloaded from Telegram at the same time
+    message_ids_batch_size = 100  # Maximum number of message IDs in one Telegram request
+    album_max_size = 10  # Maximum number of messages in a Telegram album
+    sql_variables_batch_size = 500  # Maximum number of values in one IN clause of a database query
+    dropped_tables = ('sync_state',)  # Tables of earlier versions of the database that are dropped at startup
+    download_chunk_size = 512 * 2 ** 10  # 512 KB - Size of a chunk of a resumable download from Telegram
+    partial_file_suffix = '.part'  # Suffix of a file that is being downloaded from Telegram
+    media_blobs_dir = '.blobs'  # Subdirectory of the media directory with the media shared by the files of all chats
+    media_content_hash = True  # Also deduplicate downloaded media with the same content under different Telegram IDs
+    content_hash_blob_prefix = 'sha256_'  # Prefix of the names of the blobs indexed by the hash of their content
+    flood_wait_max_retries = 3  # Maximum number of retries of a Telegram request after a FloodWait error
+    flood_sleep_threshold = 60  # Maximum FloodWait time waited out by the rate limiter, longer errors are raised, s
+    rate_limit_requests = 10  # Maximum rate of Telegram requests of one client session, requests per second
+    rate_limit_burst = 20  # Maximum number of Telegram requests of one client session sent without waiting
+    rate_limit_min_requests = 0.5  # Minimum rate of Telegram requests after FloodWait errors, requests per second
+    rate_limit_backoff_factor = 0.5  # Factor by which the request rate is reduced after a FloodWait error
+    rate_limit_recovery_step = 0.02  # Part of the maximum request rate restored after each successful request
+    entity_cache_size = 256  # Maximum number of Telegram entities kept in the entity cache
+    entity_cache_ttl = 3600  # Time to live of a Telegram entity in the entity cache, in seconds
+    date_boundary_cache_size = 1024  # Maximum number of cached date boundaries of messages
+    date_boundary_cache_dialogs = 32  # Maximum number of dialogs with cached anchors of received messages
+    date_boundary_cache_anchors = 20000  # Maximum number of cached anchors of received messages per dialog
+    dialog_catalogue_ttl = 300  # Time after which the Telegram dialog catalogue is refreshed in the background, s
+    message_group_cache_memory = 64 * 2 ** 20  # 64 MB - Maximum estimated size of cached message group lists
+    message_group_size_overhead = 512  # Estimated memory size of a message group without texts and files
+    message_file_size_overhead = 448  # Estimated memory size of a message file without its preview
+    archive_batch_size = 20  # Maximum number of message groups saved by the live archiver in one transaction
+    archive_batch_delay = 2  # Maximum delay of saving new messages by the live archiver, in seconds
+    archive_job_batch_size = 100  # Number of message groups saved by the archive job of a date range in one transaction
+    archive_job_pending_batches = 2  # Maximum number of saved batches of the archive job with files still downloading
+    download_wait_timeout = 1800  # Maximum time to wait for queued message files to be downloaded, in seconds
+    loop_stop_timeout = 5  # Time to wait for the Telegram event loop thread to stop at exit, in seconds
     truncated_text_length = 175  # Maximum length of text to display in the web page
     truncated_title_length = 25  # Maximum length of dialog title to display in the web page
     last_days_by_default = 30  # Default number of last days for messages filter
+    message_chunk_size = 100  # Number of messages (and open message groups) processed as one chunk
+    message_page_size = 50  # Number of message groups in one page of the Telegram message list
     text_with_url_pattern = re.compile(r"\[(.*?)]\((.*?)\)")  # Regex pattern to match "[text](URL)"
+    hyperlink_cache_size = 1024  # Maximum number of texts with converted hyperlinks kept in the memo cache
     message_datetime_format = '%d-%m-%Y %H:%M :%S'  # Format for displaying date and time for messages and details
     file_datetime_format = '%Y-%m-%d %H_%M_%S'  # Date and time format for file names
     saved_to_db_label = '✔ Saved'  # Label to indicate that a message has been saved to the database
     save_to_db_label = 'Save'  # Label for the checkbox to save a message to the database
+    download_files_label = 'Download full-size files'  # Label of the link to download files of a message
+    max_list_previews = 4  # Maximum number of inline previews of files for a message group in the message list
     checked_in_db_label = ''  # '✔ Checked' # Not use now
     check_in_db_label = ''  # 'Check' # Not use now
     mess_group_id = 'message_group_id'  # Key name for message group ID in HTML templates
@@ -105,20 +142,20 @@ class DialogTypes(Enum):
 
 class MessageFileTypes(Enum):
     """
-    The class contains the names, types, extensions, and signatures of message files.
-    Класс содержит названия, типы, расширения и подписи файлов сообщений.
+    The class contains the names, types, extensions, signatures, and download priorities of message files.
+    Класс содержит названия, типы, расширения, подписи и приоритеты загрузки файлов сообщений.
     """
 
-    PHOTO = (1, 'Image', '.jpg', 'pho')
-    IMAGE = (2, 'Image', '.jpg', 'img')
-    VIDEO = (3, 'Video', '.mp4', 'vid')
-    THUMBNAIL = (4, 'Image', '.jpg', 'vth')
-    AUDIO = (5, 'Audio', '.mp4', 'aud')
-    WEBPAGE = (6, 'Image', '.jpg', 'wpg')
-    CONTENT = (7, 'Content', '.html', 'ctx')
-    UNKNOWN = (10, 'Unknown', '.unk', 'unk')
+    PHOTO = (1, 'Image', '.jpg', 'pho', 0)
+    IMAGE = (2, 'Image', '.jpg', 'img', 1)
+    VIDEO = (3, 'Video', '.mp4', 'vid', 3)
+    THUMBNAIL = (4, 'Image', '.jpg', 'vth', 0)
+    AUDIO = (5, 'Audio', '.mp4', 'aud', 2)
+    WEBPAGE = (6, 'Image', '.jpg', 'wpg', 0)
+    CONTENT = (7, 'Content', '.html', 'ctx', 2)
+    UNKNOWN = (10, 'Unknown', '.unk', 'unk', 3)
 
-    def __init__(self, type_id: int, alt_text: str, default_ext: str, sign: str):
+    def __init__(self, type_id: int, alt_text: str, default_ext: str, sign: str, download_priority: int):
         """
         Initializes the MessageFileTypes enum.
         Инициализация MessageFileTypes enum.
@@ -127,12 +164,14 @@ class MessageFileTypes(Enum):
             alt_text (str): The alternative text for the file type.
             default_ext (str): The default file extension for the file type.
             sign (str): The short sign for the file type.
+            download_priority (int): The download priority of the file type, lower values are downloaded first.
         """
 
         self.type_id = type_id
         self.alt_text = alt_text
         self.default_ext = default_ext
         self.sign = sign
+        self.download_priority = download_priority
 
     @classmethod
     def get_file_type_by_type_id(cls, type_id: int) -> 'MessageFileTypes':
@@ -172,6 +211,12 @@ class TableNames:
     file_types = 'file_types'
     tags = 'tags'
     message_group_tag_links = 'message_group_tag_links'
+    input_peers = 'input_peers'
+    sync_states = 'sync_states'
+    sync_message_groups = 'sync_message_groups'
+    media_blobs = 'media_blobs'
+    message_groups_fts = 'message_groups_fts'
+    tags_fts = 'tags_fts'
 
 
 @dataclass
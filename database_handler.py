@@ -7,22 +7,33 @@ class DbDialog(Base): a class to represent a dialog (chat) in the database.
 class DbDialogType(Base): a class to represent a type of dialog (chat) in the database.
 class DbFile(Base): a class to represent a file associated with a message group in the database.
 class DbFileType(Base): a class to represent a type of file associated with a message group in the database.
+class DbInputPeer(Base): a class to represent a cached Telegram input peer of a dialog in the database.
+class DbMediaBlob(Base): a class to represent a media blob shared by the files of message groups in the database.
 class DbMessageGroup(Base): a class to represent a message group in the database.
+class DbSyncMessageGroup(Base): a class to represent a received message group of a synchronized Telegram dialog.
+class DbSyncState(Base): a class to represent the synchronization state of a Telegram dialog in the database.
 class DbTag(Base): a class to represent a tag associated with a message group in the database.
 class DbCurrentState: a class representing the current state of the database client
 class DbMessageSortFilter:a class to represent sorting and filtering of message groups in the database.
 db_handler: an object of the DatabaseHandler class for working with the database
 message_group_tag_links: a relationship table for many-to-many relationship between message groups and tags
+message_groups_fts: the FTS5 full-text index of message group texts, created outside the models
+tags_fts: the FTS5 trigram index of tag names, created outside the models
 ModelType: a TypeVar for model classes, bound to Base
 """
 
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import RLock
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
 from typing import List, Any, Type, TypeVar # List - necessary for relationships
 from sqlalchemy import create_engine, Integer, ForeignKey, Text, String, Table, Column, select, asc, desc, or_, \
-    Boolean, update, delete, event, func, Select
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
+    Boolean, update, delete, event, func, Select, CompoundSelect, Update, table, column, literal_column, text, union, \
+    Index, JSON, insert
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session, sessionmaker, with_parent
 from configs.config import ProjectDirs, GlobalConst, TableNames, DialogTypes, MessageFileTypes, TagsSorting
 from utils import parse_date_string, status_messages
 
@@ -44,9 +55,22 @@ message_group_tag_links = Table(
     Column('message_group_id', String,
            ForeignKey(f'{TableNames.message_groups}.grouped_id'), primary_key=True),
     Column('tag_id', Integer,
-           ForeignKey(f'{TableNames.tags}.id'), primary_key=True)
+           ForeignKey(f'{TableNames.tags}.id'), primary_key=True),
+    # The primary key serves the tags of a message group, the index serves the message groups and usage of a tag
+    # Первичный ключ обслуживает теги группы сообщений, индекс обслуживает группы сообщений и использование тега
+    Index(f'ix_{TableNames.message_group_tag_links}_tag_id_message_group_id', 'tag_id', 'message_group_id')
 )
 
+# FTS5 full-text index of message group texts with the external content of the message_groups table. The FTS5
+# indexes are created by DatabaseHandler.setup_search_indexes, not by the models, and only their rowid and rank
+# are queried.
+# Полнотекстовый индекс FTS5 текстов групп сообщений с внешним содержимым таблицы message_groups. Индексы FTS5
+# создаются DatabaseHandler.setup_search_indexes, а не моделями, и из них запрашиваются только rowid и rank
+message_groups_fts = table(TableNames.message_groups_fts, column('rowid'), column('rank'))
+# FTS5 trigram index of tag names with the external content of the tags table
+# Триграммный индекс FTS5 названий тегов с внешним содержимым таблицы tags
+tags_fts = table(TableNames.tags_fts, column('rowid'))
+
 
 class DbMessageGroup(Base):  # pylint: disable=too-few-public-methods
     """
@@ -55,6 +79,9 @@ class DbMessageGroup(Base):  # pylint: disable=too-few-public-methods
     """
 
     __tablename__ = TableNames.message_groups  # Table name in the database / Имя таблицы в базе данных
+    # Indexes of the filters and sorting by dialogs and dates / Индексы фильтров и сортировки по диалогам и датам
+    __table_args__ = (Index(f'ix_{TableNames.message_groups}_dialog_id_date', 'dialog_id', 'date'),
+                      Index(f'ix_{TableNames.message_groups}_date', 'date'))
     grouped_id: Mapped[str] = mapped_column(String, primary_key=True, unique=True, index=True, nullable=False)
     date: Mapped[datetime]
     text: Mapped[str] = mapped_column(Text, nullable=True)
@@ -150,11 +177,16 @@ class DbFile(Base):  # pylint: disable=too-few-public-methods
     size: Mapped[int] = mapped_column(Integer, nullable=True)
     # Relationships to 'DbMessageGroup' table
     grouped_id: Mapped[str] = mapped_column(String,
-                                            ForeignKey(f'{TableNames.message_groups}.grouped_id', ondelete='CASCADE'))
+                                            ForeignKey(f'{TableNames.message_groups}.grouped_id', ondelete='CASCADE'),
+                                            index=True)
     message_group: Mapped['DbMessageGroup'] = relationship(back_populates='files')
     # Relationships to 'DbFileType' table
     file_type_id: Mapped[int] = mapped_column(Integer, ForeignKey(f'{TableNames.file_types}.file_type_id'))
     file_type: Mapped['DbFileType'] = relationship(back_populates='files')
+    # Relationships to 'DbMediaBlob' table
+    media_id: Mapped[str] = mapped_column(String, ForeignKey(f'{TableNames.media_blobs}.media_id'), nullable=True,
+                                          index=True)
+    media_blob: Mapped['DbMediaBlob'] = relationship(back_populates='files')
 
     def is_exists(self) -> bool:
         """
@@ -180,6 +212,71 @@ class DbFileType(Base):  # pylint: disable=too-few-public-methods
     files: Mapped[List['DbFile']] = relationship(back_populates='file_type')
 
 
+class DbMediaBlob(Base):  # pylint: disable=too-few-public-methods
+    """
+    A class to represent a media blob shared by the files of message groups in the database. The files of the same
+    Telegram photo or document forwarded to several chats are links to one blob. The SHA-256 hash of the blob content
+    is filled in during maintenance, if media is deduplicated by content.
+    Класс для представления блоба медиа, общего для файлов групп сообщений в базе данных. Файлы одной фотографии
+    или документа Telegram, пересланных в несколько диалогов, являются ссылками на один блоб. Хэш SHA-256
+    содержимого блоба заполняется при обслуживании, если медиа дедуплицируются по содержимому.
+    """
+
+    __tablename__ = TableNames.media_blobs  # Table name in the database / Имя таблицы в базе данных
+    media_id: Mapped[str] = mapped_column(String, primary_key=True, nullable=False)
+    blob_path: Mapped[str] = mapped_column(String, nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=True)
+    content_hash: Mapped[str] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+    # Relationships to 'DbFile' table
+    files: Mapped[List['DbFile']] = relationship(back_populates='media_blob')
+
+
+class DbInputPeer(Base):  # pylint: disable=too-few-public-methods
+    """
+    A class to represent a cached Telegram input peer of a dialog in the database.
+    Класс для представления кэшированного входного пира Telegram диалога в базе данных.
+    """
+
+    __tablename__ = TableNames.input_peers  # Table name in the database / Имя таблицы в базе данных
+    dialog_id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
+    peer_type: Mapped[str] = mapped_column(String, nullable=False)
+    peer_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    access_hash: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now, onupdate=datetime.now)
+
+
+class DbSyncState(Base):  # pylint: disable=too-few-public-methods
+    """
+    A class to represent the synchronization state of a Telegram dialog in the database: the received message groups
+    are complete from the start date to the last received message.
+    Класс для представления состояния синхронизации диалога Telegram в базе данных: полученные группы сообщений
+    полны от начальной даты до последнего полученного сообщения.
+    """
+
+    __tablename__ = TableNames.sync_states  # Table name in the database / Имя таблицы в базе данных
+    dialog_id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
+    last_message_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # None if the message groups are received from the first message of the dialog
+    # None, если группы сообщений получены с первого сообщения диалога
+    date_from: Mapped[datetime] = mapped_column(nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now, onupdate=datetime.now)
+
+
+class DbSyncMessageGroup(Base):  # pylint: disable=too-few-public-methods
+    """
+    A class to represent a received message group of a synchronized Telegram dialog in the database, kept as a record
+    of the Telegram handler to restore the message group list after a restart.
+    Класс для представления полученной группы сообщений синхронизированного диалога Telegram в базе данных, хранимой
+    как запись обработчика Telegram для восстановления списка групп сообщений после перезапуска.
+    """
+
+    __tablename__ = TableNames.sync_message_groups  # Table name in the database / Имя таблицы в базе данных
+    grouped_id: Mapped[str] = mapped_column(String, primary_key=True, nullable=False)
+    dialog_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    record: Mapped[dict[str, Any]] = mapped_column(JSON, nullable=False)
+
+
 # noinspection PyUnresolvedReferences
 @dataclass
 class DbMessageSortFilter:  # pylint: disable=too-many-instance-attributes
@@ -188,7 +285,7 @@ class DbMessageSortFilter:  # pylint: disable=too-many-instance-attributes
     Класс для представления параметров сортировки и фильтра для групп сообщений в базе данных.
     Attributes:
         selected_dialog_list (list[int] | None): list of selected dialog IDs for filtering messages
-        sorting_field (str): field to sort messages by (date or dialog)
+        sorting_field (str): field to sort messages by (date, dialog or relevance to the message text filter)
         sort_order (bool): sort order: descending (True) or ascending (False)
         date_from (datetime | None): date from which to get messages
         date_to (datetime | None): date to which to get messages
@@ -205,6 +302,7 @@ class DbMessageSortFilter:  # pylint: disable=too-many-instance-attributes
     _tag_query: list[str] | None = None
     sort_by_date: str = 'by date'
     sort_by_title: str = 'by title'
+    sort_by_relevance: str = 'by relevance'
 
     @property
     def selected_dialog_list(self) -> list[int] | None:
@@ -241,7 +339,7 @@ class DbMessageSortFilter:  # pylint: disable=too-many-instance-attributes
         Sets the field by which messages are sorted
         Задает поле, по которому сортируются сообщения
         """
-        self._sorting_field = self.sort_by_date if value == '0' else self.sort_by_title
+        self._sorting_field = {'1': self.sort_by_title, '2': self.sort_by_relevance}.get(value, self.sort_by_date)
 
     @property
     def sort_order(self) -> bool:
@@ -374,16 +472,23 @@ class DatabaseHandler:
         all_tags_list (list[DbTag] | None): list of all database tags
         message_sort_filter (DbMessageSortFilter): current message filter
         current_state (DbCurrentState): current state of the database
+        full_text_search (bool): the message text filter uses the FTS5 full-text index
+        tag_search (bool): the tag filter uses the FTS5 trigram index of tag names
+        dialog_list_outdated (bool): message groups have been saved in another session after the dialog list was read
     """
 
     all_dialogues_list: list[DbDialog] | None = None
     all_tags_list: list[DbTag] | None = None
     message_sort_filter: DbMessageSortFilter = DbMessageSortFilter()
     current_state: DbCurrentState = DbCurrentState()
+    full_text_search: bool = False
+    tag_search: bool = False
+    dialog_list_outdated: bool = False
 
     def upsert_record(self, model_class: Type[ModelType],
                       filter_fields: dict[str, Any],
-                      update_fields: dict[str, Any]) -> ModelType:
+                      update_fields: dict[str, Any],
+                      session: Session | None = None) -> ModelType:
         """
         Universal function for searching and updating/creating records in any database model
         Универсальная функция для поиска и обновления/создания записи в любой модели БД
@@ -391,12 +496,14 @@ class DatabaseHandler:
             model_class (Type[ModelType]): model class in which to search/create a record
             filter_fields (dict[str, Any]): fields for searching the record
             update_fields (dict[str, Any]): fields for updating/creating the record
+            session (Session | None): session of the record, the shared session of the handler if None
         Returns:
             ModelType: the found or created/updated record
         """
 
+        session = session or self.session
         # Checking the record for existence / Проверяем запись на существование
-        existing = self.session.query(model_class).filter_by(**filter_fields).first()
+        existing = session.query(model_class).filter_by(**filter_fields).first()
         if filter_fields and existing:
             # Updating an existing record / Обновляем существующую запись
             for key, value in update_fields.items():
@@ -404,10 +511,29 @@ class DatabaseHandler:
         else:
             # Create a new record / Создаем новую запись
             existing = model_class(**{**filter_fields, **update_fields})
-            self.session.add(existing)
-            self.session.flush()  # Flush to get the ID if it's an autoincrement field
+            session.add(existing)
+            session.flush()  # Flush to get the ID if it's an autoincrement field
         return existing
 
+    def write_record(self, model_class: Type[ModelType], filter_fields: dict[str, Any],
+                     update_fields: dict[str, Any]) -> None:
+        """
+        Creating or updating a record in its own session and transaction, called in the background writer thread.
+        Writing is serialized with the saving of message groups by the write lock.
+        Создание или обновление записи в собственной сессии и транзакции, вызывается в потоке фоновой записи.
+        Запись сериализуется с сохранением групп сообщений блокировкой записи.
+        Attributes:
+            model_class (Type[ModelType]): model class of the record
+            filter_fields (dict[str, Any]): fields for searching the record
+            update_fields (dict[str, Any]): fields for updating/creating the record
+        """
+
+        try:
+            with self.write_lock, self.session_factory.begin() as session:
+                self.upsert_record(model_class, filter_fields, update_fields, session)
+        except SQLAlchemyError as error:
+            status_messages.mess_update('Database', f'Failed to save {model_class.__tablename__}: {error}')
+
     def setup_database_connection(self):
         """
         Configuring SQLite database connection settings
@@ -425,6 +551,254 @@ class DatabaseHandler:
             cursor.execute("PRAGMA temp_store=MEMORY")  # Временные данные в RAM
             cursor.close()
 
+    def upgrade_schema(self) -> None:
+        """
+        Adding the columns and indexes of the models missing in the tables of an existing database, since create_all
+        creates only missing tables. The added columns must allow NULL values. The tables of earlier versions that are
+        no longer used are dropped.
+        Добавление столбцов и индексов моделей, отсутствующих в таблицах существующей базы данных, так как create_all
+        создает только отсутствующие таблицы. Добавляемые столбцы должны допускать значения NULL. Таблицы прежних
+        версий, которые больше не используются, удаляются.
+        """
+
+        with self.engine.begin() as connection:
+            for dropped_table in GlobalConst.dropped_tables:
+                connection.exec_driver_sql(f'DROP TABLE IF EXISTS {dropped_table}')
+            for db_table in Base.metadata.sorted_tables:
+                table_columns = {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({db_table.name})')}
+                for db_column in db_table.columns:
+                    if db_column.name in table_columns:
+                        continue
+                    references = ''.join(f' REFERENCES {foreign_key.column.table.name}({foreign_key.column.name})'
+                                         for foreign_key in db_column.foreign_keys)
+                    connection.exec_driver_sql(f'ALTER TABLE {db_table.name} ADD COLUMN {db_column.name} '
+                                               f'{db_column.type.compile(self.engine.dialect)}{references}')
+                for index in db_table.indexes:
+                    index.create(connection, checkfirst=True)
+
+    def setup_search_indexes(self) -> None:
+        """
+        Creating the FTS5 indexes: the full-text index of message group texts and the trigram index of tag names.
+        If SQLite is built without FTS5 or its trigram tokenizer, the filters search for a fragment of the text.
+        Создание индексов FTS5: полнотекстового индекса текстов групп сообщений и триграммного индекса названий
+        тегов. Если SQLite собран без FTS5 или его триграммного токенизатора, фильтры ищут фрагмент текста.
+        """
+
+        # The unicode61 tokenizer folds the case of all alphabets, including Cyrillic
+        # Токенизатор unicode61 приводит к одному регистру буквы всех алфавитов, включая кириллицу
+        self.full_text_search = self.create_search_index(TableNames.message_groups_fts, TableNames.message_groups,
+                                                         'rowid', 'text', 'unicode61 remove_diacritics 2')
+        # The trigram tokenizer finds any fragment of at least three characters of a tag name
+        # Триграммный токенизатор находит любой фрагмент названия тега не короче трех символов
+        self.tag_search = self.create_search_index(TableNames.tags_fts, TableNames.tags, 'id', 'name', 'trigram')
+        if not self.full_text_search or not self.tag_search:
+            status_messages.mess_update('Database', 'FTS5 is not available, the filters scan messages and tags')
+        # The full-text index refers to the implicit rowid of message groups, which may be renumbered
+        # Полнотекстовый индекс ссылается на неявный rowid групп сообщений, который может быть перенумерован
+        if self.full_text_search and not self.is_search_index_in_sync(TableNames.message_groups_fts,
+                                                                      TableNames.message_groups):
+            self.rebuild_search_indexes()
+
+    def is_search_index_in_sync(self, fts: str, content_table: str) -> bool:
+        """
+        Checking that the rowid values of an FTS5 index with external content match the rowid values of its table.
+        VACUUM or copying of a table without an INTEGER PRIMARY KEY, for example, restoring it from a dump, may number
+        its rows from 1 in order, which changes them only if the rowid values have gaps, and then the largest rowid
+        decreases. The number and the largest rowid of the indexed rows are taken from the docsize table of the index.
+        Проверка соответствия значений rowid индекса FTS5 с внешним содержимым значениям rowid его таблицы. VACUUM
+        или копирование таблицы без INTEGER PRIMARY KEY, например, ее восстановление из дампа, может пронумеровать ее
+        строки с 1 по порядку, что изменяет их, только если в значениях rowid есть пропуски, и тогда наибольший rowid
+        уменьшается. Количество и наибольший rowid проиндексированных строк берутся из таблицы docsize индекса.
+        Attributes:
+            fts (str): index name
+            content_table (str): name of the indexed table
+        Returns:
+            bool: True if the index refers to the same rows as the table
+        """
+
+        with self.engine.connect() as connection:
+            table_rows = connection.exec_driver_sql(f'SELECT count(*), max(rowid) FROM {content_table}').one()
+            index_rows = connection.exec_driver_sql(f'SELECT count(*), max(id) FROM {fts}_docsize').one()
+        return tuple(table_rows) == tuple(index_rows)
+
+    def create_search_index(self, fts: str, content_table: str, content_rowid: str, content_column: str,
+                            tokenizer: str) -> bool:
+        """
+        Creating an FTS5 index with the external content of a table column and the triggers keeping it in sync with
+        the table. A new index of an existing database is filled from the table.
+        Создание индекса FTS5 с внешним содержимым столбца таблицы и триггеров, поддерживающих его соответствие
+        таблице. Новый индекс существующей базы данных заполняется из таблицы.
+        Attributes:
+            fts (str): index name
+            content_table (str): name of the indexed table
+            content_rowid (str): integer key of the indexed table
+            content_column (str): indexed column
+            tokenizer (str): FTS5 tokenizer with its options
+        Returns:
+            bool: True if the index is available
+        """
+
+        with self.engine.begin() as connection:
+            index_exists = connection.exec_driver_sql(
+                'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', fts)).first() is not None
+            if not index_exists:
+                try:
+                    connection.exec_driver_sql(
+                        f"CREATE VIRTUAL TABLE {fts} USING fts5({content_column}, content='{content_table}', "
+                        f"content_rowid='{content_rowid}', tokenize='{tokenizer}')")
+                except OperationalError:
+                    return False
+            new_values, old_values = f'new.{content_rowid}, new.{content_column}', \
+                f'old.{content_rowid}, old.{content_column}'
+            connection.exec_driver_sql(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {content_table} BEGIN
+                    INSERT INTO {fts}(rowid, {content_column}) VALUES ({new_values});
+                END""")
+            connection.exec_driver_sql(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {content_table} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {content_column}) VALUES ('delete', {old_values});
+                END""")
+            connection.exec_driver_sql(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {content_column} ON {content_table} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {content_column}) VALUES ('delete', {old_values});
+                    INSERT INTO {fts}(rowid, {content_column}) VALUES ({new_values});
+                END""")
+            if not index_exists:
+                connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        return True
+
+    def verify_query_plans(self) -> dict[str, list[str]]:
+        """
+        Checking with EXPLAIN QUERY PLAN that the filters, sorting and tag counters of the archive use indexes and do
+        not scan the tables of message groups, tag links and files, which grow with the archive
+        Проверка с помощью EXPLAIN QUERY PLAN, что фильтры, сортировка и счетчики тегов архива используют индексы и не
+        сканируют таблицы групп сообщений, связей тегов и файлов, растущие вместе с архивом
+        Returns:
+            dict[str, list[str]]: plan lines with full scans by query names, empty if all queries use indexes
+        """
+
+        watched_tables = {TableNames.message_groups, TableNames.message_group_tag_links, TableNames.files}
+        full_scans = {}
+        for query_name, plan in self.get_query_plans().items():
+            # A scan through an index is allowed, for example, reading a covering index in its order
+            # Сканирование по индексу допускается, например, чтение покрывающего индекса в его порядке
+            scans = [line for line in plan if (scan := re.match(r'SCAN (\w+)', line))
+                     and scan.group(1) in watched_tables and 'INDEX' not in line]
+            if scans:
+                full_scans[query_name] = scans
+        return full_scans
+
+    def get_query_plans(self) -> dict[str, list[str]]:
+        """
+        Getting the EXPLAIN QUERY PLAN lines of the access paths of the archive. The queries are formed by the same
+        methods as the queries of the message list, the dialog list and the tag list.
+        Получение строк EXPLAIN QUERY PLAN путей доступа архива. Запросы формируются теми же методами, что и запросы
+        списка сообщений, списка диалогов и списка тегов.
+        Returns:
+            dict[str, list[str]]: plan lines by query names
+        """
+
+        date_string = datetime.now().strftime('%d.%m.%Y')
+        query_names = ['dialog and date filter', 'date filter', 'sorting by date', 'sorting by dialog title',
+                       'tag filter']
+        # Without the full-text index the text filter can only scan the messages
+        # Без полнотекстового индекса фильтр по тексту может только сканировать сообщения
+        if self.full_text_search:
+            query_names.append('text filter')
+        message_filters = {query_name: DbMessageSortFilter() for query_name in query_names}
+        for message_filter in message_filters.values():
+            message_filter.sorting_field = '0'
+            message_filter.sort_order = '1'
+        message_filters['dialog and date filter'].selected_dialog_list = [1, 2]
+        message_filters['dialog and date filter'].date_from = date_string
+        message_filters['date filter'].date_from = date_string
+        message_filters['date filter'].date_to = date_string
+        message_filters['sorting by dialog title'].sorting_field = '1'
+        if self.full_text_search:
+            message_filters['text filter'].message_query = 'text'
+            message_filters['text filter'].sorting_field = '2'
+        message_filters['tag filter'].tag_query = 'tag'
+        queries: dict[str, Any] = {name: self.get_message_group_select(message_filter)
+                                   for name, message_filter in message_filters.items()}
+        queries.update({
+            'dialogs of message groups': self.get_message_group_dialogs_select(),
+            'tag usage count': self.get_tag_usage_count_update(),
+            # The query of the lazy loading of the files of a message group
+            # Запрос отложенной загрузки файлов группы сообщений
+            'files of a message group': select(DbFile).where(with_parent(DbMessageGroup(grouped_id=''),
+                                                                         DbMessageGroup.files)),
+        })
+        query_plans = {}
+        for query_name, query in queries.items():
+            compiled_query = query.compile(self.engine, compile_kwargs={'literal_binds': True})
+            query_plans[query_name] = [row[3] for row in self.session.connection().exec_driver_sql(
+                f'EXPLAIN QUERY PLAN {compiled_query}')]
+        return query_plans
+
+    def rebuild_search_indexes(self) -> None:
+        """
+        Rebuilding the FTS5 indexes from their tables. The index of message texts is also rebuilt at startup if
+        VACUUM has renumbered the rowid of the message_groups table.
+        Перестроение индексов FTS5 по их таблицам. Индекс текстов сообщений также перестраивается при запуске, если
+        VACUUM перенумеровал rowid таблицы message_groups.
+        """
+
+        with self.engine.begin() as connection:
+            for fts, available in ((TableNames.message_groups_fts, self.full_text_search),
+                                   (TableNames.tags_fts, self.tag_search)):
+                if available:
+                    connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        status_messages.mess_update('Database', 'Search indexes of messages and tags rebuilt')
+
+    def get_tag_ids_select(self, keywords: list[str]) -> Select | CompoundSelect:
+        """
+        Forming a query of the IDs of tags whose names contain any of the keywords. Keywords of at least three
+        characters are looked up in the trigram index, shorter ones are searched for in the tag table.
+        Формирование запроса ID тегов, названия которых содержат любое из ключевых слов. Ключевые слова не короче
+        трех символов ищутся в триграммном индексе, более короткие ищутся в таблице тегов.
+        Attributes:
+            keywords (list[str]): keywords
+        Returns:
+            Select | CompoundSelect: query of tag IDs, the union of both queries if there are keywords of both kinds
+        """
+
+        indexed_keywords = [keyword for keyword in keywords if self.tag_search and len(keyword) >= 3]
+        other_keywords = [keyword for keyword in keywords if keyword not in indexed_keywords]
+        tag_id_selects = []
+        if indexed_keywords:
+            # A keyword in double quotes is searched for as a fragment / Ключевое слово в кавычках ищется как фрагмент
+            match_query = ' OR '.join(f'"{keyword.replace('"', '""')}"' for keyword in indexed_keywords)
+            tag_id_selects.append(select(tags_fts.c.rowid).where(
+                text(f'{TableNames.tags_fts} MATCH :tag_match_query').bindparams(tag_match_query=match_query)))
+        if other_keywords:
+            tag_id_selects.append(select(DbTag.id).where(or_(*[DbTag.name.ilike(f'%{keyword}%')
+                                                               for keyword in other_keywords])))
+        return tag_id_selects[0] if len(tag_id_selects) == 1 else union(*tag_id_selects)
+
+    @staticmethod
+    def get_match_query(message_query: str) -> str:
+        """
+        Converting the text of the message text filter into an FTS5 query: words are searched as prefixes of words
+        of messages, text in double quotes is searched as a phrase, FTS5 operators and special characters are
+        removed
+        Преобразование текста фильтра по тексту сообщений в запрос FTS5: слова ищутся как начала слов сообщений,
+        текст в двойных кавычках ищется как фраза, операторы и специальные символы FTS5 удаляются
+        Attributes:
+            message_query (str): text of the message text filter
+        Returns:
+            str: FTS5 query, or empty string if the text has no words
+        """
+
+        match_terms = []
+        for phrase, words in re.findall(r'"([^"]*)"|([^\s"]+)', message_query):
+            if phrase:
+                phrase_words = re.findall(r'\w+', phrase)
+                if phrase_words:
+                    match_terms.append(f'"{" ".join(phrase_words)}"')
+            else:
+                match_terms.extend(f'"{word}"*' for word in re.findall(r'\w+', words))
+        return ' '.join(match_terms)
+
     def __init__(self):
         """
         Initializes the database handler by creating an engine, a session, and the necessary tables.
@@ -435,9 +809,23 @@ class DatabaseHandler:
         self.engine = create_engine(f'sqlite:///{ProjectDirs.data_base_file}')
         self.setup_database_connection()
         self.session = Session(self.engine)
+        # Threads other than request handlers work with the database in their own sessions, and their writes are
+        # serialized by the write lock. Input peers and synchronization states are written by one background thread.
+        # Потоки, отличные от обработчиков запросов, работают с базой данных в собственных сессиях, а их запись
+        # сериализуется блокировкой записи. Входные пиры и состояния синхронизации записываются одним фоновым потоком.
+        self.session_factory = sessionmaker(self.engine)
+        self.write_lock = RLock()
+        self.background_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database_writer')
         # Creating tables in the database if they do not exist
         # Создаем таблицы в базе данных, если они отсутствуют
         Base.metadata.create_all(self.engine)
+        self.upgrade_schema()
+        self.setup_search_indexes()
+        # Checking that the queries of the archive do not scan the large tables
+        # Проверяем, что запросы архива не сканируют большие таблицы
+        full_scans = self.verify_query_plans()
+        if full_scans:
+            status_messages.mess_update('Database', f'Queries scanning large tables: {", ".join(full_scans)}')
         # Checking the availability of data in the static table with dialogue types and adding them if necessary.
         # Проверяем наличие данных в статической таблице с типами диалогов и добавляем их при необходимости
         for dialog_type in DialogTypes:
@@ -474,7 +862,7 @@ class DatabaseHandler:
         all_dialogs_id = set(self.session.execute(select(DbDialog.dialog_id)).scalars().all())
         # Getting a set of dialog IDs that are referenced in message groups
         # Получаем множество ID диалогов, на которые есть ссылки в группах сообщений
-        referenced_dialogs_id = set(self.session.execute(select(DbMessageGroup.dialog_id).distinct()).scalars().all())
+        referenced_dialogs_id = set(self.session.execute(self.get_message_group_dialogs_select()).scalars().all())
         # Find unused dialogs / Находим не используемые диалоги
         unused_dialogs_id = all_dialogs_id - referenced_dialogs_id
         # Deleting unused dialogs / Удаляем неиспользуемые диалоги
@@ -490,6 +878,34 @@ class DatabaseHandler:
         #                             f'{len(query_result)} chats loaded from the database')
         return list(query_result)
 
+    @staticmethod
+    def get_tag_usage_count_update() -> Update:
+        """
+        Forming a statement updating the usage counts of all tags by the number of their links to message groups
+        Формирование оператора, обновляющего счетчики использования всех тегов по количеству их связей с группами
+        сообщений
+        Returns:
+            Update: update statement of the tag usage counts
+        """
+
+        return (update(DbTag).values(
+            usage_count=select(func.count())  # pylint: disable=not-callable
+            .select_from(message_group_tag_links)
+            .where(message_group_tag_links.c.tag_id == DbTag.id)  # type: ignore
+            .scalar_subquery())
+                .where(DbTag.id.isnot(None))
+                )
+
+    @staticmethod
+    def get_message_group_dialogs_select() -> Select:
+        """
+        Forming a query of the IDs of the dialogs that have message groups
+        Формирование запроса ID диалогов, у которых есть группы сообщений
+        Returns:
+            Select: query of dialog IDs
+        """
+        return select(DbMessageGroup.dialog_id).distinct()
+
     def get_all_tag_list(self) -> list[DbTag]:
         """
         Get a list of all tags available in the database, taking into account the sorting specified in
@@ -498,14 +914,7 @@ class DatabaseHandler:
         """
 
         # Updating tag usage rates / Обновляем частоту использования тегов
-        update_stmt = (update(DbTag).values(
-            usage_count=select(func.count())  # pylint: disable=not-callable
-            .select_from(message_group_tag_links)
-            .where(message_group_tag_links.c.tag_id == DbTag.id)  # type: ignore
-            .scalar_subquery())
-                       .where(DbTag.id.isnot(None))
-                       )
-        self.session.execute(update_stmt)
+        self.session.execute(self.get_tag_usage_count_update())
         # Remove tags that are not used / Удаляем теги, которые не используются
         self.session.query(DbTag).filter(DbTag.usage_count == 0).delete()
         # Save changes to the database / Сохраняем изменения в базе данных
@@ -525,6 +934,68 @@ class DatabaseHandler:
         query_result = self.session.execute(select_stmt).scalars().all()
         return list(query_result)
 
+    def get_message_group_select(self, message_sort_filter: DbMessageSortFilter) -> Select:
+        """
+        Forming a query of message groups with the filters and sorting of a message filter. The query is used by the
+        message list and by the check of query plans.
+        Формирование запроса групп сообщений с фильтрами и сортировкой фильтра сообщений. Запрос используется списком
+        сообщений и проверкой планов запросов.
+        Attributes:
+            message_sort_filter (DbMessageSortFilter): message filter
+        Returns:
+            Select: query of message groups
+        """
+
+        select_stmt = select(DbMessageGroup)
+        # Filter by selected dialogs / Фильтр по выбранным диалогам
+        if message_sort_filter.selected_dialog_list:
+            select_stmt = select_stmt.where(DbMessageGroup.dialog_id.in_(message_sort_filter.selected_dialog_list))
+        # Filter by date from and to / Фильтр по дате от и до
+        if message_sort_filter.date_from:
+            select_stmt = select_stmt.where(DbMessageGroup.date >= message_sort_filter.date_from)
+        if message_sort_filter.date_to:
+            select_stmt = select_stmt.where(DbMessageGroup.date <= message_sort_filter.date_to)
+        # Filter by message text, through the full-text index if it is available
+        # Фильтр по текстам сообщений, через полнотекстовый индекс, если он доступен
+        search_ranked = False
+        if message_sort_filter.message_query:
+            match_query = self.get_match_query(message_sort_filter.message_query) \
+                if self.full_text_search else ''
+            if match_query:
+                found_messages = (select(message_groups_fts.c.rowid, message_groups_fts.c.rank)
+                                  .where(text(f'{TableNames.message_groups_fts} MATCH :match_query')
+                                         .bindparams(match_query=match_query))
+                                  .subquery())
+                select_stmt = select_stmt.join(
+                    found_messages, found_messages.c.rowid == literal_column(f'{TableNames.message_groups}.rowid'))
+                search_ranked = True
+            else:
+                select_stmt = select_stmt.where(
+                    DbMessageGroup.text.ilike(f'%{message_sort_filter.message_query}%'))
+        # Filter by message tags: the keywords are resolved to tag IDs, then the message groups are found by the links
+        # Фильтр по тегам сообщений: ключевые слова преобразуются в ID тегов, затем группы сообщений находятся по связям
+        if message_sort_filter.tag_query:
+            select_stmt = select_stmt.where(DbMessageGroup.grouped_id.in_(
+                select(message_group_tag_links.c.message_group_id).where(message_group_tag_links.c.tag_id.in_(
+                    self.get_tag_ids_select(message_sort_filter.tag_query)))))
+        # Sort by dialogues / Сортировка по диалогам
+        if message_sort_filter.sorting_field == message_sort_filter.sort_by_title:
+            select_stmt = select_stmt.join(DbDialog).order_by(
+                DbDialog.title.desc() if message_sort_filter.sort_order else DbDialog.title.asc(),
+                DbMessageGroup.date.desc())
+        # Sort by relevance to the message text filter (bm25 rank), then by date
+        # Сортировка по релевантности фильтру по тексту сообщений (ранг bm25), затем по дате
+        if message_sort_filter.sorting_field == message_sort_filter.sort_by_relevance:
+            if search_ranked:
+                select_stmt = select_stmt.order_by(found_messages.c.rank, DbMessageGroup.date.desc())
+            else:
+                select_stmt = select_stmt.order_by(DbMessageGroup.date.desc())
+        # Sort by date / Сортировка по дате
+        if message_sort_filter.sorting_field == message_sort_filter.sort_by_date:
+            select_stmt = select_stmt.order_by(
+                DbMessageGroup.date.desc() if message_sort_filter.sort_order else DbMessageGroup.date.asc())
+        return select_stmt
+
     def get_message_group_list(self) -> list[DbMessageGroup]:
         """
         Getting a list of message groups based on filters and sorting
@@ -537,33 +1008,7 @@ class DatabaseHandler:
         # Save changes to the database / Сохраняем изменения в базе данных
         self.session.commit()
         # Generating a query taking into account filters and sorting / Формируем запрос с учетом фильтров и сортировки
-        select_stmt = select(DbMessageGroup)
-        # Filter by selected dialogs / Фильтр по выбранным диалогам
-        if self.message_sort_filter.selected_dialog_list:
-            select_stmt = select_stmt.where(DbMessageGroup.dialog_id.in_(self.message_sort_filter.selected_dialog_list))
-        # Filter by date from and to / Фильтр по дате от и до
-        if self.message_sort_filter.date_from:
-            select_stmt = select_stmt.where(DbMessageGroup.date >= self.message_sort_filter.date_from)
-        if self.message_sort_filter.date_to:
-            select_stmt = select_stmt.where(DbMessageGroup.date <= self.message_sort_filter.date_to)
-        # Filter by message text / Фильтр по текстам сообщений
-        if self.message_sort_filter.message_query:
-            select_stmt = select_stmt.where(DbMessageGroup.text.ilike(f'%{self.message_sort_filter.message_query}%'))
-        # Filter by message tags / Фильтр по тегам сообщений
-        if self.message_sort_filter.tag_query:
-            # Create a list of expressions with conditions for searching for key phrases in tags
-            # Создаем список выражений с условиями для поиска ключевых фраз в тегах
-            tag_conditions = [DbTag.name.ilike(f'%{keyword}%') for keyword in self.message_sort_filter.tag_query]
-            select_stmt = select_stmt.where(DbMessageGroup.tags.any(or_(*tag_conditions)))
-        # Sort by dialogues / Сортировка по диалогам
-        if self.message_sort_filter.sorting_field == self.message_sort_filter.sort_by_title:
-            select_stmt = select_stmt.join(DbDialog).order_by(
-                DbDialog.title.desc() if self.message_sort_filter.sort_order else DbDialog.title.asc(),
-                DbMessageGroup.date.desc())
-        # Sort by date / Сортировка по дате
-        if self.message_sort_filter.sorting_field == self.message_sort_filter.sort_by_date:
-            select_stmt = select_stmt.order_by(
-                DbMessageGroup.date.desc() if self.message_sort_filter.sort_order else DbMessageGroup.date.asc())
+        select_stmt = self.get_message_group_select(self.message_sort_filter)
         query_result = self.session.execute(select_stmt).scalars().all()
         status_messages.mess_update('Loading chats from the database',
                                     f'{len(query_result)} chats loaded from the database', True)
@@ -662,6 +1107,186 @@ class DatabaseHandler:
                             'file_type_id': query_result.file_type_id, }
         return db_file_info
 
+    def delete_unused_media_blobs(self) -> int:
+        """
+        Deletes the media blobs that are not referenced by any file from the database
+        Удаляет из базы данных блобы медиа, на которые не ссылается ни один файл
+        Returns:
+            int: number of deleted blobs
+        """
+
+        unused_blobs = self.session.execute(select(DbMediaBlob).where(~DbMediaBlob.files.any())).scalars().all()
+        for media_blob in unused_blobs:
+            self.session.delete(media_blob)
+        self.session.commit()
+        return len(unused_blobs)
+
+    def get_media_blob_hashes(self) -> dict[str, str | None]:
+        """
+        Gets the media IDs of all media blobs with the hashes of their content
+        Получает ID медиа всех блобов медиа с хэшами их содержимого
+        Returns:
+            dict[str, str | None]: content hash by media ID, None if the hash has not been calculated yet
+        """
+        return dict(self.session.execute(select(DbMediaBlob.media_id, DbMediaBlob.content_hash)).tuples().all())
+
+    def save_media_blob_hashes(self, content_hashes: dict[str, str]) -> None:
+        """
+        Saves the calculated hashes of the content of media blobs
+        Сохраняет вычисленные хэши содержимого блобов медиа
+        Attributes:
+            content_hashes (dict[str, str]): content hash by media ID
+        """
+
+        if not content_hashes:
+            return
+        self.session.execute(update(DbMediaBlob), [{'media_id': media_id, 'content_hash': content_hash}
+                                                   for media_id, content_hash in content_hashes.items()])
+        self.session.commit()
+
+    def get_input_peer(self, dialog_id: int) -> dict[str, Any] | None:
+        """
+        Gets a cached Telegram input peer of a dialog from the database
+        Получает из базы данных кэшированный входной пир Telegram диалога
+        Attributes:
+            dialog_id (int): dialog ID
+        Returns:
+            dict[str, Any] | None: input peer record or None if not found
+        """
+
+        # Called from any thread, so the shared session is not used
+        # Вызывается из любого потока, поэтому общая сессия не используется
+        with self.session_factory() as session:
+            query_result = session.get(DbInputPeer, dialog_id)
+            input_peer_record = None
+            if query_result:
+                input_peer_record = {'peer_type': query_result.peer_type,
+                                     'peer_id': query_result.peer_id,
+                                     'access_hash': query_result.access_hash}
+        return input_peer_record
+
+    def save_input_peer(self, dialog_id: int, peer_type: str, peer_id: int, access_hash: int) -> Future:
+        """
+        Saves a Telegram input peer of a dialog to the database in the background writer thread
+        Сохраняет входной пир Telegram диалога в базе данных в потоке фоновой записи
+        Attributes:
+            dialog_id (int): dialog ID
+            peer_type (str): input peer type: user, chat, channel or self
+            peer_id (int): peer ID
+            access_hash (int): peer access hash
+        Returns:
+            Future: future completed when the input peer is saved
+        """
+
+        return self.background_writer.submit(self.write_record, DbInputPeer, {'dialog_id': dialog_id},
+                                             {'peer_type': peer_type, 'peer_id': peer_id, 'access_hash': access_hash})
+
+    def get_sync_state(self, dialog_id: int) -> tuple[int, datetime | None] | None:
+        """
+        Gets the synchronization state of a Telegram dialog from the database
+        Получает из базы данных состояние синхронизации диалога Telegram
+        Attributes:
+            dialog_id (int): dialog ID
+        Returns:
+            tuple[int, datetime | None] | None: ID of the last received message and the start date of the received
+                message groups, or None if the dialog has not been synchronized
+        """
+
+        # Called from any thread, so the shared session is not used
+        # Вызывается из любого потока, поэтому общая сессия не используется
+        with self.session_factory() as session:
+            query_result = session.get(DbSyncState, dialog_id)
+            return (query_result.last_message_id, query_result.date_from) if query_result else None
+
+    def get_sync_message_groups(self, dialog_id: int) -> list[dict[str, Any]]:
+        """
+        Gets the records of the received message groups of a synchronized Telegram dialog from the database
+        Получает из базы данных записи полученных групп сообщений синхронизированного диалога Telegram
+        Attributes:
+            dialog_id (int): dialog ID
+        Returns:
+            list[dict[str, Any]]: message group records
+        """
+
+        with self.session_factory() as session:
+            return list(session.execute(select(DbSyncMessageGroup.record).where(
+                DbSyncMessageGroup.dialog_id == dialog_id)).scalars().all())
+
+    def save_sync_state(self, dialog_id: int, last_message_id: int, message_group_records: list[dict[str, Any]],
+                        date_from: datetime | None = None, replace: bool = False) -> Future:
+        """
+        Saves the synchronization state of a Telegram dialog and the records of its received message groups to the
+        database in the background writer thread
+        Сохраняет в базе данных состояние синхронизации диалога Telegram и записи его полученных групп сообщений
+        в потоке фоновой записи
+        Attributes:
+            dialog_id (int): dialog ID
+            last_message_id (int): ID of the last received message
+            message_group_records (list[dict[str, Any]]): records of the received message groups
+            date_from (datetime | None): start date of the received message groups, used only when replacing
+            replace (bool): replace all message groups of the dialog, otherwise add them to the saved ones
+        Returns:
+            Future: future completed when the synchronization state is saved
+        """
+
+        return self.background_writer.submit(self.write_sync_state, dialog_id, last_message_id,
+                                             message_group_records, date_from, replace)
+
+    def write_sync_state(self, dialog_id: int, last_message_id: int, message_group_records: list[dict[str, Any]],
+                         date_from: datetime | None, replace: bool) -> None:
+        """
+        Writing the synchronization state of a Telegram dialog and the records of its received message groups in its
+        own session and transaction, called in the background writer thread
+        Запись состояния синхронизации диалога Telegram и записей его полученных групп сообщений в собственной
+        сессии и транзакции, вызывается в потоке фоновой записи
+        Attributes:
+            dialog_id (int): dialog ID
+            last_message_id (int): ID of the last received message
+            message_group_records (list[dict[str, Any]]): records of the received message groups
+            date_from (datetime | None): start date of the received message groups, used only when replacing
+            replace (bool): replace all message groups of the dialog, otherwise add them to the saved ones
+        """
+
+        update_fields: dict[str, Any] = {'last_message_id': last_message_id}
+        try:
+            with self.write_lock, self.session_factory.begin() as session:
+                if replace:
+                    update_fields['date_from'] = date_from
+                    session.execute(delete(DbSyncMessageGroup).where(DbSyncMessageGroup.dialog_id == dialog_id))
+                else:
+                    # The groups of an album that is formed anew replace the saved ones
+                    # Группы альбома, сформированного заново, заменяют сохраненные
+                    grouped_ids = [record['grouped_id'] for record in message_group_records]
+                    for batch_start in range(0, len(grouped_ids), GlobalConst.sql_variables_batch_size):
+                        session.execute(delete(DbSyncMessageGroup).where(DbSyncMessageGroup.grouped_id.in_(
+                            grouped_ids[batch_start:batch_start + GlobalConst.sql_variables_batch_size])))
+                if message_group_records:
+                    session.execute(insert(DbSyncMessageGroup), [
+                        {'grouped_id': record['grouped_id'], 'dialog_id': dialog_id, 'record': record}
+                        for record in message_group_records])
+                self.upsert_record(DbSyncState, {'dialog_id': dialog_id}, update_fields, session)
+        except SQLAlchemyError as error:
+            status_messages.mess_update('Database', f'Failed to save {DbSyncState.__tablename__}: {error}')
+
+    def get_existing_message_group_ids(self, grouped_ids: list[str]) -> set[str]:
+        """
+        Returns the IDs of the specified message groups that exist in the database, requested in batches
+        of GlobalConst.sql_variables_batch_size IDs
+        Возвращает ID заданных групп сообщений, существующих в базе данных, запрашиваемые пакетами
+        по GlobalConst.sql_variables_batch_size ID
+        Attributes:
+            grouped_ids (list[str]): message group IDs
+        Returns:
+            set[str]: IDs of existing message groups
+        """
+
+        existing_ids = set()
+        for batch_start in range(0, len(grouped_ids), GlobalConst.sql_variables_batch_size):
+            stmt = select(DbMessageGroup.grouped_id).where(DbMessageGroup.grouped_id.in_(
+                grouped_ids[batch_start:batch_start + GlobalConst.sql_variables_batch_size]))
+            existing_ids.update(self.session.execute(stmt).scalars().all())
+        return existing_ids
+
     def add_tag_to_message_group(self, tag_name: str, message_group_id: str) -> tuple[str, str]:
         """
         Adds a tag to a specified group of messages
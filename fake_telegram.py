@@ -0,0 +1,298 @@
+"""
+The module contains the offline Telegram client backend used by the CLIENT_BACKEND=fake setting and by the tests.
+
+class FakeDialog: a class to represent a dialog of the offline Telegram client backend
+class FakeTelegramClient: a class to represent an offline Telegram client backend for working without Telegram
+"""
+
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable
+from telethon import utils as telethon_utils
+from telethon.errors import FloodWaitError
+from telethon.tl.custom import Message
+from telethon.tl.types import MessageMediaDocument, PeerChannel, PeerUser, User
+from configs.config import GlobalConst
+
+
+@dataclass
+class FakeDialog:  # pylint: disable=too-many-instance-attributes
+    """
+    A class to represent a dialog of the offline Telegram client backend with the attributes of a Telethon dialog
+    Класс, представляющий диалог автономного бэкенда клиента Telegram с атрибутами диалога Telethon
+    Attributes:
+        id (int): dialog ID
+        title (str): title of the dialog
+        name (str): name of the dialog
+        unread_count (int): number of unread messages
+        date (datetime | None): date of the last message
+        is_channel (bool): the dialog is a channel
+        is_group (bool): the dialog is a group
+        is_user (bool): the dialog is a private chat
+    """
+
+    id: int
+    title: str
+    name: str = ''
+    unread_count: int = 0
+    date: datetime | None = None
+    is_channel: bool = False
+    is_group: bool = False
+    is_user: bool = True
+
+    @property
+    def entity(self) -> 'FakeDialog':
+        """
+        Returns the entity of the dialog, which is the dialog itself
+        Возвращает сущность диалога, которой является сам диалог
+        """
+        return self
+
+
+@dataclass
+class FakeTelegramClient:  # pylint: disable=too-many-instance-attributes
+    """
+    A class to represent an offline Telegram client backend. It keeps dialogs and Telethon messages in memory and
+    implements the client methods used by the program, so the program can be run and checked without Telegram.
+    Класс, представляющий автономный бэкенд клиента Telegram. Хранит диалоги и сообщения Telethon в памяти и
+    реализует используемые программой методы клиента, так что программу можно запускать и проверять без Telegram.
+    Attributes:
+        session_name (str): name of the session
+        me_id (int): user ID of the account
+        dialogs (dict[int, FakeDialog]): dialogs by ID
+        messages (dict[int, dict[int, Message]]): messages of the dialogs by message ID
+        requests (Counter): number of calls of each client method
+        event_handlers (list[tuple[Callable, Any]]): registered event handlers and their events
+        flood_wait_rate (float): maximum rate of requests per second, a faster request raises a FloodWait error
+                                 as Telegram does; 0 if requests are not limited
+        flood_wait_seconds (int): waiting time of the raised FloodWait errors
+    """
+
+    session_name: str
+    me_id: int = 1
+    dialogs: dict[int, FakeDialog] = field(default_factory=dict)
+    messages: dict[int, dict[int, Message]] = field(default_factory=dict)
+    requests: Counter = field(default_factory=Counter)
+    event_handlers: list[tuple[Callable, Any]] = field(default_factory=list)
+    flood_wait_rate: float = 0
+    flood_wait_seconds: int = 1
+    _request_times: deque = field(default_factory=deque)
+    _blocked_until: float = 0.0
+
+    def add_dialog(self, dialog_id: int, title: str, **kwargs) -> FakeDialog:
+        """
+        Adds a dialog to the backend
+        Добавляет диалог в бэкенд
+        Attributes:
+            dialog_id (int): dialog ID
+            title (str): title of the dialog
+            kwargs: other attributes of FakeDialog
+        Returns:
+            FakeDialog: added dialog
+        """
+
+        dialog = FakeDialog(dialog_id, title, **kwargs)
+        self.dialogs[dialog_id] = dialog
+        self.messages.setdefault(dialog_id, {})
+        return dialog
+
+    def add_message(self, dialog_id: int, text: str = '', date: datetime | None = None, grouped_id: int | None = None,
+                    media: Any = None) -> Message:
+        """
+        Adds a message with the next ID to a dialog of the backend
+        Добавляет сообщение со следующим ID в диалог бэкенда
+        Attributes:
+            dialog_id (int): dialog ID
+            text (str): text of the message
+            date (datetime | None): date of the message, the current date if not specified
+            grouped_id (int | None): album ID of the message
+            media (Any): Telethon media of the message
+        Returns:
+            Message: added message
+        """
+
+        dialog_messages = self.messages.setdefault(dialog_id, {})
+        message = Message(id=next(reversed(dialog_messages), 0) + 1, peer_id=PeerChannel(abs(dialog_id)),
+                          date=date or datetime.now(timezone.utc), message=text, from_id=PeerUser(self.me_id),
+                          grouped_id=grouped_id, media=media)
+        # Without a client, the formatted text of a message is set explicitly
+        # Без клиента форматированный текст сообщения задается явно
+        message.text = text
+        dialog_messages[message.id] = message
+        if dialog_id in self.dialogs:
+            self.dialogs[dialog_id].date = message.date
+        return message
+
+    @staticmethod
+    def get_dialog_id(entity: Any) -> int:
+        """
+        Returns the dialog ID of an entity, which may be a dialog ID, a dialog or a Telethon peer
+        Возвращает ID диалога сущности, которой может быть ID диалога, диалог или пир Telethon
+        """
+
+        if isinstance(entity, int):
+            return entity
+        if isinstance(entity, FakeDialog):
+            return entity.id
+        return telethon_utils.get_peer_id(entity)
+
+    def count_request(self, method_name: str) -> None:
+        """
+        Counts a request and raises a FloodWait error if the requests of the last second exceed flood_wait_rate
+        or the previous FloodWait error has not ended
+        Учитывает запрос и вызывает ошибку FloodWait, если запросы последней секунды превышают flood_wait_rate
+        или предыдущая ошибка FloodWait не закончилась
+        Attributes:
+            method_name (str): name of the client method
+        """
+
+        self.requests[method_name] += 1
+        if not self.flood_wait_rate:
+            return
+        now = time.monotonic()
+        while self._request_times and self._request_times[0] <= now - 1:
+            self._request_times.popleft()
+        self._request_times.append(now)
+        if now < self._blocked_until or len(self._request_times) > self.flood_wait_rate:
+            self.requests['flood_wait'] += 1
+            self._blocked_until = max(self._blocked_until, now + self.flood_wait_seconds)
+            raise FloodWaitError(request=None, capture=self.flood_wait_seconds)
+
+    async def start(self, *_args, **_kwargs) -> 'FakeTelegramClient':
+        """
+        Starts the client, no connection is required
+        Запускает клиент, соединение не требуется
+        """
+        self.requests['start'] += 1
+        return self
+
+    async def disconnect(self) -> None:
+        """
+        Disconnects the client
+        Отключает клиент
+        """
+        self.requests['disconnect'] += 1
+
+    async def get_me(self) -> User:
+        """
+        Returns the user of the account
+        Возвращает пользователя аккаунта
+        """
+        self.count_request('get_me')
+        return User(id=self.me_id, is_self=True, first_name=self.session_name)
+
+    async def get_dialogs(self) -> list[FakeDialog]:
+        """
+        Returns the dialogs, the dialogs with the latest messages first
+        Возвращает диалоги, первыми диалоги с последними сообщениями
+        """
+
+        self.count_request('get_dialogs')
+        min_date = datetime.min.replace(tzinfo=timezone.utc)
+        return sorted(self.dialogs.values(), key=lambda dialog: dialog.date or min_date, reverse=True)
+
+    async def get_entity(self, entity: Any) -> FakeDialog:
+        """
+        Returns the dialog of an entity, raises ValueError as Telethon does if there is no such dialog
+        Возвращает диалог сущности, вызывает ValueError, как Telethon, если такого диалога нет
+        """
+
+        self.count_request('get_entity')
+        dialog_id = self.get_dialog_id(entity)
+        if dialog_id not in self.dialogs:
+            raise ValueError(f'Could not find the input entity for {dialog_id}')
+        return self.dialogs[dialog_id]
+
+    def filter_messages(self, entity: Any, limit: int | None = None, *,  # pylint: disable=too-many-arguments
+                        offset_date: datetime | None = None, offset_id: int = 0, min_id: int = 0, max_id: int = 0,
+                        reverse: bool = False, search: str | None = None) -> list[Message]:
+        """
+        Returns the messages of a dialog with the filters of Telethon: messages are returned from the newest
+        to the oldest, or in the reverse order; offset_date and offset_id limit them to older messages, or to newer
+        messages in the reverse order
+        Возвращает сообщения диалога с фильтрами Telethon: сообщения возвращаются от новых к старым или в обратном
+        порядке; offset_date и offset_id ограничивают их более старыми сообщениями или более новыми в обратном порядке
+        """
+
+        # Naive dates are local dates, as in Telethon / Наивные даты являются локальными датами, как в Telethon
+        if offset_date and offset_date.tzinfo is None:
+            offset_date = offset_date.astimezone()
+        dialog_messages = self.messages.get(self.get_dialog_id(entity), {})
+        filtered_messages: list[Message] = []
+        for message_id in sorted(dialog_messages, reverse=not reverse):
+            message = dialog_messages[message_id]
+            if message_id <= min_id or (max_id and message_id >= max_id):
+                continue
+            if offset_id and (message_id <= offset_id if reverse else message_id >= offset_id):
+                continue
+            if offset_date and (message.date < offset_date if reverse else message.date >= offset_date):
+                continue
+            if search and search.lower() not in (message.message or '').lower():
+                continue
+            if limit is not None and len(filtered_messages) >= limit:
+                break
+            filtered_messages.append(message)
+        return filtered_messages
+
+    async def iter_messages(self, *args, **kwargs) -> AsyncIterator[Message]:
+        """
+        Iterates over the messages of a dialog with the filters of filter_messages, a request is counted for each
+        page of GlobalConst.message_ids_batch_size messages
+        Итерация по сообщениям диалога с фильтрами filter_messages, запрос учитывается на каждую страницу из
+        GlobalConst.message_ids_batch_size сообщений
+        """
+
+        for message_number, message in enumerate(self.filter_messages(*args, **kwargs)):
+            if message_number % GlobalConst.message_ids_batch_size == 0:
+                self.count_request('iter_messages')
+            yield message
+
+    async def get_messages(self, entity: Any, *args, ids: int | list[int] | None = None,
+                           **kwargs) -> Message | None | list[Message | None]:
+        """
+        Returns messages by their IDs, None for not found ones, or a list of messages with the filters of
+        iter_messages
+        Возвращает сообщения по их ID, None для не найденных, или список сообщений с фильтрами iter_messages
+        """
+
+        self.count_request('get_messages')
+        if ids is None:
+            return self.filter_messages(entity, *args, **kwargs)
+        dialog_messages = self.messages.get(self.get_dialog_id(entity), {})
+        if isinstance(ids, int):
+            return dialog_messages.get(ids)
+        return [dialog_messages.get(message_id) for message_id in ids]
+
+    async def download_media(self, message: Message, file: Any = None, thumb: Any = None) -> str:
+        """
+        Writes zero bytes of the media size into the file
+        Записывает в файл нулевые байты размера медиа
+        """
+
+        self.count_request('download_media')
+        size = GlobalConst.download_chunk_size if thumb is None else GlobalConst.download_chunk_size // 8
+        if isinstance(message.media, MessageMediaDocument) and thumb is None:
+            size = message.media.document.size
+        Path(file).write_bytes(bytes(size))
+        return str(file)
+
+    async def iter_download(self, document: Any, offset: int = 0,
+                            request_size: int = GlobalConst.download_chunk_size) -> AsyncIterator[bytes]:
+        """
+        Iterates over chunks of zero bytes of the document size from the offset, a request is counted for each chunk
+        Итерация по частям из нулевых байтов размера документа начиная со смещения, запрос учитывается на каждую часть
+        """
+
+        for chunk_start in range(offset, document.size, request_size):
+            self.count_request('iter_download')
+            yield bytes(min(request_size, document.size - chunk_start))
+
+    def add_event_handler(self, callback: Callable, event: Any = None) -> None:
+        """
+        Registers an event handler, events are not generated by the backend
+        Регистрирует обработчик событий, бэкенд не генерирует события
+        """
+        self.event_handlers.append((callback, event))
@@ -149,6 +149,10 @@ function updateElementsFromResponse(data) {
             element.innerHTML = data[key];
         }
     });
+    // The new message list may not fill its window / Новый список сообщений может не заполнять свое окно
+    if ('tg_messages' in data) {
+        loadNextTgMessagesPage();
+    }
 }
 
 // Function that implements button press, with configuration of form elements and URL handler
@@ -307,6 +311,49 @@ setInterval(() => {
 }, 500);
 
 
+// Functions for infinite scrolling of the Telegram message list
+// Функции для бесконечной прокрутки списка сообщений Telegram
+
+let tgMessagesPageLoading = false;
+
+// Function to load the next page of the message list when its end approaches the visible area
+// Функция загрузки следующей страницы списка сообщений при приближении его конца к видимой области
+function loadNextTgMessagesPage() {
+    const container = document.getElementById('tg_messages');
+    const list = document.getElementById('tg-messages-list');
+    const marker = list ? list.querySelector('.tg-messages-more') : null;
+    if (!container || !marker || tgMessagesPageLoading) return;
+    if (container.scrollTop + 2 * container.clientHeight < container.scrollHeight) return;
+    tgMessagesPageLoading = true;
+    fetch(`${list.dataset.pageUrl}?cursor=${encodeURIComponent(marker.dataset.cursor)}`, {
+        method: 'GET',
+        headers: {
+            'X-Requested-With': 'XMLHttpRequest'
+        }
+    })
+        .then(r => r.json())
+        .then(data => {
+            // The marker is replaced by the page, which contains its own marker if there are more pages
+            // Маркер заменяется страницей, которая содержит собственный маркер, если есть еще страницы
+            marker.remove();
+            list.insertAdjacentHTML('beforeend', data['tg_messages_page']);
+            tgMessagesPageLoading = false;
+            loadNextTgMessagesPage();
+        })
+        .catch(err => {
+            console.error('Error loading messages:', err);
+            tgMessagesPageLoading = false;
+        });
+}
+
+// Scroll events do not bubble, so they are caught in the capture phase
+// События прокрутки не всплывают, поэтому перехватываются на фазе погружения
+document.addEventListener('scroll', event => {
+    if (event.target.id === 'tg_messages') {
+        loadNextTgMessagesPage();
+    }
+}, true);
+
 // Functions for working with Telegram message lists and databases
 // Функции для работы с Checkbox списков сообщений Telegram и базы данных
 
@@ -0,0 +1,449 @@
+"""
+The module contains classes and functions for working with a pool of Telegram client sessions.
+
+class TgClientPool: a class to represent a pool of Telegram client sessions with dialog affinity
+class TgRateLimiter: a class to represent a token bucket rate limiter of Telegram requests with adaptive backoff
+class TgRateLimitedClient: a class to represent a Telegram client whose requests pass through a rate limiter
+create_client_pool: a function for creating a pool of client sessions from the Telegram connection settings
+get_client_backend: a function for getting the Telegram client backend from the connection settings
+"""
+
+import time
+from asyncio import AbstractEventLoop, sleep
+from collections import Counter
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, AsyncIterator, Callable
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.tl.custom import Message
+from configs.config import GlobalConst
+from fake_telegram import FakeTelegramClient
+
+
+@dataclass
+class TgClientPool:
+    """
+    A class to represent a pool of Telegram client sessions of one account. Each dialog is assigned to one session,
+    the session with the fewest dialogs that is not waiting out a FloodWait error, so that scans and downloads of
+    different dialogs go through different connections and FloodWait limits. Sessions of one account share access
+    hashes, so entities and messages received by one session can be used by another one.
+    Класс, представляющий пул сессий клиента Telegram одного аккаунта. Каждый диалог закрепляется за одной
+    сессией, имеющей меньше всего диалогов и не ожидающей окончания ошибки FloodWait, так что просмотр и загрузки
+    разных диалогов идут через разные соединения и лимиты FloodWait. Сессии одного аккаунта имеют общие хэши
+    доступа, поэтому сущности и сообщения, полученные одной сессией, могут использоваться другой.
+    Attributes:
+        clients (list[Any]): clients of the sessions, the first one is the primary client
+        session_names (list[str]): names of the sessions
+    """
+
+    clients: list[Any]
+    session_names: list[str]
+    _dialog_clients: dict[int, int] = field(default_factory=dict)
+    _flood_wait_until: list[float] = field(default_factory=list)
+    _lock: Lock = field(default_factory=Lock)
+
+    def __post_init__(self):
+        """
+        Initializes the FloodWait deadlines of the sessions
+        Инициализирует сроки окончания FloodWait сессий
+        """
+        self._flood_wait_until = [0.0] * len(self.clients)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of sessions in the pool
+        Возвращает количество сессий в пуле
+        """
+        return len(self.clients)
+
+    @property
+    def primary(self) -> Any:
+        """
+        Returns the primary client, which receives dialogs, entities and events
+        Возвращает основной клиент, который получает диалоги, сущности и события
+        """
+        return self.clients[0]
+
+    async def start(self, phone: str | None, password: str | None) -> None:
+        """
+        Starting the clients of all sessions in the event loop thread
+        Запуск клиентов всех сессий в потоке цикла событий
+        Attributes:
+            phone (str | None): phone number of the account
+            password (str | None): two-step verification password of the account
+        """
+
+        for client in self.clients:
+            await client.start(phone, password)
+
+    async def disconnect(self) -> None:
+        """
+        Disconnecting the clients of all sessions
+        Отключение клиентов всех сессий
+        """
+
+        for client in self.clients:
+            await client.disconnect()
+
+    def get_client(self, dialog_id: int) -> Any:
+        """
+        Returns the client of the session assigned to the dialog. A dialog is assigned on the first request and
+        is moved to another session only if its session is waiting out a FloodWait error and another one is free.
+        Возвращает клиент сессии, закрепленной за диалогом. Диалог закрепляется при первом запросе и переходит к
+        другой сессии, только если его сессия ожидает окончания ошибки FloodWait, а другая свободна.
+        Attributes:
+            dialog_id (int): dialog ID
+        Returns:
+            Any: Telegram client
+        """
+
+        with self._lock:
+            index = self._dialog_clients.get(dialog_id)
+            if index is None or self._flood_wait_until[index] > time.monotonic():
+                index = self._select_client(index)
+                self._dialog_clients[dialog_id] = index
+            return self.clients[index]
+
+    def report_flood_wait(self, dialog_id: int, seconds: int) -> bool:
+        """
+        Registers a FloodWait error received by the session of the dialog and moves the dialog to a free session
+        Регистрирует ошибку FloodWait, полученную сессией диалога, и переводит диалог в свободную сессию
+        Attributes:
+            dialog_id (int): dialog ID
+            seconds (int): waiting time of the FloodWait error
+        Returns:
+            bool: True if the dialog has been moved to another session
+        """
+
+        with self._lock:
+            index = self._dialog_clients.get(dialog_id, 0)
+            self._flood_wait_until[index] = max(self._flood_wait_until[index], time.monotonic() + seconds)
+            new_index = self._select_client(index)
+            self._dialog_clients[dialog_id] = new_index
+            return new_index != index
+
+    def _select_client(self, current_index: int | None) -> int:
+        """
+        Selects the session with the fewest dialogs among the sessions that are not waiting out a FloodWait error.
+        If all sessions are waiting, the current session is kept, or the one that is released first is selected.
+        Выбирает сессию с наименьшим числом диалогов среди сессий, не ожидающих окончания ошибки FloodWait.
+        Если ожидают все сессии, сохраняется текущая сессия, или выбирается та, что освободится первой.
+        """
+
+        now = time.monotonic()
+        free_indexes = [index for index, until in enumerate(self._flood_wait_until) if until <= now]
+        if not free_indexes:
+            if current_index is not None:
+                return current_index
+            return min(range(len(self.clients)), key=lambda index: self._flood_wait_until[index])
+        dialog_counts = Counter(self._dialog_clients.values())
+        return min(free_indexes, key=lambda index: (dialog_counts[index], index))
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns statistics of the pool: the number of dialogs of each session and the remaining FloodWait time
+        Возвращает статистику пула: количество диалогов каждой сессии и оставшееся время FloodWait
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            dialog_counts = Counter(self._dialog_clients.values())
+            return {'sessions': [{'session_name': session_name,
+                                  'dialogs': dialog_counts[index],
+                                  'flood_wait': max(0, round(self._flood_wait_until[index] - now)),
+                                  'rate_limiter': client.limiter.stats if hasattr(client, 'limiter') else None}
+                                 for index, (session_name, client) in enumerate(zip(self.session_names,
+                                                                                    self.clients))]}
+
+
+@dataclass
+class TgRateLimiter:  # pylint: disable=too-many-instance-attributes
+    """
+    A class to represent a token bucket rate limiter of the requests of one Telegram client session with adaptive
+    backoff. Tokens are added at the current rate up to GlobalConst.rate_limit_burst, each request takes a token.
+    A FloodWait error reduces the current rate by GlobalConst.rate_limit_backoff_factor and stops requests until
+    the end of the wait, each successful request restores GlobalConst.rate_limit_recovery_step of the maximum rate.
+    All methods must be called in the Telegram client event loop.
+    Класс, представляющий ограничитель частоты запросов одной сессии клиента Telegram по алгоритму корзины
+    токенов с адаптивным снижением частоты. Токены добавляются с текущей частотой до GlobalConst.rate_limit_burst,
+    каждый запрос забирает токен. Ошибка FloodWait снижает текущую частоту в GlobalConst.rate_limit_backoff_factor
+    раз и останавливает запросы до конца ожидания, каждый успешный запрос восстанавливает
+    GlobalConst.rate_limit_recovery_step от максимальной частоты. Все методы должны вызываться в цикле событий
+    клиента Telegram.
+    Attributes:
+        max_rate (float): maximum rate of requests, requests per second
+        burst (int): maximum number of tokens
+        rate (float): current rate of requests, requests per second
+        requests (int): number of requests
+        throttled (int): number of requests that waited for a token
+        wait_time (float): total time of waiting for tokens, in seconds
+        flood_waits (int): number of FloodWait errors
+        flood_wait_time (int): total time of FloodWait errors, in seconds
+    """
+
+    max_rate: float = GlobalConst.rate_limit_requests
+    burst: int = GlobalConst.rate_limit_burst
+    rate: float = GlobalConst.rate_limit_requests
+    requests: int = 0
+    throttled: int = 0
+    wait_time: float = 0.0
+    flood_waits: int = 0
+    flood_wait_time: int = 0
+    _tokens: float = GlobalConst.rate_limit_burst
+    _updated: float = field(default_factory=time.monotonic)
+    _blocked_until: float = 0.0
+
+    async def acquire(self) -> None:
+        """
+        Waits for a token for one request
+        Ожидает токен для одного запроса
+        """
+
+        self.requests += 1
+        waited = False
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now >= self._blocked_until and self._tokens >= 1:
+                self._tokens -= 1
+                return
+            # Waiting for the end of the FloodWait error or for the next token
+            # Ожидание конца ошибки FloodWait или следующего токена
+            delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            if not waited:
+                self.throttled += 1
+                waited = True
+            self.wait_time += delay
+            await sleep(delay)
+
+    def on_success(self) -> None:
+        """
+        Restores a part of the maximum rate after a successful request
+        Восстанавливает часть максимальной частоты после успешного запроса
+        """
+        self.rate = min(self.max_rate, self.rate + self.max_rate * GlobalConst.rate_limit_recovery_step)
+
+    def on_flood_wait(self, seconds: int) -> None:
+        """
+        Reduces the rate and stops requests until the end of a FloodWait error
+        Снижает частоту и останавливает запросы до конца ошибки FloodWait
+        Attributes:
+            seconds (int): waiting time of the FloodWait error
+        """
+
+        self.flood_waits += 1
+        self.flood_wait_time += seconds
+        self.rate = max(GlobalConst.rate_limit_min_requests, self.rate * GlobalConst.rate_limit_backoff_factor)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns statistics of the rate limiter
+        Возвращает статистику ограничителя частоты
+        """
+        return {'rate': round(self.rate, 2), 'requests': self.requests, 'throttled': self.throttled,
+                'wait_time': round(self.wait_time, 2), 'flood_waits': self.flood_waits,
+                'flood_wait_time': self.flood_wait_time}
+
+
+class TgRateLimitedClient:
+    """
+    A class to represent a Telegram client whose requests pass through a rate limiter. FloodWait errors up to
+    GlobalConst.flood_sleep_threshold seconds are waited out and the request is repeated, iterators continue from
+    the last received message or chunk. Longer errors are raised to let the caller pass the work to another session.
+    Iterators take a token for each page of messages or each chunk of a file. Other attributes are taken from the
+    wrapped client.
+    Класс, представляющий клиент Telegram, запросы которого проходят через ограничитель частоты. Ошибки FloodWait
+    до GlobalConst.flood_sleep_threshold секунд пережидаются, и запрос повторяется, итераторы продолжают с последнего
+    полученного сообщения или части. Более длительные ошибки передаются вызывающему коду, чтобы он мог передать
+    работу другой сессии. Итераторы забирают токен на каждую страницу сообщений или каждую часть файла. Остальные
+    атрибуты берутся у обернутого клиента.
+    Attributes:
+        client (Any): wrapped Telegram client
+        limiter (TgRateLimiter): rate limiter of the client requests
+    """
+
+    def __init__(self, client: Any, limiter: TgRateLimiter | None = None):
+        """
+        Initializes the rate limited client
+        Инициализирует клиент с ограничением частоты запросов
+        Attributes:
+            client (Any): wrapped Telegram client
+            limiter (TgRateLimiter | None): rate limiter, a new one if not specified
+        """
+
+        self.client = client
+        self.limiter = limiter or TgRateLimiter()
+
+    def __getattr__(self, name: str) -> Any:
+        """
+        Returns the attributes of the wrapped client that are not limited
+        Возвращает не ограничиваемые атрибуты обернутого клиента
+        """
+        return getattr(self.client, name)
+
+    async def request(self, method: Callable, *args, **kwargs) -> Any:
+        """
+        Performs a request of the wrapped client through the rate limiter
+        Выполняет запрос обернутого клиента через ограничитель частоты
+        Attributes:
+            method (Callable): coroutine method of the wrapped client
+            args, kwargs: arguments of the method
+        Returns:
+            Any: result of the request
+        """
+
+        for attempt in range(GlobalConst.flood_wait_max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                result = await method(*args, **kwargs)
+            except FloodWaitError as error:
+                self.limiter.on_flood_wait(error.seconds)
+                if attempt == GlobalConst.flood_wait_max_retries or error.seconds > GlobalConst.flood_sleep_threshold:
+                    raise
+                continue
+            self.limiter.on_success()
+            return result
+        return None
+
+    async def get_me(self, *args, **kwargs) -> Any:
+        """
+        Rate limited get_me of the wrapped client / get_me обернутого клиента с ограничением частоты
+        """
+        return await self.request(self.client.get_me, *args, **kwargs)
+
+    async def get_dialogs(self, *args, **kwargs) -> Any:
+        """
+        Rate limited get_dialogs of the wrapped client / get_dialogs обернутого клиента с ограничением частоты
+        """
+        return await self.request(self.client.get_dialogs, *args, **kwargs)
+
+    async def get_entity(self, *args, **kwargs) -> Any:
+        """
+        Rate limited get_entity of the wrapped client / get_entity обернутого клиента с ограничением частоты
+        """
+        return await self.request(self.client.get_entity, *args, **kwargs)
+
+    async def get_messages(self, *args, **kwargs) -> Any:
+        """
+        Rate limited get_messages of the wrapped client / get_messages обернутого клиента с ограничением частоты
+        """
+        return await self.request(self.client.get_messages, *args, **kwargs)
+
+    async def download_media(self, *args, **kwargs) -> Any:
+        """
+        Rate limited download_media of the wrapped client / download_media обернутого клиента с ограничением частоты
+        """
+        return await self.request(self.client.download_media, *args, **kwargs)
+
+    async def iter_messages(self, *args, **kwargs) -> AsyncIterator[Message]:
+        """
+        Iterating over messages of the wrapped client, a token is taken for each page of
+        GlobalConst.message_ids_batch_size messages requested by Telethon. After a FloodWait error the iteration
+        continues from the last received message, the limit must be passed as a keyword argument.
+        Итерация по сообщениям обернутого клиента, токен забирается на каждую страницу из
+        GlobalConst.message_ids_batch_size сообщений, запрашиваемую Telethon. После ошибки FloodWait итерация
+        продолжается с последнего полученного сообщения, ограничение количества передается именованным аргументом.
+        """
+
+        message_count = 0
+        for attempt in range(GlobalConst.flood_wait_max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                async for message in self.client.iter_messages(*args, **kwargs):
+                    message_count += 1
+                    if message_count % GlobalConst.message_ids_batch_size == 0:
+                        self.limiter.on_success()
+                        await self.limiter.acquire()
+                    # Messages older (newer in the reverse order) than offset_id follow the received ones
+                    # Сообщения старше (новее в обратном порядке) offset_id следуют за полученными
+                    kwargs['offset_id'] = message.id
+                    if kwargs.get('limit'):
+                        kwargs['limit'] -= 1
+                    yield message
+            except FloodWaitError as error:
+                self.limiter.on_flood_wait(error.seconds)
+                if attempt == GlobalConst.flood_wait_max_retries or error.seconds > GlobalConst.flood_sleep_threshold:
+                    raise
+                continue
+            self.limiter.on_success()
+            return
+
+    async def iter_download(self, *args, **kwargs) -> AsyncIterator[bytes]:
+        """
+        Iterating over file chunks of the wrapped client, a token is taken for each chunk. After a FloodWait error
+        the download continues from the last received chunk, the offset must be passed as a keyword argument.
+        Итерация по частям файла обернутого клиента, токен забирается на каждую часть. После ошибки FloodWait
+        загрузка продолжается с последней полученной части, смещение передается именованным аргументом.
+        """
+
+        for attempt in range(GlobalConst.flood_wait_max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                async for chunk in self.client.iter_download(*args, **kwargs):
+                    self.limiter.on_success()
+                    kwargs['offset'] = kwargs.get('offset', 0) + len(chunk)
+                    yield chunk
+                    await self.limiter.acquire()
+            except FloodWaitError as error:
+                self.limiter.on_flood_wait(error.seconds)
+                if attempt == GlobalConst.flood_wait_max_retries or error.seconds > GlobalConst.flood_sleep_threshold:
+                    raise
+                continue
+            return
+
+
+def create_client_pool(connection_settings: dict, loop: AbstractEventLoop) -> TgClientPool:
+    """
+    Creating a pool of client sessions from the Telegram connection settings. The pool contains the SESSION_NAME
+    session and the sessions listed in POOL_SESSION_NAMES. The CLIENT_BACKEND setting selects the Telethon client
+    ("telethon", by default) or the offline backend of the tests ("fake").
+    Создание пула сессий клиента из настроек подключения к Telegram. Пул содержит сессию SESSION_NAME и сессии,
+    перечисленные в POOL_SESSION_NAMES. Настройка CLIENT_BACKEND выбирает клиент Telethon ("telethon", по умолчанию)
+    или автономный бэкенд тестов ("fake").
+    Attributes:
+        connection_settings (dict): Telegram connection settings
+        loop (AbstractEventLoop): event loop of the Telegram clients
+    Returns:
+        TgClientPool: pool of client sessions
+    """
+
+    session_names = [connection_settings['SESSION_NAME']] + [
+        session_name.strip() for session_name in (connection_settings.get('POOL_SESSION_NAMES') or '').split(',')
+        if session_name.strip()]
+    backend = get_client_backend(connection_settings)
+    match backend:
+        case 'telethon':
+            # FloodWait errors are waited out by the rate limiters instead of Telethon
+            # Ошибки FloodWait пережидаются ограничителями частоты вместо Telethon
+            clients: list[Any] = [TelegramClient(session_name, int(connection_settings['API_ID']),
+                                                 connection_settings['API_HASH'], loop=loop, flood_sleep_threshold=0)
+                                  for session_name in session_names]
+        case 'fake':
+            # The sessions of one account share the dialogs and messages / Сессии одного аккаунта имеют общие диалоги
+            primary_client = FakeTelegramClient(session_names[0])
+            clients = [primary_client] + [FakeTelegramClient(session_name, dialogs=primary_client.dialogs,
+                                                             messages=primary_client.messages)
+                                          for session_name in session_names[1:]]
+        case _:
+            raise ValueError(f'Unknown Telegram client backend: {backend}')
+    # Requests of each session pass through its own rate limiter
+    # Запросы каждой сессии проходят через собственный ограничитель частоты
+    return TgClientPool([TgRateLimitedClient(client) for client in clients], session_names)
+
+
+def get_client_backend(connection_settings: dict) -> str:
+    """
+    Getting the Telegram client backend from the CLIENT_BACKEND connection setting
+    Получение бэкенда клиента Telegram из настройки подключения CLIENT_BACKEND
+    Attributes:
+        connection_settings (dict): Telegram connection settings
+    Returns:
+        str: "telethon" or "fake"
+    """
+    return (connection_settings.get('CLIENT_BACKEND') or 'telethon').strip().lower()
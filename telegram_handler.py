@@ -4,33 +4,67 @@ The module contains model classes, functions, and constants for working with an
 class TelegramHandler: a class for handling Telegram operations.
 class TgCurrentState: a class to represent the current state of the Telegram client
 class TgDialog: a class to represent a Telegram dialog in this program
+class TgEntityCache: a class to represent an LRU cache of Telegram entities with a time to live
+class TgDateBoundaryCache: a class to represent a cache of message ID boundaries for dates in Telegram dialogs
+class TgDownloadQueue: a class to represent a priority queue of message files for downloading
+class TgMediaStore: a class to represent a content-addressed store of media shared by the message files of all chats
+class TgMessageGroupCache: a class to represent a cache of message group lists of Telegram dialogs
+class TgLiveArchiver: a class to represent a live archiver of new messages of Telegram dialogs
+class TgArchiveJob: a class to represent a job of archiving the messages of a Telegram dialog in a date range
 class TgDialogSortFilter: a class to represent sorting and filtering options of Telegram dialogs
 class TgFile: a class to represent a Telegram message file
 class TgMessageGroup: a class to represent a Telegram message group in this program
 class TgMessageSortFilter: a class to represent sorting and filtering of Telegram message groups.
 tg_handler: an object of the TelegramHandler class for working with the Telegram
 loop: the asyncio event loop for working with the Telegram client
-convert_text_hyperlinks: a function for converting text hyperlinks in Markdown format [Text](URL) to HTML format
-cleanup_loop: a function called at application exit to close the event loop if it is open
+loop_thread: the thread in which the event loop of the Telegram client runs
+get_inline_preview: a function for getting an inline preview of an image from the bytes contained in a message
+estimate_message_groups_size: a function for estimating the memory size of message groups
+check_downloaded_file: a function for checking the size of a downloaded partial file
+get_file_hash: a function for calculating the SHA-256 hash of the content of a file
+input_peer_to_record: a function for converting a Telegram entity to an input peer record for the storage
+input_peer_from_record: a function for restoring a Telegram input peer from a record of the storage
+message_group_to_record: a function for converting a message group to a record for the storage
+message_group_from_record: a function for restoring a message group from a record of the storage
+submit: a function for submitting a coroutine to the Telegram client event loop thread from any thread
+run_sync: a function for running a coroutine in the Telegram client event loop thread and waiting for its result
+iterate_async: a function for synchronous iteration over an asynchronous iterator in the Telegram client event loop
+run_loop: a function that runs the event loop of the Telegram client in its own thread
+cancel_tasks: a function for cancelling the background tasks of the event loop of the Telegram client
+cleanup_loop: a function called at application exit to stop the event loop thread and close the event loop
 """
 
 import atexit
-from asyncio import new_event_loop, set_event_loop
-from collections import Counter
+from base64 import b64encode
+import time
+from threading import Event as ThreadingEvent, Lock, Thread
+from asyncio import Event, Future as AsyncioFuture, all_tasks, current_task, gather, new_event_loop, \
+    run_coroutine_threadsafe, set_event_loop, sleep, to_thread
+from concurrent.futures import Future
+from array import array
+from hashlib import sha256
+from os import link
+from shutil import copyfile
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, deque
+from heapq import heappop, heappush
+from itertools import count
 from mimetypes import guess_extension
-from sys import maxsize
+from sys import getsizeof, maxsize
 from textwrap import shorten
-from dataclasses import dataclass
-from typing import Any, Callable, cast
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Callable, Coroutine, Iterable, Iterator, cast
 from datetime import datetime, timedelta
 from pathlib import Path
 from telethon.tl.custom import Dialog, Message
 from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument, PhotoSize, PhotoCachedSize, PhotoStrippedSize, \
-    PhotoSizeProgressive, MessageMediaWebPage
-from telethon import TelegramClient
+    PhotoSizeProgressive, MessageMediaWebPage, InputPeerUser, InputPeerChat, InputPeerChannel, InputPeerSelf
+from telethon import events, utils as telethon_utils
+from telethon.errors import FloodWaitError, RPCError
 from dotenv import dotenv_values
 from configs.config import ProjectDirs, GlobalConst, MessageFileTypes, DialogTypes
-from utils import parse_date_string, clean_file_path, status_messages
+from utils import parse_date_string, clean_file_path, convert_text_hyperlinks, status_messages
+from telegram_client_pool import TgClientPool, create_client_pool, get_client_backend
 
 
 @dataclass
@@ -202,15 +236,16 @@ class TgDialogSortFilter:
         return result
 
 
-@dataclass
+@dataclass(slots=True)
 class TgFile:  # pylint: disable=too-many-instance-attributes
     """
-    A class to represent a Telegram message file.
-    Класс, представляющий файл сообщения Telegram.
+    A class to represent a Telegram message file. The Telegram message is not kept, it is requested by the message ID
+    when the file is downloaded.
+    Класс, представляющий файл сообщения Telegram. Сообщение Telegram не хранится, оно запрашивается по ID сообщения
+    при загрузке файла.
     Attributes:
         dialog_id (int): dialog ID
         message_grouped_id (str): message group ID
-        message (Message): Telegram message object
         message_id (int): message ID
         description (str): description of the reference message
         file_name (str): file name
@@ -218,11 +253,14 @@ class TgFile:  # pylint: disable=too-many-instance-attributes
         alt_text (str): alternate text for media file
         size (int): size of file
         file_type (MessageFileTypes): file type
+        preview (str): blurred inline preview of an image as a data URI, or empty string
+        resumable (bool): the file is a document that can be downloaded in chunks and resumed
+        media_id (str): ID of the Telegram photo or document of the file, the same in all chats it is forwarded to,
+                        or empty string
     """
 
     dialog_id: int
     message_grouped_id: str
-    message: Message
     message_id: int
     description: str
     file_name: str
@@ -230,6 +268,9 @@ class TgFile:  # pylint: disable=too-many-instance-attributes
     alt_text: str
     size: int
     file_type: MessageFileTypes = MessageFileTypes.UNKNOWN
+    preview: str = ''
+    resumable: bool = False
+    media_id: str = ''
 
     def is_exists(self) -> bool:
         """
@@ -238,6 +279,49 @@ class TgFile:  # pylint: disable=too-many-instance-attributes
         """
         return (Path(ProjectDirs.media_dir) / self.file_path).exists() if self.file_path else False
 
+    def is_resumable(self) -> bool:
+        """
+        Checks whether the file is a document that can be downloaded in chunks and resumed
+        Проверяет, является ли файл документом, который можно загружать частями с продолжением
+        """
+        return self.resumable
+
+    @staticmethod
+    def is_resumable_media(media: Any, file_type: MessageFileTypes) -> bool:
+        """
+        Checks whether the media of a message is a document that can be downloaded in chunks and resumed
+        Проверяет, является ли медиа сообщения документом, который можно загружать частями с продолжением
+        Attributes:
+            media (Any): media of a Telegram message
+            file_type (MessageFileTypes): file type
+        Returns:
+            bool: True if the media can be downloaded in chunks
+        """
+        return isinstance(media, MessageMediaDocument) and file_type != MessageFileTypes.THUMBNAIL
+
+    @staticmethod
+    def get_media_id(media: Any, file_type: MessageFileTypes) -> str:
+        """
+        Returns the ID of the Telegram photo or document of the media of a message. Telegram keeps a forwarded photo
+        or document under the same ID, so the ID identifies the content of the file in all chats.
+        Возвращает ID фотографии или документа Telegram медиа сообщения. Telegram хранит пересланную фотографию или
+        документ под тем же ID, поэтому ID определяет содержимое файла во всех диалогах.
+        Attributes:
+            media (Any): media of a Telegram message
+            file_type (MessageFileTypes): file type
+        Returns:
+            str: media ID, or empty string if the media has no photo or document
+        """
+
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            return f'photo_{media.photo.id}'
+        if isinstance(media, MessageMediaWebPage) and getattr(media.webpage, 'photo', None):
+            return f'photo_{media.webpage.photo.id}'
+        if isinstance(media, MessageMediaDocument) and media.document:
+            # The thumbnail of a document is a separate file / Миниатюра документа является отдельным файлом
+            return f'{"thumb" if file_type == MessageFileTypes.THUMBNAIL else "document"}_{media.document.id}'
+        return ''
+
     @staticmethod
     def get_self_file_name(date: datetime, file_type: MessageFileTypes, message_grouped_id: str,
                            message_id: int, file_ext: str) -> str:
@@ -259,7 +343,7 @@ class TgFile:  # pylint: disable=too-many-instance-attributes
         return clean_file_path(file_name) or file_name
 
 
-@dataclass
+@dataclass(slots=True)
 class TgMessageGroup:  # pylint: disable=too-many-instance-attributes
     """
     A class representing a group of Telegram messages with a single grouped_id
@@ -272,9 +356,10 @@ class TgMessageGroup:  # pylint: disable=too-many-instance-attributes
         date (datetime | None): date of message group
         text (str): text of message group
         truncated_text (str): truncated text of message group for HTML templates
-        from_id (int | None): message sender ID
+        from_id (int | None): message sender peer ID
         files_report (str | None): summary of message group files
-        saved_to_db (bool): database saving status
+        saved_to_db (bool | None): database saving status, None if it has not been checked yet
+        text_converted (bool): the text hyperlinks have been converted to HTML format
     """
 
     grouped_id: str
@@ -286,7 +371,8 @@ class TgMessageGroup:  # pylint: disable=too-many-instance-attributes
     truncated_text: str = ''
     from_id: int | None = None
     files_report: str | None = ''
-    saved_to_db: bool = False
+    saved_to_db: bool | None = None
+    text_converted: bool = False
 
     def __init__(self, grouped_id: str, dialog_id: int):
         """
@@ -301,6 +387,15 @@ class TgMessageGroup:  # pylint: disable=too-many-instance-attributes
         self.dialog_id = dialog_id
         self.ids = []
         self.files = []
+        # Slotted instances have no class defaults for the other fields
+        # У экземпляров со слотами нет значений по умолчанию в классе для остальных полей
+        self.date = None
+        self.text = ''
+        self.truncated_text = ''
+        self.from_id = None
+        self.files_report = ''
+        self.saved_to_db = None
+        self.text_converted = False
 
     def add_message(self, message: Message) -> None:
         """
@@ -309,7 +404,8 @@ class TgMessageGroup:  # pylint: disable=too-many-instance-attributes
         Attributes:
             message (Message): added message
         """
-        self.from_id = message.from_id if self.from_id is None else self.from_id
+        if self.from_id is None and message.from_id:
+            self.from_id = telethon_utils.get_peer_id(message.from_id)
         self.date = message.date.astimezone() if self.date is None else min(self.date, message.date.astimezone())
         self.ids.append(message.id)
         if message.text:
@@ -349,8 +445,9 @@ class TgMessageGroup:  # pylint: disable=too-many-instance-attributes
         Converting text hyperlinks of the form [Text](URL) to HTML format
         Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат
         """
-        if self.text:
+        if self.text and not self.text_converted:
             self.text = convert_text_hyperlinks(self.text) or ''
+        self.text_converted = True
 
     def set_truncated_text(self) -> None:
         """
@@ -441,6 +538,14 @@ class TgMessageSortFilter:
         """
         self._sort_order = value == '0'  # True if value == '0' else False
 
+    @property
+    def filter_key(self) -> tuple:
+        """
+        Returns the filter values that define the set of received message groups, regardless of sorting
+        Возвращает значения фильтров, определяющие набор получаемых групп сообщений, независимо от сортировки
+        """
+        return self._date_from, self._date_to, self._message_query
+
     @property
     def date_from(self) -> datetime | None:
         """
@@ -516,14 +621,859 @@ class TgCurrentState:
         dialog_list (list[TgDialog] | None): current dialog list
         selected_dialog_id (int | None): selected dialog ID
         message_group_list (list[TgMessageGroup] | None): current message group list
+        message_group_index (dict[str, TgMessageGroup]): current message groups indexed by grouped_id
+        message_group_positions (dict[str, int]): positions of the current message groups in the list by grouped_id
         message_details (dict[str, Any] | None): selected message details
     """
 
     dialog_list: list[TgDialog] | None = None
     selected_dialog_id: int | None = None
     message_group_list: list[TgMessageGroup] | None = None
+    message_group_index: dict[str, TgMessageGroup] = field(default_factory=dict)
+    message_group_positions: dict[str, int] = field(default_factory=dict)
     message_details: dict[str, Any] | None = None
 
+    def set_message_group_list(self, message_group_list: list[TgMessageGroup]) -> None:
+        """
+        Sets the current message group list and rebuilds its index by grouped_id
+        Устанавливает текущий список групп сообщений и перестраивает его индекс по grouped_id
+        Attributes:
+            message_group_list (list[TgMessageGroup]): new message group list
+        """
+
+        self.message_group_list = message_group_list
+        self.message_group_index = {message_group.grouped_id: message_group for message_group in message_group_list}
+        self.message_group_positions = {message_group.grouped_id: position
+                                        for position, message_group in enumerate(message_group_list)}
+
+    def get_message_group_page(self, cursor: str | None = None) -> tuple[list[TgMessageGroup], str | None]:
+        """
+        Returns a page of GlobalConst.message_page_size message groups of the current list following the group
+        with the cursor grouped_id, or the first page if the cursor is not specified
+        Возвращает страницу из GlobalConst.message_page_size групп сообщений текущего списка, следующих за группой
+        с grouped_id курсора, или первую страницу, если курсор не задан
+        Attributes:
+            cursor (str | None): grouped_id of the last message group of the previous page
+        Returns:
+            tuple[list[TgMessageGroup], str | None]: message groups of the page and the cursor of the next page,
+                                                     None if it is the last page
+        """
+
+        if not self.message_group_list:
+            return [], None
+        if cursor is None:
+            start = 0
+        elif cursor in self.message_group_positions:
+            start = self.message_group_positions[cursor] + 1
+        else:
+            # The list has changed since the previous page / Список изменился после предыдущей страницы
+            return [], None
+        page = self.message_group_list[start:start + GlobalConst.message_page_size]
+        next_cursor = page[-1].grouped_id if page and start + len(page) < len(self.message_group_list) else None
+        return page, next_cursor
+
+
+@dataclass
+class TgEntityCache:
+    """
+    LRU cache of Telegram entities by their ID with a time to live of records. The cache is used both by request
+    threads and by the Telegram client event loop thread, so its records are changed under a lock.
+    LRU кэш сущностей Telegram по их ID с временем жизни записей. Кэш используется и потоками запросов, и потоком
+    цикла событий клиента Telegram, поэтому его записи изменяются под блокировкой.
+    Attributes:
+        max_size (int): maximum number of cached entities
+        ttl (int): time to live of a cached entity in seconds
+        hits (int): number of cache hits
+        misses (int): number of cache misses
+        storage_hits (int): number of entities restored from the persistent storage
+    """
+
+    max_size: int = GlobalConst.entity_cache_size
+    ttl: int = GlobalConst.entity_cache_ttl
+    hits: int = 0
+    misses: int = 0
+    storage_hits: int = 0
+    _entities: OrderedDict = field(default_factory=OrderedDict)
+    _lock: Lock = field(default_factory=Lock)
+
+    def get(self, entity_id: int) -> Any | None:
+        """
+        Returns a cached entity by its ID, or None if it is missing or expired
+        Возвращает кэшированную сущность по ее ID или None, если она отсутствует или устарела
+        Attributes:
+            entity_id (int): entity ID
+        Returns:
+            Any | None: Telegram entity
+        """
+
+        with self._lock:
+            cached = self._entities.get(entity_id)
+            if cached is None or time.monotonic() - cached[0] > self.ttl:
+                self._entities.pop(entity_id, None)
+                self.misses += 1
+                return None
+            # Mark the entity as recently used / Отмечаем сущность как недавно использованную
+            self._entities.move_to_end(entity_id)
+            self.hits += 1
+            return cached[1]
+
+    def put(self, entity_id: int, entity: Any, from_storage: bool = False) -> None:
+        """
+        Adds an entity to the cache, evicting the least recently used one if the cache is full
+        Добавляет сущность в кэш, вытесняя давно не использованную, если кэш заполнен
+        Attributes:
+            entity_id (int): entity ID
+            entity (Any): Telegram entity
+            from_storage (bool): the entity was restored from the persistent storage
+        """
+
+        with self._lock:
+            if from_storage:
+                self.storage_hits += 1
+            self._entities[entity_id] = (time.monotonic(), entity)
+            self._entities.move_to_end(entity_id)
+            while len(self._entities) > self.max_size:
+                self._entities.popitem(last=False)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Returns cache usage counters
+        Возвращает счетчики использования кэша
+        """
+        with self._lock:
+            return {'size': len(self._entities), 'hits': self.hits, 'misses': self.misses,
+                    'storage_hits': self.storage_hits}
+
+
+@dataclass
+class TgDateBoundaryCache:
+    """
+    Cache of message ID boundaries for dates in Telegram dialogs. It contains the results of previous boundary
+    requests and per-dialog sorted anchors (date, message ID) of contiguous ranges of already received messages.
+    The ranges of a dialog are kept sorted by message ID, no more than max_anchors anchors per dialog. The cache is
+    used by request threads and archive jobs, so it is changed under a lock.
+    Кэш границ ID сообщений для дат в диалогах Telegram. Содержит результаты предыдущих запросов границ и
+    отсортированные по диалогам опорные точки (дата, ID сообщения) непрерывных диапазонов уже полученных сообщений.
+    Диапазоны диалога хранятся отсортированными по ID сообщений, не более max_anchors опорных точек на диалог. Кэш
+    используется потоками запросов и заданиями архивации, поэтому изменяется под блокировкой.
+    Attributes:
+        max_dialogs (int): maximum number of dialogs with cached boundaries
+        max_anchors (int): maximum number of anchors of one dialog
+        hits (int): number of boundaries resolved locally
+        misses (int): number of boundaries that had to be requested from Telegram
+    """
+
+    max_dialogs: int = GlobalConst.date_boundary_cache_dialogs
+    max_anchors: int = GlobalConst.date_boundary_cache_anchors
+    hits: int = 0
+    misses: int = 0
+    _boundaries: OrderedDict = field(default_factory=OrderedDict)
+    _segments: OrderedDict = field(default_factory=OrderedDict)
+    _lock: Lock = field(default_factory=Lock)
+
+    def get_boundary(self, dialog_id: int, date: datetime, reverse: bool) -> int | None:
+        """
+        Returns the boundary message ID for a date: the last message before the date, or if reverse is True, the
+        first message from the date. Returns None if the boundary cannot be resolved locally.
+        Возвращает ID граничного сообщения для даты: последнего сообщения до даты, или, если reverse равен True,
+        первого сообщения начиная с даты. Возвращает None, если границу нельзя определить локально.
+        Attributes:
+            dialog_id (int): dialog ID
+            date (datetime): boundary date
+            reverse (bool): search direction
+        Returns:
+            int | None: boundary message ID, 0 if there is no such message
+        """
+
+        timestamp = int(date.timestamp())
+        with self._lock:
+            boundary = self._boundaries.get((dialog_id, timestamp, reverse))
+            if boundary is None:
+                # Search for a contiguous range of received messages that covers the date
+                # Поиск непрерывного диапазона полученных сообщений, покрывающего дату
+                for dates, ids in self._segments.get(dialog_id, []):
+                    if dates[0] < timestamp <= dates[-1]:
+                        position = bisect_left(dates, timestamp)
+                        boundary = ids[position] if reverse else ids[position - 1]
+                        break
+            if boundary is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return boundary
+
+    def put_boundary(self, dialog_id: int, date: datetime, reverse: bool, message_id: int) -> None:
+        """
+        Saves the boundary message ID received from Telegram for a date
+        Сохраняет полученный от Telegram ID граничного сообщения для даты
+        Attributes:
+            dialog_id (int): dialog ID
+            date (datetime): boundary date
+            reverse (bool): search direction
+            message_id (int): boundary message ID, 0 if there is no such message
+        """
+
+        with self._lock:
+            self._boundaries[(dialog_id, int(date.timestamp()), reverse)] = message_id
+            while len(self._boundaries) > GlobalConst.date_boundary_cache_size:
+                self._boundaries.popitem(last=False)
+
+    def add_anchors(self, dialog_id: int, anchors: list[tuple[int, int]]) -> None:
+        """
+        Adds anchors (date timestamp, message ID) of a contiguous range of received messages, merging it with
+        the ranges that overlap it
+        Добавляет опорные точки (метка времени даты, ID сообщения) непрерывного диапазона полученных сообщений,
+        объединяя его с пересекающимися с ним диапазонами
+        Attributes:
+            dialog_id (int): dialog ID
+            anchors (list[tuple[int, int]]): anchors of contiguous messages in any order
+        """
+
+        if len(anchors) < 2:
+            return
+        with self._lock:
+            anchor_dates = {message_id: timestamp for timestamp, message_id in anchors}
+            min_id, max_id = min(anchor_dates), max(anchor_dates)
+            segments = self._segments.pop(dialog_id, [])
+            # The ranges do not overlap and are sorted, so the ranges overlapping the new one go in a row.
+            # The union of overlapping contiguous ranges is also contiguous.
+            # Диапазоны не пересекаются и отсортированы, поэтому пересекающиеся с новым диапазоны идут подряд.
+            # Объединение пересекающихся непрерывных диапазонов также является непрерывным.
+            first = bisect_left(segments, min_id, key=lambda segment: segment[1][-1])
+            last = bisect_right(segments, max_id, key=lambda segment: segment[1][0])
+            for dates, ids in segments[first:last]:
+                anchor_dates.update(zip(ids, dates))
+            del segments[first:last]
+            ids = array('q', sorted(anchor_dates))
+            insort(segments, (array('q', [anchor_dates[message_id] for message_id in ids]), ids),
+                   key=lambda segment: segment[1][0])
+            self._trim_segments(segments)
+            self._segments[dialog_id] = segments
+            while len(self._segments) > self.max_dialogs:
+                self._segments.popitem(last=False)
+
+    def _trim_segments(self, segments: list[tuple[array, array]]) -> None:
+        """
+        Removes the anchors of the oldest messages of a dialog beyond max_anchors. A range is trimmed from the side
+        of the older messages, so it stays contiguous.
+        Удаляет опорные точки самых старых сообщений диалога сверх max_anchors. Диапазон обрезается со стороны
+        более старых сообщений, поэтому остается непрерывным.
+        Attributes:
+            segments (list[tuple[array, array]]): dates and IDs of the ranges of a dialog sorted by message ID
+        """
+
+        excess = sum(len(ids) for _, ids in segments) - self.max_anchors
+        while excess > 0:
+            dates, ids = segments[0]
+            # A range of less than two anchors does not cover any date
+            # Диапазон из менее чем двух опорных точек не покрывает ни одной даты
+            if len(ids) - excess < 2:
+                del segments[0]
+                excess -= len(ids)
+            else:
+                segments[0] = (dates[excess:], ids[excess:])
+                excess = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Returns cache usage counters
+        Возвращает счетчики использования кэша
+        """
+        with self._lock:
+            return {'dialogs': len(self._segments), 'hits': self.hits, 'misses': self.misses}
+
+
+@dataclass
+class TgDownloadQueue:
+    """
+    Priority queue of message files for downloading. Files are ranked by the download priority of their type
+    (images first, videos and unknown files last) and then by size, prioritized files, for example, the files of
+    the opened message, are downloaded before all others. The queue is processed by worker_count workers,
+    GlobalConst.max_concurrent_downloads per client session, all methods must be called in the Telegram client
+    event loop.
+    Очередь с приоритетом файлов сообщений для загрузки. Файлы ранжируются по приоритету загрузки их типа
+    (сначала изображения, в конце видео и неизвестные файлы), а затем по размеру, приоритетные файлы, например,
+    файлы открытого сообщения, загружаются раньше всех остальных. Очередь обрабатывается worker_count
+    обработчиками, по GlobalConst.max_concurrent_downloads на сессию клиента, все методы должны вызываться в цикле
+    событий клиента Telegram.
+    Attributes:
+        downloaded (int): number of downloaded files
+        failed (int): number of files that failed to download
+        worker_count (int): number of workers downloading files at the same time
+    """
+
+    downloaded: int = 0
+    failed: int = 0
+    _heap: list = field(default_factory=list)
+    _entries: dict[str, list] = field(default_factory=dict)
+    _results: dict[str, AsyncioFuture] = field(default_factory=dict)
+    _messages: dict[str, Message] = field(default_factory=dict)
+    _counter: Iterator[int] = field(default_factory=count)
+    _wakeup: Event | None = None
+    _workers: list = field(default_factory=list)
+    worker_count: int = GlobalConst.max_concurrent_downloads
+
+    def put(self, tg_file: TgFile, download: Callable[[TgFile, Message | None], Coroutine], prioritized: bool = False,
+            message: Message | None = None) -> AsyncioFuture:
+        """
+        Adds a file to the queue, or raises the priority of an already queued file if prioritized is True
+        Добавляет файл в очередь или повышает приоритет уже находящегося в очереди файла, если prioritized равен True
+        Attributes:
+            tg_file (TgFile): message file object
+            download (Callable[[TgFile, Message | None], Coroutine]): coroutine function for downloading a file
+            prioritized (bool): download the file before all non-prioritized files
+            message (Message | None): Telegram message of the file, kept only while the file is in the queue
+        Returns:
+            AsyncioFuture: future with the message file path if downloaded, else None
+        """
+
+        if self._wakeup is None:
+            self._wakeup = Event()
+            self._workers = [loop.create_task(self._worker(download))
+                             for _ in range(self.worker_count)]
+        result = self._results.get(tg_file.file_path)
+        if result is None:
+            result = loop.create_future()
+            self._results[tg_file.file_path] = result
+            self._push(tg_file, prioritized)
+        elif prioritized:
+            self.prioritize([tg_file])
+        if message is not None and tg_file.file_path in self._entries:
+            self._messages.setdefault(tg_file.file_path, message)
+        self._wakeup.set()
+        return result
+
+    def prioritize(self, tg_files: list[TgFile]) -> int:
+        """
+        Raises the priority of the files that are already in the queue, other files are not added to the queue
+        Повышает приоритет файлов, уже находящихся в очереди, остальные файлы в очередь не добавляются
+        Attributes:
+            tg_files (list[TgFile]): message file objects
+        Returns:
+            int: number of files whose priority was raised
+        """
+
+        prioritized_count = 0
+        for tg_file in tg_files:
+            old_entry = self._entries.get(tg_file.file_path)
+            if old_entry is not None and old_entry[0]:
+                # The old entry stays in the heap and is skipped when it is taken out
+                # Старая запись остается в куче и пропускается при извлечении
+                old_entry[-1] = None
+                self._push(tg_file, True)
+                prioritized_count += 1
+        return prioritized_count
+
+    def _push(self, tg_file: TgFile, prioritized: bool) -> None:
+        """
+        Puts a heap entry [not prioritized, type priority, size, sequence number, file] for a file
+        Помещает в кучу запись [не приоритетный, приоритет типа, размер, порядковый номер, файл] для файла
+        """
+
+        entry = [not prioritized, tg_file.file_type.download_priority, tg_file.size, next(self._counter), tg_file]
+        self._entries[tg_file.file_path] = entry
+        heappush(self._heap, entry)
+
+    def _pop(self) -> TgFile | None:
+        """
+        Takes the file with the highest priority out of the queue, or returns None if the queue is empty
+        Извлекает из очереди файл с наивысшим приоритетом или возвращает None, если очередь пуста
+        """
+
+        while self._heap:
+            tg_file = heappop(self._heap)[-1]
+            if tg_file is not None:
+                del self._entries[tg_file.file_path]
+                return tg_file
+        return None
+
+    async def _worker(self, download: Callable[[TgFile, Message | None], Coroutine]) -> None:
+        """
+        Downloads files from the queue in order of priority
+        Загружает файлы из очереди в порядке приоритета
+        """
+
+        assert self._wakeup is not None
+        while True:
+            tg_file = self._pop()
+            if tg_file is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            downloading_result = None
+            try:
+                status_messages.mess_update('', f'Download: {tg_file.file_path}')
+                downloading_result = await download(tg_file, self._messages.pop(tg_file.file_path, None))
+            except (RPCError, OSError, ValueError) as error:
+                status_messages.mess_update('', f'Download of {tg_file.file_path} failed: {error}')
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                # An unexpected error must not stop the worker, otherwise the rest of the queue is never downloaded.
+                # It fails only this file, and the worker goes on with the queue.
+                # Непредвиденная ошибка не должна останавливать обработчик, иначе остаток очереди никогда не будет
+                # загружен. Она завершает неудачей только этот файл, и обработчик продолжает обработку очереди.
+                status_messages.mess_update('', f'Unexpected error downloading {tg_file.file_path}: '
+                                                f'{type(error).__name__}: {error}')
+            finally:
+                # The future is resolved even if the worker is cancelled, so that no one waits for it forever
+                # Future разрешается, даже если обработчик отменен, чтобы никто не ожидал его бесконечно
+                self._messages.pop(tg_file.file_path, None)
+                result = self._results.pop(tg_file.file_path, None)
+                if result is not None and not result.done():
+                    result.set_result(downloading_result)
+            if downloading_result:
+                self.downloaded += 1
+            else:
+                self.failed += 1
+            status_messages.mess_update('', f'{tg_file.file_path} downloaded successfully' if downloading_result
+                                        else f'Failed to download file {tg_file.file_path}')
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Returns queue usage counters
+        Возвращает счетчики использования очереди
+        """
+        return {'queued': len(self._entries), 'downloaded': self.downloaded, 'failed': self.failed}
+
+
+@dataclass
+class TgMediaStore:
+    """
+    Content-addressed store of downloaded media. Telegram keeps a forwarded photo or document under the same ID in
+    all chats, so each media is downloaded once into a blob named by its media ID in the GlobalConst.media_blobs_dir
+    subdirectory, and the files of the message groups of all chats are hard links to the blob, or copies of it if the
+    file system does not support hard links. If GlobalConst.media_content_hash is set, the blobs are also indexed by
+    the SHA-256 hash of their content, and media uploaded again under a new ID is stored once. The downloading methods
+    must be called in the Telegram client event loop.
+    Хранилище загруженных медиа с адресацией по содержимому. Telegram хранит пересланную фотографию или документ под
+    тем же ID во всех диалогах, поэтому каждое медиа загружается один раз в блоб, названный по ID медиа, в
+    поддиректории GlobalConst.media_blobs_dir, а файлы групп сообщений всех диалогов являются жесткими ссылками на
+    блоб или его копиями, если файловая система не поддерживает жесткие ссылки. Если установлен
+    GlobalConst.media_content_hash, блобы также индексируются по хэшу SHA-256 их содержимого, и медиа, загруженное
+    повторно под новым ID, хранится один раз. Методы загрузки должны вызываться в цикле событий клиента Telegram.
+    Attributes:
+        linked (int): number of files linked to a blob instead of downloading
+        stored (int): number of downloaded files added to the store
+        content_matches (int): number of downloaded files replaced by a blob with the same content
+        saved_bytes (int): number of bytes that were not downloaded or stored again
+        pending_downloads (dict[str, Event]): downloads of media in progress by media ID
+    """
+
+    linked: int = 0
+    stored: int = 0
+    content_matches: int = 0
+    saved_bytes: int = 0
+    pending_downloads: dict[str, Event] = field(default_factory=dict)
+
+    @staticmethod
+    def get_blob_file_path(blob_name: str) -> str:
+        """
+        Returns the path of a blob relative to the media directory
+        Возвращает путь блоба относительно директории медиа
+        Attributes:
+            blob_name (str): media ID or content hash of the blob
+        Returns:
+            str: blob file path
+        """
+        return f'{GlobalConst.media_blobs_dir}/{blob_name}'
+
+    @staticmethod
+    def get_blob_path(blob_name: str) -> Path:
+        """
+        Returns the full path of a blob
+        Возвращает полный путь блоба
+        Attributes:
+            blob_name (str): media ID or content hash of the blob
+        Returns:
+            Path: blob path
+        """
+        return Path(ProjectDirs.media_dir) / TgMediaStore.get_blob_file_path(blob_name)
+
+    @staticmethod
+    def link_file(source_path: Path, file_path: Path) -> None:
+        """
+        Creating a file as a hard link to the source file, or as its copy if the file system does not support hard
+        links. The file is replaced atomically.
+        Создание файла как жесткой ссылки на исходный файл или как его копии, если файловая система не поддерживает
+        жесткие ссылки. Файл заменяется атомарно.
+        Attributes:
+            source_path (Path): source file path
+            file_path (Path): path of the created file
+        """
+
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        link_path = file_path.with_name(f'{file_path.name}{GlobalConst.partial_file_suffix}')
+        link_path.unlink(missing_ok=True)
+        try:
+            link(source_path, link_path)
+        except OSError:
+            copyfile(source_path, link_path)
+        link_path.replace(file_path)
+
+    def link_from_blob(self, media_id: str, file_path: Path) -> bool:
+        """
+        Creating a file of a message group from the blob of its media, if the media has already been downloaded
+        Создание файла группы сообщений из блоба его медиа, если медиа уже загружено
+        Attributes:
+            media_id (str): media ID
+            file_path (Path): file path
+        Returns:
+            bool: True if the file was created from the blob
+        """
+
+        blob_path = self.get_blob_path(media_id)
+        if not blob_path.exists():
+            return False
+        self.link_file(blob_path, file_path)
+        self.linked += 1
+        self.saved_bytes += blob_path.stat().st_size
+        return True
+
+    def keep_file(self, media_id: str, file_path: Path) -> None:
+        """
+        Adding an existing file, for example, downloaded before the store appeared, to the store if its media has no
+        blob
+        Добавление существующего файла, например, загруженного до появления хранилища, в хранилище, если у его медиа
+        нет блоба
+        Attributes:
+            media_id (str): media ID
+            file_path (Path): file path
+        """
+
+        if media_id and not self.get_blob_path(media_id).exists():
+            self.link_file(file_path, self.get_blob_path(media_id))
+
+    async def add_file(self, media_id: str, file_path: Path) -> None:
+        """
+        Adding a downloaded file to the store. If a blob with the same content already exists, the file is replaced
+        by a link to it.
+        Добавление загруженного файла в хранилище. Если блоб с таким же содержимым уже существует, файл заменяется
+        ссылкой на него.
+        Attributes:
+            media_id (str): media ID
+            file_path (Path): path of the downloaded file
+        """
+
+        if GlobalConst.media_content_hash:
+            # The hash is calculated outside the event loop / Хэш вычисляется вне цикла событий
+            hash_blob_path = self.get_blob_path(
+                f'{GlobalConst.content_hash_blob_prefix}{await to_thread(get_file_hash, file_path)}')
+            if hash_blob_path.exists():
+                self.link_file(hash_blob_path, file_path)
+                self.content_matches += 1
+                self.saved_bytes += hash_blob_path.stat().st_size
+            else:
+                self.link_file(file_path, hash_blob_path)
+        self.link_file(file_path, self.get_blob_path(media_id))
+        self.stored += 1
+
+    def delete_unused_blobs(self, media_hashes: dict[str, str | None]) -> tuple[int, dict[str, str]]:
+        """
+        Deleting the blobs of the store that have no record in the database, for example, the blobs of viewed but not
+        saved files, except media that is being downloaded. Content hash blobs are kept only for the content of the
+        remaining media blobs, the missing content hashes of the remaining blobs are calculated.
+        Удаление блобов хранилища, не имеющих записи в базе данных, например, блобов просмотренных, но не сохраненных
+        файлов, кроме загружаемых медиа. Блобы хэшей содержимого сохраняются только для содержимого оставшихся блобов
+        медиа, отсутствующие хэши содержимого оставшихся блобов вычисляются.
+        Attributes:
+            media_hashes (dict[str, str | None]): content hash by media ID of the media blobs recorded in the database
+        Returns:
+            tuple[int, dict[str, str]]: number of deleted blobs and the calculated content hashes by media ID
+        """
+
+        blobs_dir = Path(ProjectDirs.media_dir) / GlobalConst.media_blobs_dir
+        if not blobs_dir.exists():
+            return 0, {}
+        pending_media_ids = set(self.pending_downloads)
+        blob_paths = [blob_path for blob_path in blobs_dir.iterdir()
+                      if blob_path.is_file() and not blob_path.name.endswith(GlobalConst.partial_file_suffix)]
+        deleted_count = 0
+        content_hashes = {}
+        for blob_path in blob_paths:
+            if blob_path.name.startswith(GlobalConst.content_hash_blob_prefix):
+                continue
+            if blob_path.name not in media_hashes and blob_path.name not in pending_media_ids:
+                blob_path.unlink()
+                deleted_count += 1
+            elif GlobalConst.media_content_hash and media_hashes.get(blob_path.name) is None:
+                content_hashes[blob_path.name] = get_file_hash(blob_path)
+        # The number of links of a blob is not used, since blobs are copies if hard links are not supported
+        # Количество ссылок на блоб не используется, так как блобы являются копиями, если жесткие ссылки не
+        # поддерживаются
+        used_hashes = set()
+        if GlobalConst.media_content_hash:
+            used_hashes = {f'{GlobalConst.content_hash_blob_prefix}{content_hash}'
+                           for content_hash in [*media_hashes.values(), *content_hashes.values()] if content_hash}
+        for blob_path in blob_paths:
+            if blob_path.name.startswith(GlobalConst.content_hash_blob_prefix) and blob_path.name not in used_hashes:
+                blob_path.unlink()
+                deleted_count += 1
+        return deleted_count, content_hashes
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Returns store usage counters
+        Возвращает счетчики использования хранилища
+        """
+        return {'linked': self.linked, 'stored': self.stored, 'content_matches': self.content_matches,
+                'saved_bytes': self.saved_bytes, 'pending_downloads': len(self.pending_downloads)}
+
+
+@dataclass
+class TgMessageGroupCache:
+    """
+    LRU cache of post-processed message group lists keyed by dialog ID and filter values. Each list is stored
+    together with its high-water mark, the ID of the last received message, so only newer messages are requested
+    when the list is revalidated. Least recently used lists are evicted when their estimated total size exceeds
+    max_memory.
+    LRU кэш обработанных списков групп сообщений по ID диалога и значениям фильтров. Каждый список хранится вместе
+    с его отметкой максимума, ID последнего полученного сообщения, поэтому при повторной проверке списка
+    запрашиваются только более новые сообщения. Давно не использованные списки вытесняются, когда их оценочный
+    общий размер превышает max_memory.
+    The cache is used by request threads, the live archiver and archive jobs, so it is changed under a lock.
+    Кэш используется потоками запросов, живым архиватором и заданиями архивации, поэтому изменяется под блокировкой.
+    Attributes:
+        max_memory (int): maximum estimated size of cached lists in bytes
+        hits (int): number of lists taken from the cache
+        misses (int): number of lists received completely
+        evictions (int): number of evicted lists
+    """
+
+    max_memory: int = GlobalConst.message_group_cache_memory
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    _lists: OrderedDict = field(default_factory=OrderedDict)
+    _memory: int = 0
+    _lock: Lock = field(default_factory=Lock)
+
+    def get(self, dialog_id: int, filter_key: tuple) -> tuple[dict[str, TgMessageGroup], int] | None:
+        """
+        Returns the cached message groups of a dialog by grouped_id and the high-water mark, or None if the dialog
+        is not cached with the specified filters
+        Возвращает кэшированные группы сообщений диалога по grouped_id и отметку максимума или None, если диалог
+        не кэширован с заданными фильтрами
+        Attributes:
+            dialog_id (int): dialog ID
+            filter_key (tuple): filter values of TgMessageSortFilter.filter_key
+        Returns:
+            tuple[dict[str, TgMessageGroup], int] | None: message groups and the ID of the last received message
+        """
+
+        with self._lock:
+            cached = self._lists.get((dialog_id, filter_key))
+            if cached is None:
+                self.misses += 1
+                return None
+            self._lists.move_to_end((dialog_id, filter_key))
+            self.hits += 1
+            return cached[0], cached[1]
+
+    def put(self, dialog_id: int, filter_key: tuple, message_groups: dict[str, TgMessageGroup],
+            high_water_mark: int) -> None:
+        """
+        Saves the message groups of a dialog received with the specified filters, evicting the least recently used
+        lists if the cache exceeds max_memory
+        Сохраняет группы сообщений диалога, полученные с заданными фильтрами, вытесняя давно не использованные
+        списки, если кэш превышает max_memory
+        Attributes:
+            dialog_id (int): dialog ID
+            filter_key (tuple): filter values of TgMessageSortFilter.filter_key
+            message_groups (dict[str, TgMessageGroup]): message groups by grouped_id
+            high_water_mark (int): ID of the last received message
+        """
+
+        size = estimate_message_groups_size(message_groups.values())
+        with self._lock:
+            previous = self._lists.pop((dialog_id, filter_key), None)
+            if previous is not None:
+                self._memory -= previous[2]
+            self._lists[(dialog_id, filter_key)] = (message_groups, high_water_mark, size)
+            self._memory += size
+            # The list just added is kept even if it alone exceeds the limit
+            # Только что добавленный список сохраняется, даже если он один превышает предел
+            while self._memory > self.max_memory and len(self._lists) > 1:
+                self._memory -= self._lists.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def invalidate(self, dialog_ids: set[int] | None = None) -> None:
+        """
+        Resets the database saving status of cached message groups after changes in the database, so it is checked
+        again when the list is shown
+        Сбрасывает статус сохранения в базе данных кэшированных групп сообщений после изменений в базе данных, чтобы
+        он был проверен заново при выводе списка
+        Attributes:
+            dialog_ids (set[int] | None): IDs of the changed dialogs, None for all dialogs
+        """
+
+        with self._lock:
+            for (dialog_id, _), (message_groups, _, _) in self._lists.items():
+                if dialog_ids is None or dialog_id in dialog_ids:
+                    for message_group in message_groups.values():
+                        message_group.saved_to_db = None
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Returns cache usage counters
+        Возвращает счетчики использования кэша
+        """
+        with self._lock:
+            return {'lists': len(self._lists), 'memory': self._memory, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+@dataclass
+class TgLiveArchiver:
+    """
+    Live archiver of new messages of the specified Telegram dialogs. Message groups formed from NewMessage and Album
+    events are collected into batches of up to GlobalConst.archive_batch_size groups. A batch is passed to the save
+    function in a worker thread no later than GlobalConst.archive_batch_delay seconds after its first group.
+    All methods must be called in the Telegram client event loop.
+    Живой архиватор новых сообщений заданных диалогов Telegram. Группы сообщений, сформированные из событий
+    NewMessage и Album, собираются в пакеты до GlobalConst.archive_batch_size групп. Пакет передается функции
+    сохранения в рабочем потоке не позднее GlobalConst.archive_batch_delay секунд после его первой группы.
+    Все методы должны вызываться в цикле событий клиента Telegram.
+    Attributes:
+        dialog_ids (set[int]): IDs of archived dialogs
+        save_message_groups (Callable[[list[TgMessageGroup]], Any] | None): function saving a batch of message groups
+        archived (int): number of message groups passed to the save function
+    """
+
+    dialog_ids: set[int] = field(default_factory=set)
+    save_message_groups: Callable[[list[TgMessageGroup]], Any] | None = None
+    archived: int = 0
+    _batch: list[TgMessageGroup] = field(default_factory=list)
+    _flush_handle: Any = None
+
+    def add(self, message_groups: list[TgMessageGroup]) -> None:
+        """
+        Adds message groups to the current batch and schedules saving of the batch
+        Добавляет группы сообщений в текущий пакет и планирует сохранение пакета
+        Attributes:
+            message_groups (list[TgMessageGroup]): formed message groups
+        """
+
+        self._batch.extend(message_groups)
+        if len(self._batch) >= GlobalConst.archive_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(GlobalConst.archive_batch_delay, self.flush)
+
+    def flush(self) -> None:
+        """
+        Passes the current batch to the save function in a worker thread
+        Передает текущий пакет функции сохранения в рабочем потоке
+        """
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        message_groups, self._batch = self._batch, []
+        if message_groups and self.save_message_groups is not None:
+            self.archived += len(message_groups)
+            loop.run_in_executor(None, self.save_message_groups, message_groups)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Returns archiver counters
+        Возвращает счетчики архиватора
+        """
+        return {'dialogs': len(self.dialog_ids), 'pending': len(self._batch), 'archived': self.archived}
+
+
+@dataclass
+class TgArchiveJob:  # pylint: disable=too-many-instance-attributes
+    """
+    A class to represent a job of archiving all messages of a Telegram dialog in a date range. The job runs in its own
+    thread and can be cancelled, its progress is shown in the status bar.
+    Класс, представляющий задание архивации всех сообщений диалога Telegram за диапазон дат. Задание выполняется в
+    собственном потоке и может быть отменено, ход его выполнения выводится в строку статуса.
+    Attributes:
+        dialog_id (int): dialog ID
+        message_filter (TgMessageSortFilter): message filter with the date range of the job
+        status (str): running, cancelling, cancelled, completed or failed
+        saved_groups (int): number of saved message groups
+        saved_batches (int): number of saved batches of message groups
+        downloaded_files (int): number of downloaded files
+        failed_files (int): number of files that failed to download
+        started_at (float): monotonic time of the start of the job
+        finished_at (float | None): monotonic time of the end of the job
+        error (str): description of the error that stopped the job
+    """
+
+    dialog_id: int
+    message_filter: TgMessageSortFilter
+    status: str = 'running'
+    saved_groups: int = 0
+    saved_batches: int = 0
+    downloaded_files: int = 0
+    failed_files: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+    error: str = ''
+    _cancel_event: ThreadingEvent = field(default_factory=ThreadingEvent)
+
+    @property
+    def is_active(self) -> bool:
+        """
+        Checks whether the job has not finished yet
+        Проверяет, что задание еще не завершилось
+        """
+        return self.finished_at is None
+
+    @property
+    def is_cancelled(self) -> bool:
+        """
+        Checks whether the job cancellation has been requested
+        Проверяет, запрошена ли отмена задания
+        """
+        return self._cancel_event.is_set()
+
+    def cancel(self) -> None:
+        """
+        Requests the job cancellation, the job stops after the current message group
+        Запрашивает отмену задания, задание останавливается после текущей группы сообщений
+        """
+
+        self._cancel_event.set()
+        if self.is_active:
+            self.status = 'cancelling'
+
+    def wait_downloads(self, downloading_results: list[Future]) -> None:
+        """
+        Waits for the files of a saved batch to be downloaded, unless the job is cancelled
+        Ожидает загрузки файлов сохраненного пакета, если задание не отменено
+        Attributes:
+            downloading_results (list[Future]): futures with the results of downloading the files of the batch
+        """
+
+        for downloading_result in downloading_results:
+            while not self.is_cancelled:
+                try:
+                    file_paths = downloading_result.result(timeout=1)
+                except TimeoutError:
+                    continue
+                self.downloaded_files += len([file_path for file_path in file_paths if file_path])
+                self.failed_files += len([file_path for file_path in file_paths if not file_path])
+                break
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns the progress of the job
+        Возвращает ход выполнения задания
+        """
+
+        return {'dialog_id': self.dialog_id, 'status': self.status, 'saved_groups': self.saved_groups,
+                'saved_batches': self.saved_batches, 'downloaded_files': self.downloaded_files,
+                'failed_files': self.failed_files, 'error': self.error,
+                'elapsed': round((self.finished_at or time.monotonic()) - self.started_at, 1)}
+
 
 class TelegramHandler:
     """
@@ -534,12 +1484,30 @@ class TelegramHandler:
         dialog_sort_filter (TgDialogSortFilter): current dialog filter
         message_sort_filter (TgMessageSortFilter): current message filter
         current_state (TgCurrentState): current state of the Telegram client
+        entity_cache (TgEntityCache): cache of Telegram entities by dialog ID
+        date_boundary_cache (TgDateBoundaryCache): cache of message ID boundaries for dates
+        download_queue (TgDownloadQueue): priority queue of message files for downloading
+        media_store (TgMediaStore): content-addressed store of media shared by the message files of all chats
+        message_group_cache (TgMessageGroupCache): cache of message group lists of dialogs
+        archiver (TgLiveArchiver): live archiver of new messages of the dialogs set in the ARCHIVE_DIALOG_IDS setting
+        archive_job (TgArchiveJob | None): the last job of archiving the messages of a dialog in a date range
+        storage (Any): persistent storage of input peers and synchronization states, for example, the database handler
+        client_pool (TgClientPool): pool of Telegram client sessions, the requests of a dialog go through its session
+        client (Any): primary Telegram client of the pool
     """
 
     all_dialogues_list: list[TgDialog] | None = None
     dialog_sort_filter: TgDialogSortFilter = TgDialogSortFilter()
     message_sort_filter: TgMessageSortFilter = TgMessageSortFilter()
     current_state: TgCurrentState = TgCurrentState()
+    entity_cache: TgEntityCache = TgEntityCache()
+    date_boundary_cache: TgDateBoundaryCache = TgDateBoundaryCache()
+    download_queue: TgDownloadQueue = TgDownloadQueue()
+    media_store: TgMediaStore = TgMediaStore()
+    message_group_cache: TgMessageGroupCache = TgMessageGroupCache()
+    archiver: TgLiveArchiver = TgLiveArchiver()
+    archive_job: TgArchiveJob | None = None
+    storage: Any = None
 
     def __init__(self):
         """
@@ -549,33 +1517,253 @@ class TelegramHandler:
 
         # Load Telegram connection settings from file / Загружаем настройки подключения к Telegram из файла
         self._connection_settings = dotenv_values(ProjectDirs.telegram_settings_file)
-        # Creating and launching a Telegram client / Создаем и запускаем клиент Telegram
-        self.client = TelegramClient(self._connection_settings['SESSION_NAME'],
-                                     int(self._connection_settings['API_ID']),
-                                     self._connection_settings['API_HASH'], loop=loop)
-        self.client.start(self._connection_settings['PHONE'], self._connection_settings['PASSWORD'])
+        # Creating and launching the pool of Telegram client sessions, the primary client receives dialogs,
+        # entities and events, the other requests of the dialogs are spread across the sessions
+        # Создаем и запускаем пул сессий клиента Telegram, основной клиент получает диалоги, сущности и события,
+        # остальные запросы диалогов распределяются по сессиям
+        self.client_pool: TgClientPool = create_client_pool(self._connection_settings, loop)
+        self.client = self.client_pool.primary
+        self.download_queue.worker_count = GlobalConst.max_concurrent_downloads * len(self.client_pool)
+        run_sync(self.start_client())
         # Get your Telegram username / Получаем имя пользователя Telegram
-        self.me = loop.run_until_complete(self.client.get_me())
-        # Get a list of all Telegram account dialogues / Получаем список всех диалогов аккаунта Telegram
-        self.all_dialogues_list = self.get_dialog_list()
+        self.me = run_sync(self.client.get_me())
+        # Get a catalogue of all Telegram account dialogues / Получаем каталог всех диалогов аккаунта Telegram
+        self._dialog_index: dict[int, TgDialog] = {}
+        self._dialog_catalogue_updated = 0.0
+        self._dialog_refresh_lock = Lock()
+        self.refresh_dialog_catalogue()
         # Set the current status of the Telegram client / Устанавливаем текущее состояние клиента Telegram
-        self.current_state.dialog_list = list(self.all_dialogues_list)
+        self.current_state.dialog_list = self.get_dialog_list()
         if self.current_state.dialog_list:
             # Get the first dialog ID / Получаем ID первого диалога
             self.current_state.selected_dialog_id = self.current_state.dialog_list[0].dialog_id
-        self.current_state.message_group_list = []
+        self.current_state.set_message_group_list([])
         self.current_state.message_details = None
 
+    async def start_client(self) -> None:
+        """
+        Starting the Telegram clients of the session pool in the event loop thread
+        Запуск клиентов Telegram пула сессий в потоке цикла событий
+        """
+        # The offline backend does not require the account credentials
+        # Автономному бэкенду не требуются учетные данные аккаунта
+        if get_client_backend(self._connection_settings) == 'fake':
+            await self.client_pool.start(None, None)
+            return
+        await self.client_pool.start(self._connection_settings['PHONE'], self._connection_settings['PASSWORD'])
+
+    def attach_storage(self, storage: Any) -> None:
+        """
+        Attaches a persistent storage of input peers and synchronization states, which must provide the
+        get_input_peer(dialog_id), save_input_peer(dialog_id, peer_type, peer_id, access_hash),
+        get_sync_state(dialog_id), get_sync_message_groups(dialog_id) and
+        save_sync_state(dialog_id, last_message_id, message_group_records, date_from, replace) methods
+        Подключает постоянное хранилище входных пиров и состояний синхронизации, которое должно предоставлять методы
+        get_input_peer(dialog_id), save_input_peer(dialog_id, peer_type, peer_id, access_hash),
+        get_sync_state(dialog_id), get_sync_message_groups(dialog_id) и
+        save_sync_state(dialog_id, last_message_id, message_group_records, date_from, replace)
+        Attributes:
+            storage (Any): persistent storage, for example, the database handler
+        """
+        self.storage = storage
+
+    def get_metrics(self) -> dict:
+        """
+        Getting metrics of the Telegram client: rate limiting of the client sessions, caches, the download queue, the
+        media store and the archivers
+        Получение метрик клиента Telegram: ограничение частоты запросов сессий клиента, кэши, очередь загрузки,
+        хранилище медиа и архиваторы
+        Returns:
+            dict: metrics by components
+        """
+
+        return {'client_pool': self.client_pool.stats,
+                'entity_cache': self.entity_cache.stats,
+                'date_boundary_cache': self.date_boundary_cache.stats,
+                'message_group_cache': self.message_group_cache.stats,
+                'download_queue': self.download_queue.stats,
+                'media_store': self.media_store.stats,
+                'archiver': self.archiver.stats,
+                'archive_job': self.archive_job.stats if self.archive_job else None}
+
+    def start_archiver(self, save_message_groups: Callable[[list[TgMessageGroup]], Any]) -> None:
+        """
+        Starting the live archiver of new messages of the dialogs listed in the ARCHIVE_DIALOG_IDS setting,
+        separated by commas. Album messages are assembled into one group by grouped_id.
+        Запуск живого архиватора новых сообщений диалогов, перечисленных через запятую в настройке
+        ARCHIVE_DIALOG_IDS. Сообщения альбома собираются в одну группу по grouped_id.
+        Attributes:
+            save_message_groups (Callable[[list[TgMessageGroup]], Any]): function saving a batch of message groups,
+                                                                         called in a worker thread
+        """
+
+        archive_dialog_ids = self._connection_settings.get('ARCHIVE_DIALOG_IDS') or ''
+        dialog_ids = {int(dialog_id) for dialog_id in archive_dialog_ids.split(',') if dialog_id.strip()}
+        if not dialog_ids:
+            return
+        self.archiver.dialog_ids = dialog_ids
+        self.archiver.save_message_groups = save_message_groups
+        # Album messages are delivered by the Album event, the rest by the NewMessage event
+        # Сообщения альбомов доставляются событием Album, остальные - событием NewMessage
+        self.client.add_event_handler(self.archive_event_messages, events.NewMessage(
+            chats=list(dialog_ids), func=lambda event: event.message.grouped_id is None))
+        self.client.add_event_handler(self.archive_event_messages, events.Album(chats=list(dialog_ids)))
+        status_messages.mess_update('Live archiver', f'New messages of {len(dialog_ids)} chats are archived')
+
+    def start_archive_job(self, dialog_id: int, date_from: str, date_to: str,
+                          save_message_groups: Callable[[list[TgMessageGroup]], list[Future] | None]) -> TgArchiveJob:
+        """
+        Starting a job of archiving all messages of a dialog in a date range in a separate thread, if no other
+        archive job is running
+        Запуск в отдельном потоке задания архивации всех сообщений диалога за диапазон дат, если не выполняется
+        другое задание архивации
+        Attributes:
+            dialog_id (int): dialog ID
+            date_from (str): start date of the range, form data
+            date_to (str): end date of the range, form data
+            save_message_groups (Callable[[list[TgMessageGroup]], list[Future] | None]): function saving a batch of
+                message groups in one transaction and returning the futures of downloading their files, or None if
+                the batch could not be saved
+        Returns:
+            TgArchiveJob: started job, or the running job
+        """
+
+        if self.archive_job and self.archive_job.is_active:
+            status_messages.mess_update('Archive job', 'Another archive job is running')
+            return self.archive_job
+        # The job has its own filter, messages are received from the oldest to the newest
+        # Задание имеет собственный фильтр, сообщения получаются от старых к новым
+        message_filter = TgMessageSortFilter()
+        message_filter.sort_order = '0'
+        message_filter.date_from = date_from
+        message_filter.date_to = date_to
+        message_filter.message_query = ''
+        self.archive_job = TgArchiveJob(dialog_id, message_filter)
+        Thread(target=self.run_archive_job, args=(self.archive_job, save_message_groups), daemon=True).start()
+        return self.archive_job
+
+    def run_archive_job(self, archive_job: TgArchiveJob,
+                        save_message_groups: Callable[[list[TgMessageGroup]], list[Future] | None]) -> None:
+        """
+        Archiving the messages of a job: message groups are formed as the messages are received and saved in batches
+        of GlobalConst.archive_job_batch_size groups. The files of no more than
+        GlobalConst.archive_job_pending_batches saved batches are downloaded at the same time as the next batches are
+        formed, so the memory used does not depend on the size of the range.
+        Архивация сообщений задания: группы сообщений формируются по мере получения сообщений и сохраняются пакетами
+        по GlobalConst.archive_job_batch_size групп. Файлы не более GlobalConst.archive_job_pending_batches
+        сохраненных пакетов загружаются одновременно с формированием следующих пакетов, поэтому используемая память
+        не зависит от размера диапазона.
+        Attributes:
+            archive_job (TgArchiveJob): archive job
+            save_message_groups (Callable[[list[TgMessageGroup]], list[Future] | None]): function saving a batch
+        """
+
+        tg_dialog = self.get_dialog_by_id(archive_job.dialog_id)
+        operation = f'Archiving chat {tg_dialog.title if tg_dialog else archive_job.dialog_id}'
+        pending_downloads: deque[list[Future]] = deque()
+
+        def save_batch(message_groups: list[TgMessageGroup]) -> bool:
+            downloading_results = save_message_groups(message_groups)
+            if downloading_results is None:
+                return False
+            archive_job.saved_groups += len(message_groups)
+            archive_job.saved_batches += 1
+            status_messages.mess_update(operation, f'{archive_job.saved_groups} message groups saved')
+            # Waiting for the files of the oldest batches / Ожидание файлов самых старых пакетов
+            pending_downloads.append(downloading_results)
+            while len(pending_downloads) > GlobalConst.archive_job_pending_batches:
+                archive_job.wait_downloads(pending_downloads.popleft())
+            return True
+
+        status_messages.mess_update(operation, '', True)
+        batch: list[TgMessageGroup] = []
+        try:
+            for tg_message_group in self.iter_message_group_list(archive_job.dialog_id,
+                                                                 message_filter=archive_job.message_filter):
+                if archive_job.is_cancelled:
+                    break
+                batch.append(tg_message_group)
+                if len(batch) >= GlobalConst.archive_job_batch_size:
+                    if not save_batch(batch):
+                        archive_job.error = 'The message groups could not be saved to the database'
+                        break
+                    batch = []
+            if batch and not archive_job.is_cancelled and not archive_job.error and not save_batch(batch):
+                archive_job.error = 'The message groups could not be saved to the database'
+            while pending_downloads:
+                archive_job.wait_downloads(pending_downloads.popleft())
+        except (RPCError, OSError, ValueError) as error:
+            archive_job.error = str(error)
+        # The job thread must finish the job on any error, otherwise the job stays active and no other job can start
+        # Поток задания должен завершить задание при любой ошибке, иначе задание остается активным и другие задания
+        # не могут запуститься
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            archive_job.error = f'Unexpected error: {type(error).__name__}: {error}'
+        finally:
+            archive_job.status = 'failed' if archive_job.error else 'cancelled' if archive_job.is_cancelled \
+                else 'completed'
+            archive_job.finished_at = time.monotonic()
+            status_messages.mess_update(operation, f'Archive job {archive_job.status}: {archive_job.saved_groups} '
+                                                   f'message groups saved, {archive_job.downloaded_files} files '
+                                                   f'downloaded{f", {archive_job.error}" if archive_job.error else ""}')
+
+    async def archive_event_messages(self, event: Any) -> None:
+        """
+        Handling NewMessage and Album events of archived dialogs
+        Обработка событий NewMessage и Album архивируемых диалогов
+        Attributes:
+            event (Any): NewMessage or Album event
+        """
+
+        if self.get_dialog_by_id(event.chat_id) is None:
+            status_messages.mess_update('Live archiver', f'Chat {event.chat_id} is not found in the chat catalogue')
+            return
+        messages = event.messages if isinstance(event, events.Album.Event) else [event.message]
+        self.archiver.add(self.form_message_groups(event.chat_id, messages))
+
     def get_entity(self, entity_id: int) -> Any:
         """
-        Getting a Telegram entity by its ID
-        Получение Telegram сущности по ее ID
+        Getting a Telegram entity by its ID. The entity is taken from the cache, then from the persistent storage
+        as an input peer, and only then requested from Telegram.
+        Получение Telegram сущности по ее ID. Сущность берется из кэша, затем из постоянного хранилища в виде
+        входного пира, и только после этого запрашивается у Telegram.
         Attributes:
             entity_id (int): entity ID
         Returns:
-            Any: Telegram entity
+            Any: Telegram entity or input peer
+        """
+
+        entity = self.entity_cache.get(entity_id)
+        if entity is not None:
+            return entity
+        return run_sync(self.get_entity_async(entity_id))
+
+    async def get_entity_async(self, entity_id: int) -> Any:
         """
-        entity = loop.run_until_complete(self.client.get_entity(entity_id))
+        Getting a Telegram entity by its ID in the Telegram client event loop, in the same order as get_entity
+        Получение Telegram сущности по ее ID в цикле событий клиента Telegram в том же порядке, что и get_entity
+        Attributes:
+            entity_id (int): entity ID
+        Returns:
+            Any: Telegram entity or input peer
+        """
+
+        entity = self.entity_cache.get(entity_id)
+        if entity is not None:
+            return entity
+        # Restoring the input peer from the persistent storage / Восстанавливаем входной пир из постоянного хранилища
+        if self.storage is not None:
+            entity = input_peer_from_record(await to_thread(self.storage.get_input_peer, entity_id))
+            if entity is not None:
+                self.entity_cache.put(entity_id, entity, from_storage=True)
+                return entity
+        entity = await self.client.get_entity(entity_id)
+        self.entity_cache.put(entity_id, entity)
+        # Saving the input peer to the persistent storage / Сохраняем входной пир в постоянном хранилище
+        if self.storage is not None:
+            input_peer_record = input_peer_to_record(entity)
+            if input_peer_record:
+                self.storage.save_input_peer(entity_id, **input_peer_record)
         return entity
 
     def get_dialog_by_id(self, dialog_id: int) -> TgDialog | None:
@@ -587,51 +1775,83 @@ class TelegramHandler:
         Returns:
             TgDialog | None: Telegram dialog object
         """
-        found_tg_dialog = next((x for x in (self.all_dialogues_list or []) if x.dialog_id == dialog_id), None)
-        return found_tg_dialog
+        return self._dialog_index.get(dialog_id)
 
-    @staticmethod
-    def get_message_group_by_id(message_group_list: list, grouped_id: str) -> TgMessageGroup | None:
+    def get_message_group_by_id(self, grouped_id: str) -> TgMessageGroup | None:
         """
-        Retrieving a group of messages from the message list with the same grouped_id
-        Получение группы сообщений из списка сообщений с одинаковым grouped_id
+        Retrieving a group of messages from the current message group index by grouped_id
+        Получение группы сообщений из индекса текущих групп сообщений по grouped_id
         Attributes:
-            message_group_list (list): list of message groups
             grouped_id (str): grouped ID of the message group
         Returns:
             TgMessageGroup | None: message group object
         """
-        found_tg_message_group = next((x for x in message_group_list if x.grouped_id == grouped_id), None)
-        return found_tg_message_group
-
-    def get_dialog_list(self) -> list[TgDialog]:
-        """
-        Getting a list of all Telegram dialogs with filters and sorting
-        Получение списка всех диалогов Telegram с учетом фильтров и сортировки
+        return self.current_state.message_group_index.get(grouped_id)
+
+    def refresh_dialog_catalogue(self) -> None:
+        """
+        Loading the catalogue of all Telegram dialogs into all_dialogues_list
+        Загрузка каталога всех диалогов Telegram в all_dialogues_list
+        """
+
+        # Only one refresh of the catalogue can be performed at a time / Одновременно выполняется только одно обновление
+        if not self._dialog_refresh_lock.acquire(blocking=False):
+            return
+        try:
+            status_messages.mess_update('Loading chat list from Telegram', '', True)
+            dialogs = run_sync(self.client.get_dialogs())
+            all_dialogues_list = []
+            for dialog in dialogs:
+                tg_dialog = TgDialog(dialog)
+                # The dialog already contains its entity, so we put it in the cache
+                # Диалог уже содержит свою сущность, поэтому помещаем ее в кэш
+                self.entity_cache.put(tg_dialog.dialog_id, dialog.entity)
+                if tg_dialog.dialog_id == self.me.id:
+                    tg_dialog.title = GlobalConst.me_dialog_title
+                all_dialogues_list.append(tg_dialog)
+            self.all_dialogues_list = all_dialogues_list
+            self._dialog_index = {tg_dialog.dialog_id: tg_dialog for tg_dialog in all_dialogues_list}
+            self._dialog_catalogue_updated = time.monotonic()
+            status_messages.mess_update('Loading chat lists', f'{len(all_dialogues_list)} chats loaded from Telegram')
+        finally:
+            self._dialog_refresh_lock.release()
+
+    def get_dialog_list(self, refresh: bool = False) -> list[TgDialog]:
+        """
+        Getting a list of all Telegram dialogs with filters and sorting from the dialog catalogue. The catalogue is
+        reloaded if refresh is True, or in the background if it is older than GlobalConst.dialog_catalogue_ttl.
+        Получение списка всех диалогов Telegram с учетом фильтров и сортировки из каталога диалогов. Каталог
+        перезагружается, если refresh равен True, или в фоне, если он старше GlobalConst.dialog_catalogue_ttl.
+        Attributes:
+            refresh (bool): reload the dialog catalogue from Telegram before filtering
+        Returns:
+            list[TgDialog]: filtered and sorted dialog list
         """
 
-        status_messages.mess_update('Loading chat list from Telegram', '', True)
-        dialogs = loop.run_until_complete(self.client.get_dialogs())
-        dialog_list = []
-        for dialog in dialogs:
-            tg_dialog = TgDialog(dialog)
-            if tg_dialog.dialog_id == self.me.id:
-                tg_dialog.title = GlobalConst.me_dialog_title
-            if self.dialog_sort_filter.check_filters(tg_dialog):
-                dialog_list.append(tg_dialog)
-        status_messages.mess_update('Loading chat lists', f'{len(dialog_list)} chats loaded from Telegram')
+        if refresh or self.all_dialogues_list is None:
+            self.refresh_dialog_catalogue()
+        elif time.monotonic() - self._dialog_catalogue_updated > GlobalConst.dialog_catalogue_ttl:
+            Thread(target=self.refresh_dialog_catalogue, daemon=True).start()
+        dialog_list = [tg_dialog for tg_dialog in (self.all_dialogues_list or [])
+                       if self.dialog_sort_filter.check_filters(tg_dialog)]
         return self.dialog_sort_filter.sort_dialog_list(dialog_list)
 
-    def get_message_list(self, dialog_id: int) -> list[Message]:
+    def iter_message_list(self, dialog_id: int, min_id: int = 0,
+                          message_filter: TgMessageSortFilter | None = None) -> Iterator[Message]:
         """
-        Getting a list of messages from a specified chat, taking into account filters and sorting
-        Получение списка сообщений из заданного чата с учетом фильтров и сортировки
+        Iterating over messages from a specified chat, taking into account filters and sorting.
+        Messages are requested from Telegram page by page as the iteration proceeds.
+        Итерация по сообщениям из заданного чата с учетом фильтров и сортировки.
+        Сообщения запрашиваются у Telegram постранично по мере продвижения итерации.
         Attributes:
             dialog_id (int): dialog ID
+            min_id (int): only messages with a greater ID are requested, 0 for all messages
+            message_filter (TgMessageSortFilter | None): message filter, the current message filter if not specified
         Returns:
-            list[Message]: list of Telegram messages
+            Iterator[Message]: iterator of Telegram messages
         """
 
+        message_filter = message_filter or self.message_sort_filter
         current_tg_dialog = self.get_dialog_by_id(dialog_id)
         if current_tg_dialog:
             status_messages.mess_update(f'Loading messages for "{current_tg_dialog.title}" dialog', '', True)
@@ -639,101 +1859,401 @@ class TelegramHandler:
         dialog = self.get_entity(dialog_id)
         # Forming the current message filter parameters / Формируем текущие параметры фильтра сообщений
         message_filters = {'entity': dialog}
-        # Set filter parameters by minimum date via message ID
-        # Устанавливаем параметры фильтрации по минимальной дате через ID сообщений
-        if self.message_sort_filter.date_from:
-            message_from = loop.run_until_complete(
-                self.client.get_messages(entity=dialog, offset_date=self.message_sort_filter.date_from, limit=1))
-            message_filters['min_id'] = message_from[0].id if message_from else 0
-        # Set filter parameters by maximum date via message ID
-        # Устанавливаем параметры фильтрации по максимальной дате через id сообщений
-        if self.message_sort_filter.date_to:
-            message_to = loop.run_until_complete(
-                self.client.get_messages(entity=dialog, offset_date=self.message_sort_filter.date_to, limit=1,
-                                         reverse=True))
-            message_filters['max_id'] = message_to[0].id if message_to else maxsize
+        # Set filter parameters by minimum date via message ID, the boundary message is kept as an anchor
+        # Устанавливаем параметры фильтрации по минимальной дате через ID сообщений, граничное сообщение сохраняем
+        min_boundary_message = max_boundary_message = None
+        if message_filter.date_from:
+            message_filters['min_id'], min_boundary_message = self.get_date_boundary(
+                dialog_id, dialog, message_filter.date_from, False)
+        # In the incremental mode, the boundary message does not adjoin the received range of messages
+        # В инкрементальном режиме граничное сообщение не примыкает к полученному диапазону сообщений
+        if min_id > message_filters.get('min_id', 0):
+            message_filters['min_id'], min_boundary_message = min_id, None
+        # Set filter parameters by maximum date via message ID, the boundary message is kept as an anchor
+        # Устанавливаем параметры фильтрации по максимальной дате через id сообщений, граничное сообщение сохраняем
+        if message_filter.date_to:
+            message_filters['max_id'], max_boundary_message = self.get_date_boundary(
+                dialog_id, dialog, message_filter.date_to, True)
+            message_filters['max_id'] = message_filters['max_id'] or maxsize
         # Setting the sort order parameter by date / Установка параметра порядка сортировки по дате
-        message_filters['reverse'] = self.message_sort_filter.sort_order
-        # Getting a list of messages according to filters / Получение списка сообщений в соответствии с фильтрами
-        message_list = loop.run_until_complete(self.client.get_messages(**message_filters))
-        status_messages.mess_update('', f'{len(message_list)} messages loaded')
-        return message_list
-
-    def get_message_group_list(self, dialog_id: int) -> list[TgMessageGroup]:
-        """
-        Create list of message groups from messages in specified chat, taking in accordance filters, sorting, grouping.
-        Формирование списка групп сообщений из сообщений заданного чата с учетом фильтров, сортировки и группировки
+        message_filters['reverse'] = message_filter.sort_order
+        # The text filter is applied by Telegram, found messages are supplemented with their album messages
+        # Фильтр по тексту применяется Telegram, найденные сообщения дополняются сообщениями их альбомов
+        search_query = message_filter.message_query
+        if search_query:
+            message_filters['search'] = search_query
+        # Iterating over messages according to filters, Telethon requests them in pages of 100 messages
+        # Итерация по сообщениям в соответствии с фильтрами, Telethon запрашивает их страницами по 100 сообщений
+        message_iterator = iterate_async(self.client_pool.get_client(dialog_id).iter_messages(**message_filters))
+        if search_query:
+            message_iterator = self.iter_album_siblings(dialog_id, dialog, message_iterator, message_filters['reverse'])
+        message_count = 0
+        anchors = []
+        completed = False
+        try:
+            for message in message_iterator:
+                message_count += 1
+                anchors.append((int(message.date.timestamp()), message.id))
+                if message_count % GlobalConst.message_chunk_size == 0:
+                    status_messages.mess_update('', f'{message_count} messages loaded')
+                yield message
+            completed = True
+            status_messages.mess_update('', f'{message_count} messages loaded')
+        finally:
+            # The received messages form a contiguous range, the boundary message adjoins it if the range was
+            # received completely or from its side. Found messages do not form a contiguous range.
+            # Полученные сообщения образуют непрерывный диапазон, граничное сообщение примыкает к нему, если
+            # диапазон получен полностью или с его стороны. Найденные сообщения не образуют непрерывный диапазон.
+            if not search_query:
+                if min_boundary_message and (completed or message_filters['reverse']):
+                    anchors.append((int(min_boundary_message.date.timestamp()), min_boundary_message.id))
+                if max_boundary_message and (completed or not message_filters['reverse']):
+                    anchors.append((int(max_boundary_message.date.timestamp()), max_boundary_message.id))
+                self.date_boundary_cache.add_anchors(dialog_id, anchors)
+
+    def iter_album_siblings(self, dialog_id: int, dialog: Any, messages: Iterator[Message],
+                            reverse: bool) -> Iterator[Message]:
+        """
+        Supplementing found messages with the other messages of their albums. Album messages have consecutive IDs,
+        so the album messages are searched among GlobalConst.album_max_size - 1 IDs on each side of a found message.
+        The ID windows of several albums are requested together, up to GlobalConst.message_ids_batch_size IDs.
+        Дополнение найденных сообщений остальными сообщениями их альбомов. Сообщения альбома имеют
+        последовательные ID, поэтому сообщения альбома ищутся среди GlobalConst.album_max_size - 1 ID с каждой
+        стороны от найденного сообщения. Окна ID нескольких альбомов запрашиваются вместе, до
+        GlobalConst.message_ids_batch_size ID.
         Attributes:
             dialog_id (int): dialog ID
+            dialog (Any): Telegram entity of the dialog
+            messages (Iterator[Message]): iterator of found messages
+            reverse (bool): the messages go in ascending order of IDs
         Returns:
-            list[TgMessageGroup]: list of message groups
+            Iterator[Message]: iterator of found messages and their album messages, without repetitions
+        """
+
+        yielded_ids: set[int] = set()
+        pending_messages: list[Message] = []
+        window_ids: set[int] = set()
+
+        def release_pending_messages() -> Iterator[Message]:
+            # Requesting the ID windows of pending albums / Запрос окон ID ожидающих альбомов
+            albums: dict[int, list[Message]] = {}
+            if window_ids:
+                album_messages = run_sync(
+                    self.client_pool.get_client(dialog_id).get_messages(dialog, ids=sorted(window_ids)))
+                for album_message in album_messages:
+                    if album_message and album_message.grouped_id:
+                        albums.setdefault(album_message.grouped_id, []).append(album_message)
+            for pending_message in pending_messages:
+                album = albums.get(pending_message.grouped_id, [pending_message]) if pending_message.grouped_id \
+                    else [pending_message]
+                for album_message in sorted(album, key=lambda x: x.id, reverse=not reverse):
+                    if album_message.id not in yielded_ids:
+                        yielded_ids.add(album_message.id)
+                        yield album_message
+            pending_messages.clear()
+            window_ids.clear()
+
+        for message in messages:
+            # The message was already received as a message of a found album
+            # Сообщение уже получено как сообщение найденного альбома
+            if message.id in yielded_ids:
+                continue
+            if message.grouped_id:
+                message_window = range(message.id - GlobalConst.album_max_size + 1,
+                                       message.id + GlobalConst.album_max_size)
+                if len(window_ids) + len(message_window) > GlobalConst.message_ids_batch_size:
+                    yield from release_pending_messages()
+                window_ids.update(message_window)
+            elif not pending_messages:
+                yielded_ids.add(message.id)
+                yield message
+                continue
+            # Messages wait for the album request to keep their order / Сообщения ожидают запроса альбомов для порядка
+            pending_messages.append(message)
+        yield from release_pending_messages()
+
+    def get_date_boundary(self, dialog_id: int, dialog: Any, date: datetime,
+                          reverse: bool) -> tuple[int, Message | None]:
+        """
+        Getting the boundary message ID for a date: the last message before the date, or if reverse is True, the
+        first message from the date. The boundary is resolved locally if possible, otherwise requested from Telegram.
+        Получение ID граничного сообщения для даты: последнего сообщения до даты, или, если reverse равен True,
+        первого сообщения начиная с даты. Граница определяется локально, если возможно, иначе запрашивается у Telegram.
+        Attributes:
+            dialog_id (int): dialog ID
+            dialog (Any): Telegram entity of the dialog
+            date (datetime): boundary date
+            reverse (bool): search direction
+        Returns:
+            tuple[int, Message | None]: boundary message ID (0 if there is no such message) and the boundary message
+                                        if it was requested from Telegram
+        """
+
+        boundary = self.date_boundary_cache.get_boundary(dialog_id, date, reverse)
+        if boundary is not None:
+            return boundary, None
+        boundary_messages = run_sync(
+            self.client_pool.get_client(dialog_id).get_messages(entity=dialog, offset_date=date, limit=1,
+                                                                reverse=reverse))
+        boundary_message = boundary_messages[0] if boundary_messages else None
+        boundary = boundary_message.id if boundary_message else 0
+        # The absence of messages after the date may change when new messages arrive, so it is not cached
+        # Отсутствие сообщений после даты может измениться с приходом новых сообщений, поэтому не кэшируется
+        if boundary or not reverse:
+            self.date_boundary_cache.put_boundary(dialog_id, date, reverse, boundary)
+        return boundary, boundary_message
+
+    def iter_message_group_list(self, dialog_id: int, min_id: int = 0,
+                                message_filter: TgMessageSortFilter | None = None) -> Iterator[TgMessageGroup]:
+        """
+        Iterating over message groups formed from messages in specified chat as they arrive from Telegram, taking
+        into account filters and grouping. Only a window of the last GlobalConst.message_chunk_size groups is kept
+        open, since messages of one group follow each other.
+        Итерация по группам сообщений, формируемым из сообщений заданного чата по мере их получения из Telegram, с
+        учетом фильтров и группировки. Открытым остается только окно из последних GlobalConst.message_chunk_size
+        групп, так как сообщения одной группы следуют друг за другом.
+        Attributes:
+            dialog_id (int): dialog ID
+            min_id (int): only messages with a greater ID are requested, 0 for all messages
+            message_filter (TgMessageSortFilter | None): message filter, the current message filter if not specified
+        Returns:
+            Iterator[TgMessageGroup]: iterator of formed message groups
         """
 
-        # Creating a list of message groups based on grouping parameters and text filters
-        # Создание списка групп сообщений с учетом параметра группировки и фильтра по тексту
-        message_group_list: list[TgMessageGroup] = []
-        # Creating a list of messages based on grouping by message.grouped_id
-        # Составление списка сообщений с учетом группировки по message.grouped_id
-        for message in self.get_message_list(dialog_id):
+        # Index of open message groups by grouped_id in the order of insertion
+        # Индекс открытых групп сообщений по grouped_id в порядке добавления
+        message_groups: OrderedDict[str, TgMessageGroup] = OrderedDict()
+        # Creating message groups based on grouping by message.grouped_id
+        # Формирование групп сообщений с учетом группировки по message.grouped_id
+        for message in self.iter_message_list(dialog_id, min_id, message_filter):
             # If message.grouped_id is None, then use message.id
             # Если message.grouped_id сообщения is None, то используем message.id
             message_grouped_id = f'{dialog_id}_{message.grouped_id if message.grouped_id else message.id}'
             # Check if a message group with the current grouped_id exists
             # Проверяем существование группы сообщений с текущим grouped_id
-            tg_message_group = self.get_message_group_by_id(message_group_list, message_grouped_id)
-            # If a message group with current grouped_id does not exist, create it and add to the list of message groups
-            # Если группа сообщений с текущим grouped_id не существует, создаем ее и добавляем в список групп сообщений
+            tg_message_group = message_groups.get(message_grouped_id)
+            # If a message group with current grouped_id does not exist, create it and add it to the open groups index
+            # Если группа сообщений с текущим grouped_id не существует, создаем ее и добавляем в индекс групп сообщений
             if tg_message_group is None:
                 tg_message_group = TgMessageGroup(message_grouped_id, dialog_id)
-                message_group_list.append(tg_message_group)
+                message_groups[message_grouped_id] = tg_message_group
+                # Close the oldest message group if the window of open groups is full
+                # Закрываем самую старую группу сообщений, если окно открытых групп заполнено
+                if len(message_groups) > GlobalConst.message_chunk_size:
+                    _, closed_message_group = message_groups.popitem(last=False)
+                    if self.complete_message_group(closed_message_group, message_filter=message_filter):
+                        yield closed_message_group
             # Add the current message to the appropriate message group
             # Добавляем текущее сообщение в соответствующую группу сообщений
-            tg_message_group.add_message(message)
-            # Get information about the message file, if it exists / Получаем информацию о файле сообщения, если он есть
-            message_file = self.get_message_file_info(dialog_id, tg_message_group, message, False)
-            # Add the file, if it exists, to the appropriate message group
-            # Добавляем файл, если он есть, в соответствующую группу сообщений
-            if message_file:
+            self.add_message_to_group(dialog_id, tg_message_group, message)
+        # Close the remaining message groups / Закрываем оставшиеся группы сообщений
+        for tg_message_group in message_groups.values():
+            if self.complete_message_group(tg_message_group, message_filter=message_filter):
+                yield tg_message_group
+
+    def add_message_to_group(self, dialog_id: int, tg_message_group: TgMessageGroup, message: Message) -> None:
+        """
+        Adding a message and information about its files to a message group
+        Добавление сообщения и информации о его файлах в группу сообщений
+        Attributes:
+            dialog_id (int): dialog ID
+            tg_message_group (TgMessageGroup): message group
+            message (Message): Telegram message object
+        """
+
+        tg_message_group.add_message(message)
+        # Get information about the message file, if it exists / Получаем информацию о файле сообщения, если он есть
+        message_file = self.get_message_file_info(dialog_id, tg_message_group, message, False)
+        # Add the file, if it exists, to the appropriate message group
+        # Добавляем файл, если он есть, в соответствующую группу сообщений
+        if message_file:
+            tg_message_group.add_message_file(message_file)
+            # If it is a video, we check for its presence and obtain information about the file with a thumbnail
+            # Если это файл с видео, то проверяем на наличие и получаем информацию о файле с thumbnail
+            if message_file.file_type == MessageFileTypes.VIDEO:
+                message_file = self.get_message_file_info(dialog_id, tg_message_group, message, True)
                 tg_message_group.add_message_file(message_file)
-                # If it is a video, we check for its presence and obtain information about the file with a thumbnail
-                # Если это файл с видео, то проверяем на наличие и получаем информацию о файле с thumbnail
-                if message_file.file_type == MessageFileTypes.VIDEO:
-                    message_file = self.get_message_file_info(dialog_id, tg_message_group, message, True)
-                    tg_message_group.add_message_file(message_file)
+
+    def form_message_groups(self, dialog_id: int, messages: list[Message]) -> list[TgMessageGroup]:
+        """
+        Forming complete message groups from the given messages of a dialog without applying the message filters
+        Формирование завершенных групп сообщений из заданных сообщений диалога без применения фильтров сообщений
+        Attributes:
+            dialog_id (int): dialog ID
+            messages (list[Message]): Telegram messages, for example, the messages of an album
+        Returns:
+            list[TgMessageGroup]: list of message groups
+        """
+
+        message_groups: dict[str, TgMessageGroup] = {}
+        for message in messages:
+            message_grouped_id = f'{dialog_id}_{message.grouped_id if message.grouped_id else message.id}'
+            tg_message_group = message_groups.setdefault(message_grouped_id,
+                                                         TgMessageGroup(message_grouped_id, dialog_id))
+            self.add_message_to_group(dialog_id, tg_message_group, message)
+        for tg_message_group in message_groups.values():
+            self.complete_message_group(tg_message_group, apply_filter=False)
+        return list(message_groups.values())
+
+    def complete_message_group(self, tg_message_group: TgMessageGroup, apply_filter: bool = True,
+                               message_filter: TgMessageSortFilter | None = None) -> bool:
+        """
+        Applying the text filter to a formed message group and its post-processing
+        Применение фильтра по тексту к сформированной группе сообщений и ее постобработка
+        Attributes:
+            tg_message_group (TgMessageGroup): formed message group
+            apply_filter (bool): apply the text filter of the message filter
+            message_filter (TgMessageSortFilter | None): message filter, the current message filter if not specified
+        Returns:
+            bool: True if the message group matches the text filter
+        """
+
         # Apply filter based on message group text, if specified
         # Применение фильтра по тексту группы сообщений, если он задан
-        if self.message_sort_filter.message_query:
-            for message_group in message_group_list.copy():
-                if not self.message_sort_filter.message_query.lower() in message_group.text.lower():
-                    message_group_list.remove(message_group)
-        # Post-processing of the generated message group / Постобработка сформированной группы сообщений
-        for tg_message_group in message_group_list:
-            # Converting text hyperlinks of the form [Text](URL) to HTML format
-            # Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат
-            tg_message_group.text_hyperlink_conversion()
-            # Create a summary string based on the files available in the group messages and their types
-            # Формирование строки резюме по имеющимся в группе сообщений файлам и их типам
-            tg_message_group.set_files_report()
-            # Create a truncated message text for display in the web interface of the message list
-            # Формирование обрезанного текста сообщения для отображения в веб-интерфейсе списка сообщений
-            tg_message_group.set_truncated_text()
-        status_messages.mess_update('', f'{len(message_group_list)} message groups have been formed')
-        return self.message_sort_filter.sort_message_group_list(message_group_list)
-
-    def get_message_detail(self, dialog_id: int, message_group_id: str) -> dict:
-        """
-        Getting message details by dialog ID and message group ID
-        Получение деталей сообщения по ID диалога и ID группы сообщений
+        message_query = (message_filter or self.message_sort_filter).message_query
+        if apply_filter and message_query:
+            if message_query.lower() not in tg_message_group.text.lower():
+                return False
+        # Converting text hyperlinks of the form [Text](URL) to HTML format
+        # Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат
+        tg_message_group.text_hyperlink_conversion()
+        # Create a summary string based on the files available in the group messages and their types
+        # Формирование строки резюме по имеющимся в группе сообщений файлам и их типам
+        tg_message_group.set_files_report()
+        # Create a truncated message text for display in the web interface of the message list
+        # Формирование обрезанного текста сообщения для отображения в веб-интерфейсе списка сообщений
+        tg_message_group.set_truncated_text()
+        return True
+
+    def get_message_group_list(self, dialog_id: int) -> list[TgMessageGroup]:
+        """
+        Create list of message groups from messages in specified chat, taking in accordance filters, sorting, grouping.
+        If the dialog was already received with the same filters, only messages newer than the high-water mark are
+        requested and merged into the cached list. The latest messages without a text filter are kept in the
+        persistent storage, so after a restart the list is restored from it and also only refreshed.
+        Формирование списка групп сообщений из сообщений заданного чата с учетом фильтров, сортировки и группировки.
+        Если диалог уже был получен с теми же фильтрами, запрашиваются только сообщения новее отметки максимума,
+        которые объединяются с кэшированным списком. Последние сообщения без фильтра по тексту хранятся в постоянном
+        хранилище, поэтому после перезапуска список восстанавливается из него и также только обновляется.
+        Attributes:
+            dialog_id (int): dialog ID
+        Returns:
+            list[TgMessageGroup]: list of message groups
+        """
+
+        filter_key = self.message_sort_filter.filter_key
+        cached = self.message_group_cache.get(dialog_id, filter_key)
+        # Only a range up to the latest messages without a text filter can be kept in the storage
+        # В хранилище может храниться только диапазон до последних сообщений без фильтра по тексту
+        synchronized = self.storage is not None and self.message_sort_filter.date_to is None and \
+            not self.message_sort_filter.message_query
+        if cached is None and synchronized:
+            cached = self.restore_message_groups(dialog_id)
+        message_groups: dict[str, TgMessageGroup] = {}
+        new_message_groups: list[TgMessageGroup] = []
+        high_water_mark = last_synced_id = 0
+        if cached:
+            # Incremental mode: request only new messages / Инкрементальный режим: запрашиваем только новые сообщения
+            message_groups, high_water_mark = cached
+            last_synced_id = high_water_mark
+            new_message_groups = list(self.iter_message_group_list(dialog_id, high_water_mark))
+            status_messages.mess_update('', f'{len(new_message_groups)} new message groups have been formed')
+            # New messages of an album that is already cached require the album to be formed anew
+            # Новые сообщения уже кэшированного альбома требуют формирования альбома заново
+            if any(message_group.grouped_id in message_groups for message_group in new_message_groups):
+                cached = None
+            else:
+                message_groups = message_groups | {message_group.grouped_id: message_group
+                                                   for message_group in new_message_groups}
+        if not cached:
+            message_groups = {message_group.grouped_id: message_group
+                              for message_group in self.iter_message_group_list(dialog_id)}
+            high_water_mark = 0
+            status_messages.mess_update('', f'{len(message_groups)} message groups have been formed')
+        high_water_mark = max([high_water_mark] + [max(group.ids) for group in message_groups.values() if group.ids])
+        self.message_group_cache.put(dialog_id, filter_key, message_groups, high_water_mark)
+        if synchronized:
+            self.save_sync_state(dialog_id, message_groups, new_message_groups if cached else None, last_synced_id,
+                                 high_water_mark)
+        return self.message_sort_filter.sort_message_group_list(list(message_groups.values()))
+
+    def restore_message_groups(self, dialog_id: int) -> tuple[dict[str, TgMessageGroup], int] | None:
+        """
+        Restoring the message groups of a dialog received before a restart from the persistent storage, if they cover
+        the dates of the current message filter
+        Восстановление групп сообщений диалога, полученных до перезапуска, из постоянного хранилища, если они
+        охватывают даты текущего фильтра сообщений
+        Attributes:
+            dialog_id (int): dialog ID
+        Returns:
+            tuple[dict[str, TgMessageGroup], int] | None: message groups by grouped_id and the ID of the last received
+                message, or None if the dialog has not been synchronized from the start date of the filter
+        """
+
+        sync_state = self.storage.get_sync_state(dialog_id)
+        if sync_state is None:
+            return None
+        last_synced_id, synced_date_from = sync_state
+        date_from = self.message_sort_filter.date_from
+        if synced_date_from is not None and (date_from is None or date_from < synced_date_from):
+            return None
+        message_groups = {}
+        for message_group_record in self.storage.get_sync_message_groups(dialog_id):
+            message_group = message_group_from_record(message_group_record)
+            if date_from is None or (message_group.date and message_group.date >= date_from.astimezone()):
+                message_groups[message_group.grouped_id] = message_group
+        status_messages.mess_update('', f'{len(message_groups)} message groups have been restored')
+        return message_groups, last_synced_id
+
+    def save_sync_state(self, dialog_id: int, message_groups: dict[str, TgMessageGroup],
+                        new_message_groups: list[TgMessageGroup] | None, last_synced_id: int,
+                        high_water_mark: int) -> None:
+        """
+        Saving the received message groups of a dialog to the persistent storage. New message groups are added to the
+        saved ones only if those end at the message from which the new ones were requested, otherwise all message
+        groups are saved anew with the start date of the current message filter.
+        Сохранение полученных групп сообщений диалога в постоянном хранилище. Новые группы сообщений добавляются
+        к сохраненным, только если те заканчиваются сообщением, с которого запрошены новые, иначе все группы
+        сообщений сохраняются заново с начальной датой текущего фильтра сообщений.
+        Attributes:
+            dialog_id (int): dialog ID
+            message_groups (dict[str, TgMessageGroup]): all received message groups by grouped_id
+            new_message_groups (list[TgMessageGroup] | None): message groups received incrementally, None if all
+                message groups were received anew
+            last_synced_id (int): ID of the message from which the new message groups were requested
+            high_water_mark (int): ID of the last received message
+        """
+
+        sync_state = self.storage.get_sync_state(dialog_id)
+        if new_message_groups is not None and sync_state is not None and sync_state[0] == last_synced_id:
+            if new_message_groups:
+                self.storage.save_sync_state(dialog_id, high_water_mark,
+                                             [message_group_to_record(message_group)
+                                              for message_group in new_message_groups])
+        else:
+            self.storage.save_sync_state(dialog_id, high_water_mark,
+                                         [message_group_to_record(message_group)
+                                          for message_group in message_groups.values()],
+                                         self.message_sort_filter.date_from, True)
+
+    def get_message_detail(self, dialog_id: int, message_group_id: str, download_files: bool = False) -> dict:
+        """
+        Getting message details by dialog ID and message group ID. Files missing in the file system are shown
+        as inline previews, already queued ones are moved to the head of the download queue, new downloads are
+        started only on explicit request.
+        Получение деталей сообщения по ID диалога и ID группы сообщений. Отсутствующие в файловой системе файлы
+        показываются как встроенные превью, уже поставленные в очередь перемещаются в начало очереди загрузки,
+        новые загрузки запускаются только по явному запросу.
         Attributes:
             dialog_id (int): dialog ID
             message_group_id (str): message group ID
+            download_files (bool): start downloading missing files, except videos
         Returns:
             dict: details of message group
         """
 
         # Get the current group of messages by id / Получаем текущую группу сообщений по id
-        current_message_group = self.get_message_group_by_id(self.current_state.message_group_list or [],
-                                                             message_group_id)
+        current_message_group = self.get_message_group_by_id(message_group_id)
         assert current_message_group is not None and current_message_group.date is not None, \
             'The message group must exist and contain the date'
         message_date_str = current_message_group.date.strftime(GlobalConst.message_datetime_format)
@@ -744,26 +2264,37 @@ class TelegramHandler:
         detail_dialog_title = (current_dialog.title if current_dialog else None) or GlobalConst.dialog_no_title
         status_messages.mess_update(
             f'Loading details of message {message_date_str} in chat {detail_dialog_title}', '', True)
+        # Converting text hyperlinks of the form [Text](URL) to HTML format, if it has not been done yet
+        # Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат, если это еще не сделано
+        current_message_group.text_hyperlink_conversion()
         tg_details = {'dialog_id': dialog_id,
                       'dialog_title': detail_dialog_title,
                       'message_group_id': message_group_id,
                       'date': current_message_group.date,
-                      # Converting text hyperlinks of the form [Text](URL) to HTML format
-                      # Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат
-                      'text': convert_text_hyperlinks(
-                          current_message_group.text) if current_message_group.text else '',
+                      'text': current_message_group.text or '',
                       'files': current_message_group.files,
                       'files_report': current_message_group.files_report if current_message_group.files_report else '',
                       'saved_to_db': current_message_group.saved_to_db}
         # Download files, except videos, contained in the detailed message, if they are not in the file system
         # Скачиваем файлы, кроме видео, содержащиеся в детальном сообщении, если их нет в файловой системе
         tg_details_files = cast(list[TgFile], tg_details.get('files', []))
-        for tg_file in tg_details_files:
-            if not tg_file.is_exists():
-                if tg_file.file_type != MessageFileTypes.VIDEO:
-                    status_messages.mess_update('', f'Downloading file {tg_file.file_path}')
-                    self.download_message_file(tg_file)
+        downloadable_files = [tg_file for tg_file in tg_details_files
+                              if not tg_file.is_exists() and tg_file.file_type != MessageFileTypes.VIDEO]
+        if download_files:
+            # The files are moved to the head of the download queue / Файлы перемещаются в начало очереди загрузки
+            self.download_message_files(downloadable_files, prioritized=True)
+        elif downloadable_files:
+            # Files already queued, for example, by saving to the database, are moved to the head of the queue
+            # without waiting, new downloads are started only on explicit request
+            # Файлы, уже поставленные в очередь, например, сохранением в базу данных, перемещаются в начало очереди
+            # без ожидания, новые загрузки запускаются только по явному запросу
+            self.prioritize_queued_files(downloadable_files)
         tg_details['existing_files'] = [tg_file for tg_file in tg_details_files if tg_file.is_exists()]
+        # Inline previews of missing files, which do not require requests to Telegram
+        # Встроенные превью отсутствующих файлов, не требующие запросов к Telegram
+        tg_details['preview_files'] = [tg_file for tg_file in tg_details_files
+                                       if not tg_file.is_exists() and tg_file.preview]
+        tg_details['downloadable_count'] = len([tg_file for tg_file in downloadable_files if not tg_file.is_exists()])
         status_messages.mess_update('', 'Message details loaded')
         return tg_details
 
@@ -829,15 +2360,19 @@ class TelegramHandler:
                 file_ext = MessageFileTypes.UNKNOWN.default_ext
         else:
             file_ext = file_type.default_ext
-        # Getting file size / Получаем размер файла
+        # Getting file size and image sizes with preview bytes / Получаем размер файла и размеры изображений с превью
         file_size = 0
+        images = []
         if isinstance(message.media, MessageMediaPhoto):
-            file_size = get_image_size(message.media.photo.sizes)
+            images = message.media.photo.sizes
+            file_size = get_image_size(images)
         elif isinstance(message.media, MessageMediaWebPage):
             if hasattr(message.media.webpage, 'photo') and message.media.webpage.photo:
-                file_size = get_image_size(message.media.webpage.photo.sizes)
+                images = message.media.webpage.photo.sizes
+                file_size = get_image_size(images)
         elif isinstance(message.media, MessageMediaDocument):
             mess_doc = message.media.document
+            images = getattr(mess_doc, 'thumbs', None) or []
             if all([thumbnail, hasattr(mess_doc, 'thumbs'), mess_doc.thumbs]):
                 file_size = get_image_size(mess_doc.thumbs)
             else:
@@ -854,14 +2389,17 @@ class TelegramHandler:
                                                    width=GlobalConst.truncated_text_length, placeholder='...')])
         # Creating TgFile object / Создаем объект TgFile
         tg_file = TgFile(dialog_id=dialog_id, message_grouped_id=message_group.grouped_id,
-                         message=message, message_id=message.id,
+                         message_id=message.id,
                          description=description,
                          file_name='', file_path='',
                          alt_text=file_type.alt_text,
                          size=file_size,
-                         file_type=file_type)
+                         file_type=file_type,
+                         preview=get_inline_preview(images),
+                         resumable=TgFile.is_resumable_media(message.media, file_type),
+                         media_id=TgFile.get_media_id(message.media, file_type))
         # Generating a path to a file in the file system / Формирование пути к файлу в файловой системе
-        tg_file.file_name = TgFile.get_self_file_name(tg_file.message.date, tg_file.file_type,
+        tg_file.file_name = TgFile.get_self_file_name(message.date, tg_file.file_type,
                                                       message_group.grouped_id, message.id, file_ext)
         current_dialog = self.get_dialog_by_id(dialog_id)
         assert current_dialog is not None, 'The dialog must exist'
@@ -869,6 +2407,128 @@ class TelegramHandler:
         tg_file.file_path = file_path.as_posix()
         return tg_file
 
+    async def download_message_file_async(self, tg_file: TgFile, message: Message | None = None) -> str | None:
+        """
+        Getting a message file: the file is created from the blob of its media in the media store if the media has
+        already been downloaded for any chat, otherwise it is downloaded once, while the other files with the same
+        media wait for the download.
+        Получение файла сообщения: файл создается из блоба его медиа в хранилище медиа, если медиа уже загружено для
+        любого диалога, иначе оно загружается один раз, а остальные файлы с тем же медиа ожидают загрузки.
+        Attributes:
+            tg_file (TgFile): message file object
+            message (Message | None): Telegram message of the file, requested by the message ID if not specified
+        Returns:
+            str | None: message file path if downloaded, else None
+        """
+
+        file_path = Path(ProjectDirs.media_dir) / tg_file.file_path
+        # If the file already exists, return its path / Если файл уже существует, то возвращаем его путь
+        if tg_file.is_exists():
+            self.media_store.keep_file(tg_file.media_id, file_path)
+            return tg_file.file_path
+        # Check file size is 0 < tg_file.size <= GlobalConst.max_download_file_size
+        # Проверка размера файла на 0 < tg_file.size <= GlobalConst.max_download_file_size
+        if not 0 < tg_file.size <= GlobalConst.max_download_file_size:
+            return None
+        if not tg_file.media_id:
+            return await self.download_new_file(tg_file, message, file_path)
+        while tg_file.media_id in self.media_store.pending_downloads:
+            await self.media_store.pending_downloads[tg_file.media_id].wait()
+        if self.media_store.link_from_blob(tg_file.media_id, file_path):
+            return file_path.as_posix()
+        download_finished = self.media_store.pending_downloads[tg_file.media_id] = Event()
+        try:
+            downloaded_file_path = await self.download_new_file(tg_file, message, file_path)
+            if downloaded_file_path:
+                await self.media_store.add_file(tg_file.media_id, file_path)
+            return downloaded_file_path
+        finally:
+            del self.media_store.pending_downloads[tg_file.media_id]
+            download_finished.set()
+
+    async def download_new_file(self, tg_file: TgFile, message: Message | None, file_path: Path) -> str | None:
+        """
+        Downloading a message file into a partial file, waiting out FloodWait errors up to
+        GlobalConst.flood_wait_max_retries times. After the size check the partial file is renamed to the file path.
+        Загрузка файла сообщения в частичный файл с ожиданием ошибок FloodWait не более
+        GlobalConst.flood_wait_max_retries раз. После проверки размера частичный файл переименовывается в путь файла.
+        Attributes:
+            tg_file (TgFile): message file object
+            message (Message | None): Telegram message of the file, requested by the message ID if not specified
+            file_path (Path): full file path
+        Returns:
+            str | None: message file path if downloaded, else None
+        """
+
+        if message is None:
+            # The sessions of the pool have no entity cache, so the dialog is passed as a resolved input peer
+            # Сессии пула не имеют кэша сущностей, поэтому диалог передается разрешенным входным пиром
+            dialog = await self.get_entity_async(tg_file.dialog_id)
+            message = await self.client_pool.get_client(tg_file.dialog_id).get_messages(dialog, ids=tg_file.message_id)
+            if message is None:
+                status_messages.mess_update('', f'No message found for file {tg_file.file_path}')
+                return None
+        # Create the appropriate directories, if necessary, and download the file
+        # Создаем соответствующие директории, при необходимости, и загружаем файл
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = file_path.with_name(f'{file_path.name}{GlobalConst.partial_file_suffix}')
+        for attempt in range(GlobalConst.flood_wait_max_retries + 1):
+            try:
+                await self.download_file_part(tg_file, message, part_path)
+                break
+            except FloodWaitError as error:
+                if attempt == GlobalConst.flood_wait_max_retries:
+                    return None
+                # The dialog is passed to a free session of the pool, if there is one
+                # Диалог передается свободной сессии пула, если она есть
+                if self.client_pool.report_flood_wait(tg_file.dialog_id, error.seconds):
+                    status_messages.mess_update('', f'FloodWait: {tg_file.file_path} is passed to another session')
+                    continue
+                status_messages.mess_update('', f'FloodWait: waiting {error.seconds} s to download {tg_file.file_path}')
+                await sleep(error.seconds)
+        # Checking the size of the downloaded file and renaming it atomically
+        # Проверка размера загруженного файла и его атомарное переименование
+        if not check_downloaded_file(tg_file, part_path):
+            return None
+        part_path.replace(file_path)
+        return file_path.as_posix()
+
+    async def download_file_part(self, tg_file: TgFile, message: Message, part_path: Path) -> None:
+        """
+        Downloading a message file into a partial file. Documents are downloaded in chunks of
+        GlobalConst.download_chunk_size and the download continues from the chunk where it was interrupted.
+        Photos and thumbnails are small and are downloaded entirely.
+        Загрузка файла сообщения в частичный файл. Документы загружаются частями по GlobalConst.download_chunk_size,
+        и загрузка продолжается с той части, на которой была прервана. Фотографии и миниатюры небольшие и
+        загружаются целиком.
+        Attributes:
+            tg_file (TgFile): message file object
+            message (Message): Telegram message of the file
+            part_path (Path): partial file path
+        """
+
+        client = self.client_pool.get_client(tg_file.dialog_id)
+        if not tg_file.is_resumable():
+            downloading_param = {'message': message, 'file': part_path}
+            if tg_file.file_type == MessageFileTypes.THUMBNAIL:
+                downloading_param['thumb'] = -1
+            await client.download_media(**downloading_param)
+            return
+        # The size of the partial file, rounded down to the chunk size, is the resume offset
+        # Размер частичного файла, округленный вниз до размера части, является смещением для продолжения загрузки
+        chunk_size = GlobalConst.download_chunk_size
+        offset = part_path.stat().st_size // chunk_size * chunk_size if part_path.exists() else 0
+        with open(part_path, 'r+b' if part_path.exists() else 'wb') as part_file:
+            part_file.truncate(offset)
+            part_file.seek(offset)
+            if offset >= tg_file.size:
+                return
+            if offset:
+                status_messages.mess_update('', f'Resuming download of {tg_file.file_path} from {offset} bytes')
+            async for chunk in client.iter_download(message.media.document, offset=offset,
+                                                         request_size=chunk_size):
+                part_file.write(chunk)
+
     def download_message_file(self, tg_file: TgFile) -> str | None:
         """
         Downloading a message file
@@ -878,26 +2538,120 @@ class TelegramHandler:
         Returns:
             str | None: message file path if downloaded, else None
         """
+        return run_sync(self.download_message_file_async(tg_file))
 
-        downloading_param = {}
-        result = None
-        # Checking file existence / Проверка существования файла
-        if not tg_file.is_exists():
-            # Check file size is 0 < tg_file.size <= GlobalConst.max_download_file_size
-            # Проверка размера файла на 0 < tg_file.size <= GlobalConst.max_download_file_size
-            if 0 < tg_file.size <= GlobalConst.max_download_file_size:
-                # Create the appropriate directories, if necessary, and download the file
-                # Создаем соответствующие директории, при необходимости, и загружаем файл
-                (Path(ProjectDirs.media_dir) / tg_file.file_path).parent.mkdir(parents=True, exist_ok=True)
-                downloading_param['message'] = tg_file.message
-                downloading_param['file'] = Path(ProjectDirs.media_dir) / tg_file.file_path
-                if tg_file.file_type == MessageFileTypes.THUMBNAIL:
-                    downloading_param['thumb'] = -1
-                result = loop.run_until_complete(self.client.download_media(**downloading_param))
-        else:
-            # If the file already exists, return its full path / Если файл уже существует, то возвращаем его полный путь
-            result = tg_file.file_path
-        return result
+    def get_file_messages(self, tg_file_list: list[TgFile]) -> dict[tuple[int, int], Message]:
+        """
+        Requesting the Telegram messages of message files missing in the file system and in the media store, in
+        batches of GlobalConst.message_ids_batch_size IDs per request
+        Запрос сообщений Telegram для отсутствующих в файловой системе и в хранилище медиа файлов сообщений пакетами
+        по GlobalConst.message_ids_batch_size ID за запрос
+        Attributes:
+            tg_file_list (list[TgFile]): list of message file objects
+        Returns:
+            dict[tuple[int, int], Message]: found messages by dialog ID and message ID
+        """
+
+        # Grouping the message IDs by dialogs / Группируем ID сообщений по диалогам
+        # The media already in the media store and the repeated media are not requested
+        # Медиа, уже находящиеся в хранилище медиа, и повторяющиеся медиа не запрашиваются
+        dialog_message_ids: dict[int, set[int]] = {}
+        requested_media_ids = set()
+        for tg_file in tg_file_list:
+            if not 0 < tg_file.size <= GlobalConst.max_download_file_size or tg_file.is_exists():
+                continue
+            if tg_file.media_id:
+                if tg_file.media_id in requested_media_ids or TgMediaStore.get_blob_path(tg_file.media_id).exists():
+                    continue
+                requested_media_ids.add(tg_file.media_id)
+            dialog_message_ids.setdefault(tg_file.dialog_id, set()).add(tg_file.message_id)
+        file_messages = {}
+        for dialog_id, message_ids in dialog_message_ids.items():
+            dialog = self.get_entity(dialog_id)
+            sorted_ids = sorted(message_ids)
+            for batch_start in range(0, len(sorted_ids), GlobalConst.message_ids_batch_size):
+                messages = run_sync(self.client_pool.get_client(dialog_id).get_messages(
+                    entity=dialog, ids=sorted_ids[batch_start:batch_start + GlobalConst.message_ids_batch_size]))
+                file_messages.update({(dialog_id, message.id): message for message in messages if message})
+        return file_messages
+
+    def queue_message_files(self, tg_file_list: list[TgFile], prioritized: bool = False,
+                            file_messages: dict[tuple[int, int], Message] | None = None) -> Future:
+        """
+        Adding message files to the download queue without waiting for them to be downloaded. The messages of the
+        files are requested in batches before queuing, if they are not specified.
+        Добавление файлов сообщений в очередь загрузки без ожидания их загрузки. Сообщения файлов запрашиваются
+        пакетами перед постановкой в очередь, если они не заданы.
+        Attributes:
+            tg_file_list (list[TgFile]): list of message file objects
+            prioritized (bool): download the files before all non-prioritized files in the queue
+            file_messages (dict[tuple[int, int], Message] | None): messages of the files by dialog ID and message ID
+        Returns:
+            Future: future with the list of message file paths if downloaded, else None, in the order of the list
+        """
+
+        if file_messages is None:
+            file_messages = self.get_file_messages(tg_file_list)
+
+        async def queue_all() -> list[str | None]:
+            return list(await gather(*[self.download_queue.put(
+                tg_file, self.download_message_file_async, prioritized,
+                file_messages.get((tg_file.dialog_id, tg_file.message_id))) for tg_file in tg_file_list]))
+
+        return submit(queue_all())
+
+    def prioritize_queued_files(self, tg_file_list: list[TgFile]) -> int:
+        """
+        Moving message files that are already in the download queue to its head, without queuing new files
+        Перемещение файлов сообщений, уже находящихся в очереди загрузки, в ее начало без постановки в очередь новых
+        Attributes:
+            tg_file_list (list[TgFile]): list of message file objects
+        Returns:
+            int: number of moved files
+        """
+
+        async def prioritize_all() -> int:
+            return self.download_queue.prioritize(tg_file_list)
+
+        return run_sync(prioritize_all())
+
+    def download_message_files(self, tg_file_list: list[TgFile], prioritized: bool = False,
+                               file_messages: dict[tuple[int, int], Message] | None = None) -> list[str | None]:
+        """
+        Downloading message files through the download queue, no more than GlobalConst.max_concurrent_downloads
+        at a time, with progress reporting to the status bar
+        Загрузка файлов сообщений через очередь загрузки, не более GlobalConst.max_concurrent_downloads за раз,
+        с выводом хода загрузки в строку статуса
+        Attributes:
+            tg_file_list (list[TgFile]): list of message file objects
+            prioritized (bool): download the files before all non-prioritized files in the queue
+            file_messages (dict[tuple[int, int], Message] | None): messages of the files by dialog ID and message ID
+        Returns:
+            list[str | None]: message file paths if downloaded, else None, in the order of the list
+        """
+
+        if not tg_file_list:
+            return []
+        return self.wait_message_files(self.queue_message_files(tg_file_list, prioritized, file_messages),
+                                       len(tg_file_list))
+
+    @staticmethod
+    def wait_message_files(downloading_result: Future, file_count: int) -> list[str | None]:
+        """
+        Waiting for queued message files to be downloaded, no longer than GlobalConst.download_wait_timeout
+        Ожидание загрузки поставленных в очередь файлов сообщений, не дольше GlobalConst.download_wait_timeout
+        Attributes:
+            downloading_result (Future): future with the list of message file paths returned by queue_message_files
+            file_count (int): number of queued files
+        Returns:
+            list[str | None]: message file paths if downloaded, else None, all None if the waiting timed out
+        """
+
+        try:
+            return downloading_result.result(timeout=GlobalConst.download_wait_timeout)
+        except TimeoutError:
+            status_messages.mess_update('', f'Files are still downloading after {GlobalConst.download_wait_timeout} s')
+            return [None] * file_count
 
     def download_message_file_from_list(self, downloaded_file_list: list) -> str:
         """
@@ -909,42 +2663,54 @@ class TelegramHandler:
             str: resulting report
         """
 
-        # # Setting counters / Установка счетчиков
-        successfully_download = 0
-        failed_to_download = 0
+        status_messages.mess_update('Synchronizing the list of local files with the database', '')
         no_messages_found = 0
-        # Скачивание файлов по списку / Downloading files from a list
-        for counter, downloaded_file in enumerate(downloaded_file_list, 1):
-            progress = f'{counter} / {len(downloaded_file_list)}'
-            dialog = self.get_entity(downloaded_file['dialog_id'])
-            message = loop.run_until_complete(
-                self.client.get_messages(entity=dialog, ids=downloaded_file['message_id']))
-            if message:
-                # If the message is found, create a TgFile object and load the file
-                # Если сообщение найдено, то создаем объект TgFile и загружаем файл
-                tg_file = TgFile(dialog_id=downloaded_file['dialog_id'], message_grouped_id='message_grouped_id',
-                                 message=message, message_id=message.id,
-                                 description='description',
-                                 file_name='', file_path=downloaded_file['file_path'],
-                                 alt_text='alt_text',
-                                 size=downloaded_file['size'],
-                                 file_type=MessageFileTypes.get_file_type_by_type_id(downloaded_file['file_type_id']))
-                # Загружаем файл сообщения / Downloading the message file
-                status_messages.mess_update('Synchronizing the list of local files with the database',
-                                            f'{progress}  Download: {tg_file.file_path}')
-                downloading_result = self.download_message_file(tg_file)
-                # Depending on the result of the file download, we change the counters
-                # В зависимости от результата загрузки файла изменяем счетчики
-                if downloading_result:
-                    status_messages.mess_update('', f'{progress}  Successfully!')
-                    successfully_download += 1
-                else:
-                    status_messages.mess_update('', f'{progress}  Download failed')
-                    failed_to_download += 1
-            else:
-                status_messages.mess_update('', f'{counter} / {len(downloaded_file_list)} No messages found for '
-                                                f'dialog {dialog.title} and message id {downloaded_file["message_id"]}')
-                no_messages_found += 1
+        # Grouping the files from the list by dialogs / Группируем файлы из списка по диалогам
+        dialog_file_lists: dict[int, list[dict]] = {}
+        for downloaded_file in downloaded_file_list:
+            dialog_file_lists.setdefault(downloaded_file['dialog_id'], []).append(downloaded_file)
+        # Finding the messages of the files in batches of GlobalConst.message_ids_batch_size IDs per request
+        # Поиск сообщений файлов пакетами по GlobalConst.message_ids_batch_size ID за запрос
+        tg_file_list = []
+        file_messages = {}
+        requested_count = 0
+        for dialog_id, dialog_file_list in dialog_file_lists.items():
+            dialog = self.get_entity(dialog_id)
+            for batch_start in range(0, len(dialog_file_list), GlobalConst.message_ids_batch_size):
+                file_batch = dialog_file_list[batch_start:batch_start + GlobalConst.message_ids_batch_size]
+                messages = run_sync(self.client_pool.get_client(dialog_id).get_messages(
+                    entity=dialog, ids=[x['message_id'] for x in file_batch]))
+                requested_count += len(file_batch)
+                status_messages.mess_update('', f'{requested_count} / {len(downloaded_file_list)} '
+                                                f'messages of files requested')
+                # The messages are returned in the order of the requested IDs, None for not found ones
+                # Сообщения возвращаются в порядке запрошенных ID, None для не найденных
+                for downloaded_file, message in zip(file_batch, messages):
+                    if message:
+                        # If the message is found, create a TgFile object to load the file
+                        # Если сообщение найдено, то создаем объект TgFile для загрузки файла
+                        file_type = MessageFileTypes.get_file_type_by_type_id(downloaded_file['file_type_id'])
+                        tg_file_list.append(
+                            TgFile(dialog_id=dialog_id, message_grouped_id='message_grouped_id',
+                                   message_id=message.id,
+                                   description='description',
+                                   file_name='', file_path=downloaded_file['file_path'],
+                                   alt_text='alt_text',
+                                   size=downloaded_file['size'],
+                                   file_type=file_type,
+                                   resumable=TgFile.is_resumable_media(message.media, file_type),
+                                   media_id=TgFile.get_media_id(message.media, file_type)))
+                        file_messages[(dialog_id, message.id)] = message
+                    else:
+                        tg_dialog = self.get_dialog_by_id(dialog_id)
+                        dialog_title = tg_dialog.title if tg_dialog else dialog_id
+                        status_messages.mess_update('', f'No messages found for dialog {dialog_title} '
+                                                        f'and message id {downloaded_file["message_id"]}')
+                        no_messages_found += 1
+        # Concurrent downloading of the found files / Одновременная загрузка найденных файлов
+        downloading_results = self.download_message_files(tg_file_list, file_messages=file_messages)
+        successfully_download = len([result for result in downloading_results if result])
+        failed_to_download = len(downloading_results) - successfully_download
         # Формирование отчета по результатам загрузки файлов / Generating a report based on file downloading results
         resulting_report = (f'Files to download: {len(downloaded_file_list)};\n '
                             f'Downloaded files: {successfully_download};\n '
@@ -954,42 +2720,291 @@ class TelegramHandler:
         return resulting_report
 
 
-def convert_text_hyperlinks(message_text: str | None) -> str | None:
+def get_inline_preview(images: list) -> str:
+    """
+    Getting a blurred inline preview of an image from the bytes of PhotoCachedSize or PhotoStrippedSize contained
+    in the message itself, without requests to Telegram
+    Получение размытого встроенного превью изображения из байтов PhotoCachedSize или PhotoStrippedSize,
+    содержащихся в самом сообщении, без запросов к Telegram
+    Attributes:
+        images (list): image sizes of a photo or document thumbnails
+    Returns:
+        str: JPEG image as a data URI, or empty string if there are no preview bytes
+    """
+
+    preview_bytes = b''
+    for image in images:
+        if isinstance(image, PhotoCachedSize) and image.bytes:
+            preview_bytes = image.bytes
+            break
+        if isinstance(image, PhotoStrippedSize) and image.bytes and not preview_bytes:
+            # Stripped previews contain JPEG data without the common header
+            # Сокращенные превью содержат данные JPEG без общего заголовка
+            preview_bytes = telethon_utils.stripped_photo_to_jpg(image.bytes)
+    return f'data:image/jpeg;base64,{b64encode(preview_bytes).decode("ascii")}' if preview_bytes else ''
+
+
+def estimate_message_groups_size(message_groups: Iterable[TgMessageGroup]) -> int:
+    """
+    Estimating the memory size of message groups by their texts, previews and the number of files
+    Оценка размера групп сообщений в памяти по их текстам, превью и количеству файлов
+    Attributes:
+        message_groups (Iterable[TgMessageGroup]): message groups
+    Returns:
+        int: estimated size in bytes
+    """
+
+    return sum(GlobalConst.message_group_size_overhead + getsizeof(message_group.text) +
+               getsizeof(message_group.truncated_text) +
+               sum(GlobalConst.message_file_size_overhead + len(tg_file.preview) for tg_file in message_group.files)
+               for message_group in message_groups)
+
+
+def check_downloaded_file(tg_file: TgFile, part_path: Path) -> bool:
     """
-    Converting text hyperlinks of the form [Text](URL) to HTML format
-    Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат
+    Checking a downloaded partial file: a document must have the size of TgFile.size, other files must not be empty.
+    An incorrect partial file is deleted.
+    Проверка загруженного частичного файла: документ должен иметь размер TgFile.size, остальные файлы не должны быть
+    пустыми. Некорректный частичный файл удаляется.
     Attributes:
-        message_text (str | None): message text
+        tg_file (TgFile): message file object
+        part_path (Path): partial file path
     Returns:
-        str | None: converted message text
+        bool: True if the partial file is complete
+    """
+
+    if not part_path.exists():
+        return False
+    part_size = part_path.stat().st_size
+    # The size of a document is known exactly, the size of photos and thumbnails is only estimated
+    # Размер документа известен точно, размер фотографий и миниатюр лишь оценивается
+    if tg_file.is_resumable():
+        complete = part_size == tg_file.size
+    else:
+        complete = part_size > 0
+    if complete:
+        return True
+    status_messages.mess_update('', f'Downloaded file {tg_file.file_path} has size {part_size} '
+                                    f'instead of {tg_file.size} and was deleted')
+    part_path.unlink()
+    return False
+
+
+def get_file_hash(file_path: Path) -> str:
+    """
+    Calculating the SHA-256 hash of the content of a file, read in chunks of GlobalConst.download_chunk_size
+    Вычисление хэша SHA-256 содержимого файла, читаемого частями по GlobalConst.download_chunk_size
+    Attributes:
+        file_path (Path): file path
+    Returns:
+        str: hexadecimal hash
+    """
+
+    file_hash = sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(GlobalConst.download_chunk_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def input_peer_to_record(entity: Any) -> dict[str, Any] | None:
+    """
+    Converting a Telegram entity to an input peer record for the persistent storage
+    Преобразование сущности Telegram в запись входного пира для постоянного хранилища
+    Attributes:
+        entity (Any): Telegram entity
+    Returns:
+        dict[str, Any] | None: input peer record, or None if the entity cannot be converted
+    """
+
+    try:
+        input_peer = telethon_utils.get_input_peer(entity)
+    except TypeError:
+        return None
+    match input_peer:
+        case InputPeerUser():
+            return {'peer_type': 'user', 'peer_id': input_peer.user_id, 'access_hash': input_peer.access_hash}
+        case InputPeerChannel():
+            return {'peer_type': 'channel', 'peer_id': input_peer.channel_id, 'access_hash': input_peer.access_hash}
+        case InputPeerChat():
+            return {'peer_type': 'chat', 'peer_id': input_peer.chat_id, 'access_hash': 0}
+        case InputPeerSelf():
+            return {'peer_type': 'self', 'peer_id': 0, 'access_hash': 0}
+    return None
+
+
+def input_peer_from_record(input_peer_record: dict[str, Any] | None) -> Any:
+    """
+    Restoring a Telegram input peer from a record of the persistent storage
+    Восстановление входного пира Telegram из записи постоянного хранилища
+    Attributes:
+        input_peer_record (dict[str, Any] | None): input peer record
+    Returns:
+        Any: Telegram input peer, or None if the record is missing or unknown
+    """
+
+    if not input_peer_record:
+        return None
+    peer_id, access_hash = input_peer_record['peer_id'], input_peer_record['access_hash']
+    match input_peer_record['peer_type']:
+        case 'user':
+            return InputPeerUser(user_id=peer_id, access_hash=access_hash)
+        case 'channel':
+            return InputPeerChannel(channel_id=peer_id, access_hash=access_hash)
+        case 'chat':
+            return InputPeerChat(chat_id=peer_id)
+        case 'self':
+            return InputPeerSelf()
+    return None
+
+
+def message_group_to_record(message_group: TgMessageGroup) -> dict[str, Any]:
+    """
+    Converting a message group to a record for the persistent storage. The database saving status is not kept,
+    since it is checked again.
+    Преобразование группы сообщений в запись для постоянного хранилища. Статус сохранения в базе данных не
+    сохраняется, так как он проверяется заново.
+    Attributes:
+        message_group (TgMessageGroup): message group
+    Returns:
+        dict[str, Any]: message group record
+    """
+
+    return {'grouped_id': message_group.grouped_id,
+            'dialog_id': message_group.dialog_id,
+            'ids': message_group.ids,
+            'files': [asdict(tg_file) | {'file_type': tg_file.file_type.name} for tg_file in message_group.files],
+            'date': message_group.date.isoformat() if message_group.date else None,
+            'text': message_group.text,
+            'truncated_text': message_group.truncated_text,
+            'from_id': message_group.from_id,
+            'files_report': message_group.files_report,
+            'text_converted': message_group.text_converted}
+
+
+def message_group_from_record(message_group_record: dict[str, Any]) -> TgMessageGroup:
+    """
+    Restoring a message group from a record of the persistent storage
+    Восстановление группы сообщений из записи постоянного хранилища
+    Attributes:
+        message_group_record (dict[str, Any]): message group record
+    Returns:
+        TgMessageGroup: message group
+    """
+
+    message_group = TgMessageGroup(message_group_record['grouped_id'], message_group_record['dialog_id'])
+    message_group.ids = message_group_record['ids']
+    message_group.files = [TgFile(**(file_record | {'file_type': MessageFileTypes[file_record['file_type']]}))
+                           for file_record in message_group_record['files']]
+    message_group.date = datetime.fromisoformat(message_group_record['date']) if message_group_record['date'] else None
+    message_group.text = message_group_record['text']
+    message_group.truncated_text = message_group_record['truncated_text']
+    message_group.from_id = message_group_record['from_id']
+    message_group.files_report = message_group_record['files_report']
+    message_group.text_converted = message_group_record['text_converted']
+    return message_group
+
+
+def submit(coroutine: Coroutine) -> Future:
+    """
+    Submitting a coroutine to the event loop thread of the Telegram client from any thread
+    Передача корутины в поток цикла событий клиента Telegram из любого потока
+    Attributes:
+        coroutine (Coroutine): coroutine to run
+    Returns:
+        Future: future with the result of the coroutine
+    """
+    return run_coroutine_threadsafe(coroutine, loop)
+
+
+def run_sync(coroutine: Coroutine) -> Any:
+    """
+    Running a coroutine in the event loop thread of the Telegram client and waiting for its result. Coroutines
+    submitted from different threads are executed concurrently.
+    Выполнение корутины в потоке цикла событий клиента Telegram и ожидание ее результата. Корутины, переданные
+    из разных потоков, выполняются одновременно.
+    Attributes:
+        coroutine (Coroutine): coroutine to run
+    Returns:
+        Any: result of the coroutine
+    """
+    return submit(coroutine).result()
+
+
+def iterate_async(async_iterator: AsyncIterator, batch_size: int = GlobalConst.message_chunk_size) -> Iterator:
+    """
+    Synchronous iteration over an asynchronous iterator in the event loop thread of the Telegram client.
+    Items are received in batches so that the threads are switched once per batch, not once per item.
+    Синхронная итерация по асинхронному итератору в потоке цикла событий клиента Telegram.
+    Элементы получаются пакетами, чтобы потоки переключались один раз на пакет, а не на каждый элемент.
+    Attributes:
+        async_iterator (AsyncIterator): asynchronous iterator, for example, client.iter_messages()
+        batch_size (int): maximum number of items received in one switch to the event loop thread
+    Returns:
+        Iterator: synchronous iterator over the same items
+    """
+
+    async def next_batch() -> tuple[list[Any], bool]:
+        batch: list[Any] = []
+        try:
+            while len(batch) < batch_size:
+                batch.append(await anext(async_iterator))
+        except StopAsyncIteration:
+            return batch, True
+        return batch, False
+
+    finished = False
+    while not finished:
+        batch, finished = run_sync(next_batch())
+        yield from batch
+
+
+def run_loop():
+    """
+    Runs the event loop of the Telegram client in its own thread until it is stopped
+    Выполняет цикл событий клиента Telegram в собственном потоке до его остановки
+    """
+
+    set_event_loop(loop)
+    loop.run_forever()
+
+
+async def cancel_tasks() -> None:
+    """
+    Cancels all tasks of the event loop, except the current one, and waits for them to finish
+    Отменяет все задачи цикла событий, кроме текущей, и ожидает их завершения
     """
 
-    if message_text:
-        matches = GlobalConst.text_with_url_pattern.findall(message_text)
-        if matches:
-            for match in matches:
-                message_text = message_text.replace(f'[{match[0]}]({match[1]})',
-                                                    f'<a href = "{match[1]}" target="_blank" >{match[0]}</a>')
-    return message_text
+    tasks = [task for task in all_tasks() if task is not current_task()]
+    for task in tasks:
+        task.cancel()
+    await gather(*tasks, return_exceptions=True)
 
 
 def cleanup_loop():
     """
-    Called when the application terminates and closes the event loop if it is open.
-    Вызывается при завершении приложения и закрывает цикл событий, если он открыт
+    Called when the application terminates, stops the event loop thread and closes the event loop if it is open.
+    Вызывается при завершении приложения, останавливает поток цикла событий и закрывает цикл событий, если он открыт
     """
 
     if loop.is_running():
-        loop.stop()
-    if not loop.is_closed():
+        # Cancel the background tasks, for example, the download queue workers
+        # Отменяем фоновые задачи, например, обработчики очереди загрузки
+        try:
+            submit(cancel_tasks()).result(timeout=GlobalConst.loop_stop_timeout)
+        except TimeoutError:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=GlobalConst.loop_stop_timeout)
+    if not loop.is_closed() and not loop.is_running():
         loop.close()
-    set_event_loop(None)
 
 
-# Создаем и сохраняем цикл событий для работы с клиентом Telegram
-# Create and save the asyncio event loop for working with the Telegram client
+# Создаем цикл событий для работы с клиентом Telegram и запускаем его в отдельном потоке
+# Create the asyncio event loop for working with the Telegram client and run it in a separate thread
 loop = new_event_loop()
-set_event_loop(loop)
+loop_thread = Thread(target=run_loop, name='telegram_event_loop', daemon=True)
+loop_thread.start()
 atexit.register(cleanup_loop)
 # Создаем экземпляр TelegramHandler для работы с клиентом Telegram
 # Create an object of the TelegramHandler class for working with the Telegram client
@@ -4,16 +4,40 @@ The module implements the main logic of the program based on Flask.
 
 import logging
 import shutil
+from concurrent.futures import Future
 from datetime import datetime
 from pathlib import Path
+from typing import cast
 from flask import Flask, render_template, request, send_from_directory, jsonify
 from sqlalchemy import delete, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 from configs.config import GlobalConst, MessageFileTypes, ProjectDirs, FormCfg, TagsSorting
 from utils import clean_file_path, status_messages
-from telegram_handler import tg_handler, TgFile
-from database_handler import db_handler, DbDialog, DbMessageGroup, DbFile, DbDialogType, DbFileType
+from telegram_handler import tg_handler, TgFile, TgMediaStore, TgMessageGroup
+from database_handler import db_handler, DbDialog, DbMessageGroup, DbFile, DbDialogType, DbFileType, DbMediaBlob
 
 tg_saver = Flask(__name__)
+# Telegram input peers are cached in the database / Входные пиры Telegram кэшируются в базе данных
+tg_handler.attach_storage(db_handler)
+# Saving of message groups by request handlers and by the live archiver is serialized with the other writes of
+# the database handler
+# Сохранение групп сообщений обработчиками запросов и живым архиватором сериализуется с другими записями
+# обработчика базы данных
+save_lock = db_handler.write_lock
+
+
+@tg_saver.before_request
+def refresh_db_dialog_list():
+    """
+    Updating the list of database dialogs after message groups have been saved by the archivers in their own sessions
+    Обновление списка диалогов базы данных после сохранения групп сообщений архиваторами в собственных сессиях
+    """
+
+    if db_handler.dialog_list_outdated:
+        db_handler.dialog_list_outdated = False
+        db_handler.all_dialogues_list = db_handler.get_dialog_list()
+        db_handler.current_state.dialog_list = db_handler.all_dialogues_list.copy()
 
 
 @tg_saver.context_processor
@@ -22,6 +46,9 @@ def inject_field_names():
     Registering a context processor with field names
     Регистрация контекстного процессора с именами полей
     """
+    # Only the first page of the Telegram message list is rendered, the next pages are loaded by scrolling
+    # Рендерится только первая страница списка сообщений Telegram, следующие страницы загружаются при прокрутке
+    tg_messages, tg_messages_next_cursor = tg_handler.current_state.get_message_group_page()
     return {
         'constants': GlobalConst,
         'tg_file_types': MessageFileTypes,
@@ -29,7 +56,8 @@ def inject_field_names():
         'tg_me': tg_handler.me,
         'tg_mess_date_from_default': tg_handler.message_sort_filter.date_from_default,
         'tg_dialogs': tg_handler.current_state.dialog_list,
-        'tg_messages': tg_handler.current_state.message_group_list,
+        'tg_messages': tg_messages,
+        'tg_messages_next_cursor': tg_messages_next_cursor,
         'tg_details': tg_handler.current_state.message_details,
         'db_all_dialog_list': db_handler.all_dialogues_list,
         'db_all_tags': db_handler.all_tags_list,
@@ -62,6 +90,17 @@ def status_output():
     return jsonify(status_messages.messages)
 
 
+@tg_saver.route('/tg_metrics')
+def tg_metrics():
+    """
+    Metrics of the Telegram client: request rate limiting and FloodWait errors of the client sessions, caches,
+    the download queue and the live archiver
+    Метрики клиента Telegram: ограничение частоты запросов и ошибки FloodWait сессий клиента, кэши, очередь загрузки
+    и живой архиватор
+    """
+    return jsonify(tg_handler.get_metrics())
+
+
 @tg_saver.route("/")
 def index():
     """
@@ -101,12 +140,11 @@ def tg_get_messages(dialog_id):
     tg_message_groups = tg_handler.get_message_group_list(int(dialog_id))
     # Check which message groups are already saved in the database
     # Проверяем, какие группы сообщений уже сохранены в базе данных
-    for tg_message_group in tg_message_groups:
-        tg_message_group.saved_to_db = db_handler.message_group_exists(tg_message_group.grouped_id)
+    tg_check_saved_to_db(tg_message_groups)
     # Set the Telegram ID of the current dialogue and the list of message groups in the current state of the client
     # Устанавливаем в текущем состоянии клиента Telegram ID текущего диалога и список групп сообщений
     tg_handler.current_state.selected_dialog_id = int(dialog_id)
-    tg_handler.current_state.message_group_list = tg_message_groups
+    tg_handler.current_state.set_message_group_list(tg_message_groups)
     # Refresh message list, message counter, and clear current message details
     # Обновление списка сообщений, счетчика сообщений и очистка деталей текущего сообщения
     return jsonify({'tg_messages': render_template('tg_messages.html'),
@@ -114,17 +152,36 @@ def tg_get_messages(dialog_id):
                     'tg_details': '', })
 
 
+@tg_saver.route('/tg_messages_page')
+def tg_get_messages_page():
+    """
+    Getting the next page of the current list of Telegram message groups after the group specified by the cursor
+    query parameter
+    Получение следующей страницы текущего списка групп сообщений Telegram после группы, заданной параметром
+    запроса cursor
+    """
+
+    tg_messages, tg_messages_next_cursor = tg_handler.current_state.get_message_group_page(request.args.get('cursor'))
+    # The list items are appended to the already rendered ones / Элементы списка добавляются к уже выведенным
+    return jsonify({'tg_messages_page': render_template('tg_message_items.html', tg_messages=tg_messages,
+                                                        tg_messages_next_cursor=tg_messages_next_cursor)})
+
+
 @tg_saver.route('/tg_details/<string:dialog_id>/<string:message_group_id>')
 def tg_get_details(dialog_id: str, message_group_id: str):
     """
-    Getting detailed information from a Telegram message
-    Получение детальной информации сообщения Telegram
+    Getting detailed information from a Telegram message. Files already in the download queue are moved to its
+    head, new downloads of full-size files are started only if the query string contains the download parameter.
+    Получение детальной информации сообщения Telegram. Файлы, уже находящиеся в очереди загрузки, перемещаются в
+    ее начало, новые загрузки полноразмерных файлов запускаются, только если строка запроса содержит параметр
+    download.
     Attributes:
         dialog_id (str): ID of the selected dialog / ID выбранного диалога
         message_group_id (str): ID of the selected message group / ID выбранной группы сообщений
     """
     tg_handler.current_state.message_details = (
-        tg_handler.get_message_detail(int(dialog_id), message_group_id)) if message_group_id else None
+        tg_handler.get_message_detail(int(dialog_id), message_group_id, bool(request.args.get('download')))
+    ) if message_group_id else None
     # Updating message details / Обновление деталей сообщения
     return jsonify({'tg_details': render_template('tg_details.html')})
 
@@ -132,24 +189,43 @@ def tg_get_details(dialog_id: str, message_group_id: str):
 @tg_saver.route('/tg_dialog_apply_filters', methods=['POST'])
 def tg_dialog_apply_filters():
     """
-    Getting a list of Telegram chats using filters
-    Получение списка диалогов Telegram с применением фильтров
+    Getting a list of Telegram chats from the chat catalogue using filters
+    Получение списка диалогов Telegram из каталога диалогов с применением фильтров
     """
+    return tg_update_dialog_list(refresh=False)
+
 
-    # Setting Telegram dialog filter values based on values from the form
-    # Установка значений фильтров диалогов Telegram по значениям из формы
+@tg_saver.route('/tg_dialog_refresh', methods=['POST'])
+def tg_dialog_refresh():
+    """
+    Reloading the chat catalogue from Telegram and getting a list of chats using filters
+    Перезагрузка каталога диалогов из Telegram и получение списка диалогов с применением фильтров
+    """
+    return tg_update_dialog_list(refresh=True)
+
+
+def tg_update_dialog_list(refresh: bool):
+    """
+    Updating the list of Telegram chats using filters from the form
+    Обновление списка диалогов Telegram с применением фильтров из формы
+    Attributes:
+        refresh (bool): reload the chat catalogue from Telegram / перезагрузить каталог диалогов из Telegram
+    """
+
+    # Setting Telegram dialog filter values based on values from the form, the field names are strings
+    # Установка значений фильтров диалогов Telegram по значениям из формы, имена полей являются строками
     form_cfg = FormCfg.tg_dialog_filter
     form = request.form
     dial_filter = tg_handler.dialog_sort_filter
-    dial_filter.sort_field(form.get(form_cfg['sorting_field']))
-    dial_filter.sort_order(form.get(form_cfg['sorting_order']))
-    dial_filter.dialog_type(form.get(form_cfg['dialog_type']))
-    dial_filter.title_query(form.get(form_cfg['dialog_title_query']))
+    dial_filter.sort_field(form.get(cast(str, form_cfg['sorting_field']), ''))
+    dial_filter.sort_order(form.get(cast(str, form_cfg['sorting_order']), ''))
+    dial_filter.dialog_type(form.get(cast(str, form_cfg['dialog_type']), ''))
+    dial_filter.title_query(form.get(cast(str, form_cfg['dialog_title_query']), ''))
     # Getting a list of dialogs using filters / Получение списка диалогов с применением фильтров
-    tg_handler.current_state.dialog_list = tg_handler.get_dialog_list()
+    tg_handler.current_state.dialog_list = tg_handler.get_dialog_list(refresh)
     # Clearing the message list and message details in the current state of the client
     # Очистка списка сообщений и деталей сообщений в текущем состоянии клиента
-    tg_handler.current_state.message_group_list = []
+    tg_handler.current_state.set_message_group_list([])
     tg_handler.current_state.message_details = None
     # Update list of dialogs and the dialog counter, clear list of messages, message details, and the message counter
     # Обновление списка диалогов и счетчика диалогов, очистка списка сообщений, деталей сообщения и счетчика сообщений
@@ -175,8 +251,9 @@ def tg_message_apply_filters():
     mess_filter.date_to = form.get(form_cfg['date_to'])
     mess_filter.message_query = form.get(form_cfg['message_query'])
     # Getting a list of messages using filters / Получение списка сообщений с применением фильтров
-    tg_handler.current_state.message_group_list = tg_handler.get_message_group_list(
-        tg_handler.current_state.selected_dialog_id)
+    tg_handler.current_state.set_message_group_list(tg_handler.get_message_group_list(
+        tg_handler.current_state.selected_dialog_id))
+    tg_check_saved_to_db(tg_handler.current_state.message_group_list)
     # Clearing the message details window / Очистка окна деталей сообщения
     tg_handler.current_state.message_details = None
     # Updating the message list, message counter, and clearing the message details
@@ -197,107 +274,19 @@ def tg_save_selected_message_to_db():
     # Получение из формы списка ID групп сообщений, отмеченных для сохранения
     selected_messages_ids = request.form.getlist(FormCfg.tg_checkbox_list['tg_checkbox_list'])
     selected_messages_ids = [x.replace(GlobalConst.select_in_telegram, '').strip() for x in selected_messages_ids]
-    # Processing the list of message groups in the current state of the client
-    # Обработка списка групп сообщений в текущего состояния клиента
-    for tg_message_group in tg_handler.current_state.message_group_list:
-        if tg_message_group.grouped_id in selected_messages_ids:
-            # If the message group ID is in the list marked for saving, save it to the database.
-            # Если ID группы сообщений находится в списке отмеченных для сохранения, сохраняем её в базе данных
-            if not db_handler.session.in_transaction():
-                db_handler.session.begin()
-            # Save or update the dialog / Сохраняем или обновляем диалог
-            tg_dialog = tg_handler.get_dialog_by_id(tg_message_group.dialog_id)
-            db_dialog = db_handler.upsert_record(DbDialog, {'dialog_id': tg_dialog.dialog_id},
-                                                 {'title': tg_dialog.title, 'dialog_type_id': tg_dialog.type.value})
-            # Set the relationship for the dialog if it is not already set
-            # Устанавливаем relationship для диалога, если не установлен
-            if db_dialog.dialog_type is None:
-                db_dialog.dialog_type = db_handler.session.query(DbDialogType).filter_by(
-                    dialog_type_id=tg_dialog.type.value).first()
-            # Saving a group of messages / Сохраняем группу сообщений
-            db_message_group = db_handler.upsert_record(DbMessageGroup, {'grouped_id': tg_message_group.grouped_id},
-                                                        {'date': tg_message_group.date,
-                                                         'text': tg_message_group.text,
-                                                         'truncated_text': tg_message_group.truncated_text,
-                                                         'files_report': tg_message_group.files_report,
-                                                         'from_id': tg_message_group.from_id,
-                                                         'dialog_id': tg_dialog.dialog_id})
-            # Set the relationship for the message group, if not already set
-            # Устанавливаем relationship для группы сообщений, если не установлен
-            if db_message_group.dialog is None:
-                db_message_group.dialog = db_dialog
-            # Save or update data about message files belonging to the group
-            # Сохраняем или обновляем данные о файлах сообщений, входящих в группу
-            status_messages.mess_update('Downloading files', '', new_list=True)
-            for tg_file in tg_message_group.files:
-                db_file = db_handler.upsert_record(DbFile, {'file_path': tg_file.file_path},
-                                                   {'message_id': tg_file.message_id,
-                                                    'size': tg_file.size,
-                                                    'grouped_id': tg_message_group.grouped_id,
-                                                    'file_type_id': tg_file.file_type.type_id})
-                # Set relationships for the file, if not already set
-                # Устанавливаем relationships для файла, если не установлено
-                if db_file.message_group is None:
-                    db_file.message_group = db_message_group
-                if db_file.file_type is None:
-                    db_file.file_type = db_handler.session.query(DbFileType).filter_by(
-                        file_type_id=tg_file.file_type.type_id).first()
-                # Download file if it is not in specified directory of the file system and its size is less than limit
-                # Скачиваем файл, если его нет в заданной директории файловой системы и его размер меньше предельного
-                status_messages.mess_update('Downloading files', tg_file.file_path)
-                downloading_result = tg_handler.download_message_file(tg_file)
-                report_msg = f'{tg_file.file_path} downloaded successfully' \
-                    if downloading_result else f'Failed to download file {tg_file.file_path}'
-                status_messages.mess_update('Downloading files', report_msg)
-            db_handler.session.flush()
-            # Get and save the HTML template with the message group content to save to a file
-            # Получаем и сохраняем HTML шаблон с контентом группы сообщений для сохранения в файл
-            message_group_export_data = db_message_group.get_export_data()
-            message_group_export_data.update({'files_report': tg_message_group.files_report})
-            # Correcting file paths so that they can be opened from an HTML file in the same directory
-            # Корректируем пути к файлам для возможности открытия из HTML файла в той же директории
-            for file in message_group_export_data.get('files', []):
-                file['file_name'] = Path(file['file_path']).name
-            # Generating paths to files and subdirectories in the file system
-            # Формирование пути к файлу и вложенных директорий в файловой системе
-            file_name = TgFile.get_self_file_name(tg_message_group.date, MessageFileTypes.CONTENT,
-                                                  tg_message_group.grouped_id, 0, MessageFileTypes.CONTENT.default_ext)
-            file_path = Path(
-                ProjectDirs.media_dir) / tg_dialog.get_self_dir() / tg_message_group.get_self_dir() / file_name
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            # Rendering HTML content for a file / Рендеринг HTML контента для файла
-            html_content = render_template('export_message.html', **message_group_export_data)
-            # Save the HTML file with the message content in the file system
-            # Сохраняем HTML файл с контентом сообщения в файловой системе
-            with open(file_path, 'w', encoding='utf-8') as cf:
-                cf.write(html_content)
-            # Create a record about the HTML file in the database for the corresponding message group
-            # Создаем запись о HTML файле в базе данных для соответствующей группы сообщений
-            db_file = db_handler.upsert_record(DbFile, {'file_path': file_path.as_posix()},
-                                               {'message_id': 0,
-                                                'size': len(html_content.encode('utf-8')),
-                                                'grouped_id': message_group_export_data.get('message_group_id'),
-                                                'file_type_id': MessageFileTypes.CONTENT.type_id})
-            # Set relationships for the file, if not already set
-            # Устанавливаем relationships для файла, если не установлено
-            if db_file.message_group is None:
-                db_file.message_group = db_message_group
-            if db_file.file_type is None:
-                db_file.file_type = db_handler.session.query(DbFileType).filter_by(
-                    file_type_id=MessageFileTypes.CONTENT.type_id).first()
-            # Save changes to the database / Сохраняем изменения в базе данных
-            db_handler.session.commit()
-            # After saving to the database, set the save flag for the message group
-            # После сохранения в БД устанавливаем признак сохранения для группы сообщений
-            tg_message_group.saved_to_db = True
-            # Updating the list of dialogs stored in the database / Обновляем список диалогов, сохраненных в базе данных
-            db_handler.all_dialogues_list = db_handler.get_dialog_list()
-            db_handler.current_state.dialog_list = db_handler.all_dialogues_list.copy()
-            # Set the save flag for message groups that are already saved in the database
-            # Устанавливаем признак сохранения для групп сообщений, которые уже сохранены в базе данных
-            # noinspection PyAssignmentToLoopOrWithParameter
-            for tg_message_group in tg_handler.current_state.message_group_list:
-                tg_message_group.saved_to_db = db_handler.message_group_exists(tg_message_group.grouped_id)
+    # Saving the message groups of the current state of the client that are marked for saving
+    # Сохранение отмеченных для сохранения групп сообщений текущего состояния клиента
+    selected_message_groups = [tg_message_group for tg_message_group in tg_handler.current_state.message_group_list
+                               if tg_message_group.grouped_id in selected_messages_ids]
+    downloading_results = save_message_groups_to_db(selected_message_groups)
+    # Set the save flag for message groups that are already saved in the database
+    # Устанавливаем признак сохранения для групп сообщений, которые уже сохранены в базе данных
+    tg_check_saved_to_db(tg_handler.current_state.message_group_list)
+    # Waiting for the queued files to be downloaded / Ожидание загрузки поставленных в очередь файлов
+    downloaded_files = [file_path for tg_message_group, result in zip(selected_message_groups, downloading_results)
+                        for file_path in tg_handler.wait_message_files(result, len(tg_message_group.files))]
+    status_messages.mess_update('Downloading files', f'Downloaded files: {len([x for x in downloaded_files if x])} '
+                                                     f'of {len(downloaded_files)}')
     # Update the message list, message counter, and dialogue list in the database dialogue filter
     # Обновление списка сообщений, счетчика сообщений и списка диалогов в фильтре диалогов базы данных
     return jsonify({'tg_messages': render_template('tg_messages.html'),
@@ -307,17 +296,57 @@ def tg_save_selected_message_to_db():
                                                                                'dialog_id', 'title')})
 
 
+@tg_saver.route('/tg_archive_range', methods=["POST"])
+def tg_archive_range():
+    """
+    Starting a job of archiving all messages of the current Telegram chat in the date range of the message filter
+    Запуск задания архивации всех сообщений текущего диалога Telegram за диапазон дат фильтра сообщений
+    """
+
+    form_cfg = FormCfg.tg_message_filter
+    dialog_id = tg_handler.current_state.selected_dialog_id
+    if dialog_id is None:
+        status_messages.mess_update('Archive job', 'Select a chat to archive')
+        return jsonify({})
+    tg_handler.start_archive_job(dialog_id, request.form.get(form_cfg['date_from']),
+                                 request.form.get(form_cfg['date_to']), archive_job_message_groups)
+    return jsonify({})
+
+
+@tg_saver.route('/tg_archive_cancel', methods=["POST"])
+def tg_archive_cancel():
+    """
+    Cancelling the running archive job
+    Отмена выполняемого задания архивации
+    """
+
+    if tg_handler.archive_job:
+        tg_handler.archive_job.cancel()
+    return jsonify({})
+
+
+@tg_saver.route('/tg_archive_status')
+def tg_archive_status():
+    """
+    Progress of the last archive job
+    Ход выполнения последнего задания архивации
+    """
+    return jsonify(tg_handler.archive_job.stats if tg_handler.archive_job else {})
+
+
 @tg_saver.route('/db_database_maintenance', methods=["POST"])
 def db_database_maintenance():
     """
     Database and file system maintenance
     Сервисное обслуживание базы данных и файловой системы
         1. Deleting files from the local file system that are not referenced in the database
-        2. Deleting empty directories from the local file system
+        2. Deleting media blobs that are not referenced by any saved file and empty directories from the local file
+           system
         3. Downloading files that are referenced in the database but are not present in the local file system
         4. Backing up the database
         5. Deleting unused dialogs from the database dialog table
         6. Recalculating the number of tag uses, deleting unused tags from the tag table
+        7. Rebuilding the search indexes of message texts and tag names
     """
 
     # Fetch all files with specified extensions from the database
@@ -344,6 +373,15 @@ def db_database_maintenance():
     files_deleted_count = len([Path(x).unlink() for x in files_to_delete if Path(x).exists()])
     status_messages.mess_update('Synchronizing the list of local files with the database',
                                 f'Files deleted from local storage: {files_deleted_count}', True)
+    # Delete the media blobs that are not referenced by any file from the database, then the blobs without a record
+    # and the content hash blobs of no remaining media from the local file system
+    # Удаляем из базы данных блобы медиа, на которые не ссылается ни один файл, затем из локальной файловой системы
+    # блобы без записи и блобы хэшей содержимого, не относящиеся ни к одному оставшемуся медиа
+    db_handler.delete_unused_media_blobs()
+    blobs_deleted_count, content_hashes = tg_handler.media_store.delete_unused_blobs(
+        db_handler.get_media_blob_hashes())
+    db_handler.save_media_blob_hashes(content_hashes)
+    status_messages.mess_update('', f'Unused media blobs deleted from local storage: {blobs_deleted_count}')
     # Delete empty directories / Удаляем пустые директории
     dir_tree = sorted(Path.walk(Path(ProjectDirs.media_dir)), key=lambda x: len(x[0].as_posix()), reverse=True)
     dir_deleted_count = len([x[0].rmdir() for x in dir_tree if
@@ -373,6 +411,9 @@ def db_database_maintenance():
     # Update list of tags in database, sorting them according to current settings and recalculating the number of uses
     # Обновление списка тегов в базе данных с сортировкой по текущим установкам и пересчетом количества использований
     db_handler.all_tags_list = db_handler.get_all_tag_list()
+    # Rebuilding the search indexes of message texts and tag names
+    # Перестроение поисковых индексов текстов сообщений и названий тегов
+    db_handler.rebuild_search_indexes()
     # Creating a data structure for updating dialogue lists and tags in a database form
     # Формирование структуры данных для обновления списков диалогов и тегов в форме базы данных
     data_structure = {FormCfg.db_message_filter.get('dialog_select'): db_handler.get_select_content_string(
@@ -500,6 +541,9 @@ def db_delete_selected_from_database():
     stmt = delete(DbMessageGroup).where(DbMessageGroup.grouped_id.in_(selected_messages_id))
     db_handler.session.execute(stmt)
     db_handler.session.commit()
+    # The save flags of the cached Telegram message groups are checked again
+    # Признаки сохранения кэшированных групп сообщений Telegram проверяются заново
+    tg_handler.message_group_cache.invalidate()
     # Updating the message list after deletion from the database
     # Обновление списка сообщений после удаления из базы данных
     db_handler.current_state.message_group_list = db_handler.get_message_group_list()
@@ -639,6 +683,229 @@ def db_all_tag_sorting():
                         db_handler.get_select_content_string(db_handler.all_tags_list, 'id', 'name')})
 
 
+def tg_check_saved_to_db(tg_message_groups: list[TgMessageGroup] | None):
+    """
+    Setting the save flag of message groups whose saving status has not been checked yet, with one database query
+    per batch of groups
+    Установка признака сохранения групп сообщений, статус сохранения которых еще не проверен, одним запросом
+    к базе данных на пакет групп
+    Attributes:
+        tg_message_groups (list[TgMessageGroup] | None): message groups
+    """
+
+    unchecked_groups = [tg_message_group for tg_message_group in tg_message_groups or []
+                        if tg_message_group.saved_to_db is None]
+    saved_ids = db_handler.get_existing_message_group_ids([x.grouped_id for x in unchecked_groups])
+    for tg_message_group in unchecked_groups:
+        tg_message_group.saved_to_db = tg_message_group.grouped_id in saved_ids
+
+
+def save_message_group_content(tg_message_group: TgMessageGroup, message_group_date: datetime, dialog_dir: str,
+                               db_message_group: DbMessageGroup, session: Session) -> None:
+    """
+    Saving the HTML file with the content of a message group to the file system and its record to the database
+    Сохранение HTML файла с контентом группы сообщений в файловой системе и его записи в базе данных
+    Attributes:
+        tg_message_group (TgMessageGroup): message group
+        message_group_date (datetime): date of the message group
+        dialog_dir (str): subdirectory of the dialog of the message group
+        db_message_group (DbMessageGroup): saved message group
+        session (Session): session of the calling thread
+    """
+
+    # Get and save the HTML template with the message group content to save to a file
+    # Получаем и сохраняем HTML шаблон с контентом группы сообщений для сохранения в файл
+    message_group_export_data = db_message_group.get_export_data()
+    message_group_export_data.update({'files_report': tg_message_group.files_report})
+    # Correcting file paths so that they can be opened from an HTML file in the same directory
+    # Корректируем пути к файлам для возможности открытия из HTML файла в той же директории
+    for file in message_group_export_data.get('files', []):
+        file['file_name'] = Path(file['file_path']).name
+    # Generating paths to files and subdirectories in the file system
+    # Формирование пути к файлу и вложенных директорий в файловой системе
+    file_name = TgFile.get_self_file_name(message_group_date, MessageFileTypes.CONTENT,
+                                          tg_message_group.grouped_id, 0, MessageFileTypes.CONTENT.default_ext)
+    file_path = Path(ProjectDirs.media_dir) / dialog_dir / tg_message_group.get_self_dir() / file_name
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Rendering HTML content for a file / Рендеринг HTML контента для файла
+    html_content = render_template('export_message.html', **message_group_export_data)
+    # Save the HTML file with the message content in the file system
+    # Сохраняем HTML файл с контентом сообщения в файловой системе
+    with open(file_path, 'w', encoding='utf-8') as cf:
+        cf.write(html_content)
+    # Create a record about the HTML file in the database for the corresponding message group
+    # Создаем запись о HTML файле в базе данных для соответствующей группы сообщений
+    db_file = db_handler.upsert_record(DbFile, {'file_path': file_path.as_posix()},
+                                       {'message_id': 0,
+                                        'size': len(html_content.encode('utf-8')),
+                                        'grouped_id': message_group_export_data.get('message_group_id'),
+                                        'file_type_id': MessageFileTypes.CONTENT.type_id}, session)
+    # Set relationships for the file, if not already set
+    # Устанавливаем relationships для файла, если не установлено
+    if db_file.message_group is None:
+        db_file.message_group = db_message_group
+    if db_file.file_type is None:
+        db_file.file_type = session.query(DbFileType).filter_by(
+            file_type_id=MessageFileTypes.CONTENT.type_id).first()
+
+
+def save_message_groups_to_db(tg_message_groups: list[TgMessageGroup],
+                              session: Session | None = None) -> list[Future]:
+    """
+    Saving Telegram message groups in the database in one transaction and queuing their files for downloading.
+    Called from request handlers with the shared session and from the archiver threads with their own sessions,
+    so saving is serialized by the lock. Message groups without a date or with an unknown dialog are skipped.
+    Сохранение групп сообщений Telegram в базе данных одной транзакцией и постановка их файлов в очередь загрузки.
+    Вызывается из обработчиков запросов с общей сессией и из потоков архиваторов с собственными сессиями, поэтому
+    сохранение сериализуется блокировкой. Группы сообщений без даты или с неизвестным диалогом пропускаются.
+    Attributes:
+        tg_message_groups (list[TgMessageGroup]): message groups to save
+        session (Session | None): session of the calling thread, the shared session of the database handler if None
+    Returns:
+        list[Future]: futures with the results of downloading the files of each message group, the files of skipped
+            message groups are not downloaded
+    """
+
+    session = session or db_handler.session
+    saved_message_groups: list[TgMessageGroup] = []
+    with save_lock:
+        for tg_message_group in tg_message_groups:
+            tg_dialog = tg_handler.get_dialog_by_id(tg_message_group.dialog_id)
+            message_group_date = tg_message_group.date
+            if tg_dialog is None or message_group_date is None:
+                status_messages.mess_update('Saving messages', f'Message group {tg_message_group.grouped_id} is '
+                                                               f'skipped: its dialog or date is unknown')
+                continue
+            if not session.in_transaction():
+                session.begin()
+            # Save or update the dialog / Сохраняем или обновляем диалог
+            db_dialog = db_handler.upsert_record(DbDialog, {'dialog_id': tg_dialog.dialog_id},
+                                                 {'title': tg_dialog.title, 'dialog_type_id': tg_dialog.type.value},
+                                                 session)
+            # Set the relationship for the dialog if it is not already set
+            # Устанавливаем relationship для диалога, если не установлен
+            if db_dialog.dialog_type is None:
+                db_dialog.dialog_type = session.query(DbDialogType).filter_by(
+                    dialog_type_id=tg_dialog.type.value).first()
+            # Saving a group of messages / Сохраняем группу сообщений
+            db_message_group = db_handler.upsert_record(DbMessageGroup, {'grouped_id': tg_message_group.grouped_id},
+                                                        {'date': tg_message_group.date,
+                                                         'text': tg_message_group.text,
+                                                         'truncated_text': tg_message_group.truncated_text,
+                                                         'files_report': tg_message_group.files_report,
+                                                         'from_id': tg_message_group.from_id,
+                                                         'dialog_id': tg_dialog.dialog_id}, session)
+            # Set the relationship for the message group, if not already set
+            # Устанавливаем relationship для группы сообщений, если не установлен
+            if db_message_group.dialog is None:
+                db_message_group.dialog = db_dialog
+            # Save or update data about message files belonging to the group
+            # Сохраняем или обновляем данные о файлах сообщений, входящих в группу
+            status_messages.mess_update('Downloading files', '', new_list=True)
+            for tg_file in tg_message_group.files:
+                # The files of the same media in different chats refer to one blob
+                # Файлы одного медиа в разных диалогах ссылаются на один блоб
+                if tg_file.media_id:
+                    db_handler.upsert_record(DbMediaBlob, {'media_id': tg_file.media_id},
+                                             {'blob_path': TgMediaStore.get_blob_file_path(tg_file.media_id),
+                                              'size': tg_file.size}, session)
+                db_file = db_handler.upsert_record(DbFile, {'file_path': tg_file.file_path},
+                                                   {'message_id': tg_file.message_id,
+                                                    'size': tg_file.size,
+                                                    'grouped_id': tg_message_group.grouped_id,
+                                                    'file_type_id': tg_file.file_type.type_id,
+                                                    'media_id': tg_file.media_id or None}, session)
+                # Set relationships for the file, if not already set
+                # Устанавливаем relationships для файла, если не установлено
+                if db_file.message_group is None:
+                    db_file.message_group = db_message_group
+                if db_file.file_type is None:
+                    db_file.file_type = session.query(DbFileType).filter_by(
+                        file_type_id=tg_file.file_type.type_id).first()
+            session.flush()
+            save_message_group_content(tg_message_group, message_group_date, tg_dialog.get_self_dir(),
+                                       db_message_group, session)
+            saved_message_groups.append(tg_message_group)
+        # Save changes of all message groups to the database in one transaction
+        # Сохраняем изменения всех групп сообщений в базе данных одной транзакцией
+        session.commit()
+        # After saving to the database, the cached message groups of the dialogs are checked again, and the save
+        # flag is set for the saved message groups
+        # После сохранения в БД кэшированные группы сообщений диалогов проверяются заново, а для сохраненных групп
+        # сообщений устанавливается признак сохранения
+        tg_handler.message_group_cache.invalidate({x.dialog_id for x in tg_message_groups})
+        for tg_message_group in saved_message_groups:
+            tg_message_group.saved_to_db = True
+        # Updating the list of dialogs stored in the database, the objects of the list belong to the shared session,
+        # so after saving in another session the list is updated by the next request
+        # Обновляем список диалогов, сохраненных в базе данных, объекты списка принадлежат общей сессии, поэтому
+        # после сохранения в другой сессии список обновляется следующим запросом
+        if session is db_handler.session:
+            db_handler.all_dialogues_list = db_handler.get_dialog_list()
+            db_handler.current_state.dialog_list = db_handler.all_dialogues_list.copy()
+        else:
+            db_handler.dialog_list_outdated = True
+    # Queue files for downloading if they are not in the file system and their size is less than limit.
+    # The messages of the files of all message groups are requested together in batches.
+    # Images are downloaded before videos and documents, regardless of the order of the messages.
+    # Ставим в очередь загрузки файлы, которых нет в файловой системе и размер которых меньше предельного.
+    # Сообщения файлов всех групп сообщений запрашиваются вместе пакетами.
+    # Изображения загружаются раньше видео и документов, независимо от порядка сообщений.
+    file_messages = tg_handler.get_file_messages([x for tg_message_group in saved_message_groups
+                                                  for x in tg_message_group.files])
+    saved_ids = {tg_message_group.grouped_id for tg_message_group in saved_message_groups}
+    return [tg_handler.queue_message_files(tg_message_group.files if tg_message_group.grouped_id in saved_ids else [],
+                                           file_messages=file_messages)
+            for tg_message_group in tg_message_groups]
+
+
+def archive_message_groups(tg_message_groups: list[TgMessageGroup]):
+    """
+    Saving a batch of message groups received by the live archiver, called in a worker thread
+    Сохранение пакета групп сообщений, полученных живым архиватором, вызывается в рабочем потоке
+    Attributes:
+        tg_message_groups (list[TgMessageGroup]): message groups to save
+    """
+
+    # Rendering of the HTML files of message groups requires the application context
+    # Рендеринг HTML файлов групп сообщений требует контекста приложения
+    # Each batch is saved in its own session of the worker thread
+    # Каждый пакет сохраняется в собственной сессии рабочего потока
+    with tg_saver.app_context(), db_handler.session_factory() as session:
+        try:
+            save_message_groups_to_db(tg_message_groups, session)
+        except SQLAlchemyError as error:
+            session.rollback()
+            status_messages.mess_update('Live archiver', f'Failed to save new messages: {error}')
+            return
+    status_messages.mess_update('Live archiver', f'{len(tg_message_groups)} new message groups saved')
+
+
+def archive_job_message_groups(tg_message_groups: list[TgMessageGroup]) -> list[Future] | None:
+    """
+    Saving a batch of message groups of the archive job, called in the thread of the job
+    Сохранение пакета групп сообщений задания архивации, вызывается в потоке задания
+    Attributes:
+        tg_message_groups (list[TgMessageGroup]): message groups to save
+    Returns:
+        list[Future] | None: futures with the results of downloading the files, None if the batch was not saved
+    """
+
+    # Each batch is saved in its own session of the job thread
+    # Каждый пакет сохраняется в собственной сессии потока задания
+    with tg_saver.app_context(), db_handler.session_factory() as session:
+        try:
+            return save_message_groups_to_db(tg_message_groups, session)
+        except SQLAlchemyError as error:
+            session.rollback()
+            status_messages.mess_update('Archive job', f'Failed to save message groups: {error}')
+            return None
+
+
+# Starting the live archiver of the chats set in the Telegram settings file
+# Запуск живого архиватора диалогов, заданных в файле настроек Telegram
+tg_handler.start_archiver(archive_message_groups)
+
 if __name__ == '__main__':
     tg_saver.run(debug=True, use_reloader=False)
 
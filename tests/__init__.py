@@ -0,0 +1,4 @@
+"""
+Tests of the program, run with pytest from the project directory
+Тесты программы, запускаются pytest из директории проекта
+"""
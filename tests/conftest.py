@@ -0,0 +1,23 @@
+"""
+Common settings of the tests: the database, the media and the Telegram settings file of the offline client backend
+are created in a temporary directory before the modules of the program are imported, since the database handler and
+the Telegram handler are created when their modules are imported
+Общие настройки тестов: база данных, медиа и файл настроек Telegram автономного бэкенда клиента создаются во
+временной директории до импорта модулей программы, так как обработчики базы данных и Telegram создаются при импорте
+их модулей
+"""
+
+import tempfile
+from pathlib import Path
+from configs.config import ProjectDirs
+
+test_dir = Path(tempfile.mkdtemp(prefix='telegram_saver_tests_'))
+ProjectDirs.data_base_dir = test_dir / 'database'
+ProjectDirs.data_base_dir.mkdir()
+ProjectDirs.data_base_file = ProjectDirs.data_base_dir / 'telegram_archive_test.db'
+ProjectDirs.media_dir = (test_dir / 'media').as_posix()
+# The offline backend requires neither API keys nor account credentials
+# Автономному бэкенду не требуются ни ключи API, ни учетные данные аккаунта
+ProjectDirs.telegram_settings_file = test_dir / '.env_test'
+ProjectDirs.telegram_settings_file.write_text('SESSION_NAME=test\nPOOL_SESSION_NAMES=test_pool\nCLIENT_BACKEND=fake\n',
+                                              encoding='utf-8')
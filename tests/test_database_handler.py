@@ -0,0 +1,106 @@
+"""
+Tests of the database handler: the access paths of the archive use indexes and the full-text index follows the rows
+of its table
+Тесты обработчика базы данных: пути доступа архива используют индексы, а полнотекстовый индекс следует за строками
+своей таблицы
+"""
+
+import re
+import pytest
+from configs.config import TableNames
+from database_handler import db_handler
+
+# Tables that grow with the archive / Таблицы, растущие вместе с архивом
+WATCHED_TABLES = {TableNames.message_groups, TableNames.message_group_tag_links, TableNames.files}
+INDEXED_ACCESS_PATHS = ['dialog and date filter', 'date filter', 'sorting by date', 'sorting by dialog title',
+                        'tag filter', 'dialogs of message groups', 'tag usage count', 'files of a message group']
+
+
+@pytest.fixture(scope='module', name='query_plans')
+def fixture_query_plans() -> dict[str, list[str]]:
+    """
+    EXPLAIN QUERY PLAN lines of the access paths by query names
+    Строки EXPLAIN QUERY PLAN путей доступа по именам запросов
+    """
+    return db_handler.get_query_plans()
+
+
+def get_watched_lines(plan: list[str]) -> list[str]:
+    """
+    Returns the plan lines reading the tables that grow with the archive
+    Возвращает строки плана, читающие таблицы, растущие вместе с архивом
+    """
+    return [line for line in plan if (access := re.match(r'(?:SCAN|SEARCH) (\w+)', line))
+            and access.group(1) in WATCHED_TABLES]
+
+
+@pytest.mark.parametrize('query_name', INDEXED_ACCESS_PATHS)
+def test_access_path_uses_index(query_plans, query_name):
+    """
+    The access path reads the growing tables only through indexes
+    Путь доступа читает растущие таблицы только через индексы
+    """
+
+    watched_lines = get_watched_lines(query_plans[query_name])
+    assert watched_lines, query_plans[query_name]
+    for line in watched_lines:
+        assert re.search(r'USING (COVERING )?INDEX', line), line
+
+
+def test_text_filter_uses_full_text_index(query_plans):
+    """
+    The text filter of messages searches the full-text index
+    Фильтр сообщений по тексту ищет в полнотекстовом индексе
+    """
+
+    assert db_handler.full_text_search
+    plan = query_plans['text filter']
+    assert any(line.startswith(f'SCAN {TableNames.message_groups_fts} VIRTUAL TABLE INDEX') for line in plan), plan
+    for line in get_watched_lines(plan):
+        assert re.search(r'USING (COVERING )?INDEX|USING INTEGER PRIMARY KEY', line), line
+
+
+def test_verify_query_plans_finds_no_full_scans():
+    """
+    The check of query plans at startup reports no full scans of the growing tables
+    Проверка планов запросов при запуске не сообщает о полных просмотрах растущих таблиц
+    """
+
+    assert not db_handler.verify_query_plans()
+
+
+def test_renumbered_message_groups_are_indexed_again():
+    """
+    The full-text index is rebuilt at startup if the rowid of message groups was renumbered
+    Полнотекстовый индекс перестраивается при запуске, если rowid групп сообщений были перенумерованы
+    """
+
+    def find_message_groups(word: str) -> list[str]:
+        with db_handler.engine.connect() as connection:
+            return list(connection.exec_driver_sql(
+                f'SELECT grouped_id FROM {TableNames.message_groups_fts} JOIN {TableNames.message_groups} '
+                f'ON {TableNames.message_groups}.rowid = {TableNames.message_groups_fts}.rowid '
+                f'WHERE {TableNames.message_groups_fts} MATCH ?', (word,)).scalars())
+
+    with db_handler.engine.begin() as connection:
+        connection.exec_driver_sql(f'INSERT INTO {TableNames.dialogs}(dialog_id, title, dialog_type_id) '
+                                   f"SELECT -1, 'Renumbered', min(dialog_type_id) FROM {TableNames.dialog_types}")
+        for grouped_id, message_text in (('renumbered_1', 'alpha'), ('renumbered_2', 'beta'),
+                                         ('renumbered_3', 'gamma')):
+            connection.exec_driver_sql(f'INSERT INTO {TableNames.message_groups}(grouped_id, text, selected, date, '
+                                       f"dialog_id) VALUES (?, ?, 0, '2024-01-01', -1)", (grouped_id, message_text))
+        # Renumbering of the rows after a gap, as when the table is copied
+        # Перенумерация строк после пропуска, как при копировании таблицы
+        free_rowid = connection.exec_driver_sql(f"SELECT rowid FROM {TableNames.message_groups} "
+                                                f"WHERE grouped_id = 'renumbered_2'").scalar()
+        connection.exec_driver_sql(f"DELETE FROM {TableNames.message_groups} WHERE grouped_id = 'renumbered_2'")
+        connection.exec_driver_sql(f"UPDATE {TableNames.message_groups} SET rowid = ? "
+                                   f"WHERE grouped_id = 'renumbered_3'", (free_rowid,))
+    assert not find_message_groups('gamma')
+    assert not db_handler.is_search_index_in_sync(TableNames.message_groups_fts, TableNames.message_groups)
+    db_handler.setup_search_indexes()
+    assert db_handler.is_search_index_in_sync(TableNames.message_groups_fts, TableNames.message_groups)
+    assert find_message_groups('gamma') == ['renumbered_3']
+    with db_handler.engine.begin() as connection:
+        connection.exec_driver_sql(f'DELETE FROM {TableNames.message_groups} WHERE dialog_id = -1')
+        connection.exec_driver_sql(f'DELETE FROM {TableNames.dialogs} WHERE dialog_id = -1')
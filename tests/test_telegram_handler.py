@@ -0,0 +1,375 @@
+"""
+Tests of the Telegram handler with the offline client backend: grouping of messages, incremental refresh of
+a dialog and downloading of message files
+Тесты обработчика Telegram с автономным бэкендом клиента: группировка сообщений, инкрементальное обновление
+диалога и загрузка файлов сообщений
+"""
+
+from asyncio import gather, sleep
+from hashlib import sha256
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from pathlib import Path
+from time import sleep as sleep_thread
+import pytest
+from telethon.tl.types import Document, MessageMediaDocument
+from configs.config import GlobalConst, MessageFileTypes, ProjectDirs
+import telegram_handler
+from telegram_handler import TgArchiveJob, TgDateBoundaryCache, TgDownloadQueue, TgFile, TgMediaStore, \
+    TgMessageGroupCache, tg_handler
+from database_handler import db_handler
+from fake_telegram import FakeTelegramClient
+
+# The caches of the Telegram handler are shared, so each test gets its own dialog
+# Кэши обработчика Telegram общие, поэтому каждый тест получает собственный диалог
+dialog_ids = count(-1001, -1)
+
+
+def make_document(document_id: int, size: int) -> MessageMediaDocument:
+    """
+    Returns the media of a PDF document of the specified size
+    Возвращает медиа PDF документа заданного размера
+    """
+    return MessageMediaDocument(document=Document(id=document_id, access_hash=1, file_reference=b'', date=None,
+                                                  mime_type='application/pdf', size=size, dc_id=1, attributes=[]))
+
+
+def get_fake_client() -> FakeTelegramClient:
+    """
+    Returns the offline client wrapped by the rate limiter of the primary session
+    Возвращает автономный клиент, обернутый ограничителем частоты основной сессии
+    """
+    return tg_handler.client.client
+
+
+def raise_rate_limits(monkeypatch: pytest.MonkeyPatch, rate: int) -> None:
+    """
+    Raises the request rate limits of all sessions of the pool for the duration of a test
+    Повышает ограничения частоты запросов всех сессий пула на время теста
+    """
+    for session in tg_handler.client_pool.clients:
+        monkeypatch.setattr(session.limiter, 'rate', float(rate))
+        monkeypatch.setattr(session.limiter, 'max_rate', float(rate))
+        monkeypatch.setattr(session.limiter, 'burst', rate)
+
+
+@pytest.fixture(name='dialog_id')
+def fixture_dialog_id() -> int:
+    """
+    ID of a new dialog of three single messages and an album of three documents
+    ID нового диалога из трех одиночных сообщений и альбома из трех документов
+    """
+
+    dialog_id = next(dialog_ids)
+    fake_client = get_fake_client()
+    fake_client.add_dialog(dialog_id, f'Vacancies {dialog_id}', is_channel=True, is_user=False)
+    start_date = datetime.now(timezone.utc) - timedelta(days=1)
+    for message_number in range(3):
+        fake_client.add_message(dialog_id, f'Python developer {message_number}',
+                                start_date + timedelta(minutes=message_number))
+    for document_number in range(3):
+        fake_client.add_message(dialog_id, 'Album' if document_number == 0 else '',
+                                start_date + timedelta(minutes=10), grouped_id=777,
+                                media=make_document(100 * -dialog_id + document_number, 3000 + document_number))
+    tg_handler.refresh_dialog_catalogue()
+    return dialog_id
+
+
+def test_offline_backend_starts_without_credentials(dialog_id):
+    """
+    The sessions of the offline backend start without account credentials and list the dialogs
+    Сессии автономного бэкенда запускаются без учетных данных аккаунта и выводят список диалогов
+    """
+
+    assert all(session.client.requests['start'] == 1 for session in tg_handler.client_pool.clients)
+    assert tg_handler.get_dialog_by_id(dialog_id).title == f'Vacancies {dialog_id}'
+
+
+def test_album_messages_form_one_group(dialog_id):
+    """
+    The messages of an album form one message group with the files of all its messages
+    Сообщения альбома образуют одну группу сообщений с файлами всех его сообщений
+    """
+
+    message_groups = {message_group.grouped_id: message_group
+                      for message_group in tg_handler.get_message_group_list(dialog_id)}
+    assert len(message_groups) == 4
+    album = message_groups[f'{dialog_id}_777']
+    assert album.ids == [4, 5, 6]
+    assert album.text == 'Album'
+    assert [tg_file.size for tg_file in album.files] == [3000, 3001, 3002]
+
+
+def test_incremental_refresh_requests_only_new_messages(dialog_id, monkeypatch):
+    """
+    A refresh of a cached dialog requests only new messages, and a new message of an album forms the album anew
+    Обновление кэшированного диалога запрашивает только новые сообщения, а новое сообщение альбома формирует
+    альбом заново
+    """
+
+    tg_handler.get_message_group_list(dialog_id)
+    fake_client = get_fake_client()
+    fake_client.add_message(dialog_id, 'Python developer 3')
+    # The messages of the dialog are requested by the session of the pool assigned to it
+    # Сообщения диалога запрашиваются сессией пула, назначенной ему
+    session_client = tg_handler.client_pool.get_client(dialog_id).client
+    min_ids = []
+    filter_messages = session_client.filter_messages
+
+    def spy_filter_messages(*args, **kwargs):
+        min_ids.append(kwargs.get('min_id', 0))
+        return filter_messages(*args, **kwargs)
+
+    monkeypatch.setattr(session_client, 'filter_messages', spy_filter_messages)
+    message_groups = tg_handler.get_message_group_list(dialog_id)
+    assert min_ids == [6]
+    assert len(message_groups) == 5
+    # A new message of a cached album forms the album anew
+    # Новое сообщение кэшированного альбома формирует альбом заново
+    fake_client.add_message(dialog_id, '', grouped_id=777, media=make_document(100 * -dialog_id + 3, 3003))
+    message_groups = {message_group.grouped_id: message_group
+                      for message_group in tg_handler.get_message_group_list(dialog_id)}
+    assert message_groups[f'{dialog_id}_777'].ids == [4, 5, 6, 8]
+    assert len(message_groups) == 5
+
+
+def test_message_groups_are_restored_after_restart(dialog_id, monkeypatch):
+    """
+    The message groups received before a restart are restored from the storage, and only new messages are requested
+    Группы сообщений, полученные до перезапуска, восстанавливаются из хранилища, и запрашиваются только новые сообщения
+    """
+
+    monkeypatch.setattr(tg_handler, 'storage', db_handler)
+    album_files = {message_group.grouped_id: message_group
+                   for message_group in tg_handler.get_message_group_list(dialog_id)}[f'{dialog_id}_777'].files
+    db_handler.background_writer.submit(lambda: None).result()
+    assert db_handler.get_sync_state(dialog_id)[0] == 6
+    # A restart leaves the cache of message group lists empty
+    # Перезапуск оставляет кэш списков групп сообщений пустым
+    monkeypatch.setattr(tg_handler, 'message_group_cache', TgMessageGroupCache())
+    get_fake_client().add_message(dialog_id, 'Python developer 3')
+    session_client = tg_handler.client_pool.get_client(dialog_id).client
+    min_ids = []
+    filter_messages = session_client.filter_messages
+
+    def spy_filter_messages(*args, **kwargs):
+        min_ids.append(kwargs.get('min_id', 0))
+        return filter_messages(*args, **kwargs)
+
+    monkeypatch.setattr(session_client, 'filter_messages', spy_filter_messages)
+    message_groups = {message_group.grouped_id: message_group
+                      for message_group in tg_handler.get_message_group_list(dialog_id)}
+    assert min_ids == [6]
+    assert len(message_groups) == 5
+    assert message_groups[f'{dialog_id}_777'].files == album_files
+    db_handler.background_writer.submit(lambda: None).result()
+    assert db_handler.get_sync_state(dialog_id)[0] == 7
+    assert len(db_handler.get_sync_message_groups(dialog_id)) == 5
+
+
+def test_download_message_files(dialog_id):
+    """
+    Message files are downloaded in full and are not downloaded again
+    Файлы сообщений загружаются полностью и не загружаются повторно
+    """
+
+    tg_files = [tg_file for message_group in tg_handler.get_message_group_list(dialog_id)
+                for tg_file in message_group.files]
+    file_paths = tg_handler.download_message_files(tg_files)
+    assert all(file_paths)
+    for tg_file in tg_files:
+        assert (Path(ProjectDirs.media_dir) / tg_file.file_path).stat().st_size == tg_file.size
+        assert tg_file.is_exists()
+    assert tg_handler.download_queue.stats['downloaded'] >= len(tg_files)
+    # Downloaded files are not downloaded again / Загруженные файлы не загружаются повторно
+    iter_download_requests = sum(session.client.requests['iter_download'] for session in tg_handler.client_pool.clients)
+    assert all(tg_handler.download_message_files(tg_files))
+    assert sum(session.client.requests['iter_download']
+               for session in tg_handler.client_pool.clients) == iter_download_requests
+    assert GlobalConst.partial_file_suffix not in ''.join(path.name for path in Path(ProjectDirs.media_dir).rglob('*'))
+
+
+def test_large_dialog_is_grouped_in_chunks(monkeypatch):
+    """
+    Messages of a large dialog are grouped as they arrive in chunks, and the first group is yielded without waiting
+    Сообщения большого диалога группируются по мере поступления фрагментами, первая группа выдается без ожидания
+    """
+
+    dialog_id = next(dialog_ids)
+    fake_client = get_fake_client()
+    fake_client.add_dialog(dialog_id, f'Archive {dialog_id}', is_channel=True, is_user=False)
+    # 100 000 messages, every 40 messages start with two albums of four messages. Album IDs are large as in
+    # Telegram, so they do not coincide with message IDs.
+    # 100 000 сообщений, каждые 40 сообщений начинаются с двух альбомов из четырех сообщений. ID альбомов
+    # большие, как в Telegram, поэтому не совпадают с ID сообщений.
+    message_count = 100_000
+    start_date = datetime.now(timezone.utc) - timedelta(days=2)
+    for message_number in range(message_count):
+        fake_client.add_message(dialog_id, f'Message {message_number}', start_date + timedelta(seconds=message_number),
+                                grouped_id=10 ** 12 + message_number // 4 if message_number % 40 < 8 else None)
+    tg_handler.refresh_dialog_catalogue()
+    raise_rate_limits(monkeypatch, message_count)
+    # Messages are passed from the event loop thread in batches, not one at a time
+    # Сообщения передаются из потока цикла событий пакетами, а не по одному
+    run_sync_calls = []
+    run_sync = telegram_handler.run_sync
+
+    def spy_run_sync(coroutine):
+        run_sync_calls.append(coroutine)
+        return run_sync(coroutine)
+
+    monkeypatch.setattr(telegram_handler, 'run_sync', spy_run_sync)
+    session_client = tg_handler.client_pool.get_client(dialog_id).client
+    iter_messages_requests = session_client.requests['iter_messages']
+    message_groups = tg_handler.iter_message_group_list(dialog_id)
+    first_group = next(message_groups)
+    # The first group is yielded after the first chunks, not after the whole dialog is loaded
+    # Первая группа выдается после первых фрагментов, а не после загрузки всего диалога
+    assert session_client.requests['iter_messages'] - iter_messages_requests <= 3
+    group_sizes = [len(first_group.ids)] + [len(message_group.ids) for message_group in message_groups]
+    album_count = message_count // 40 * 2
+    assert len(group_sizes) == message_count - album_count * 3
+    assert group_sizes.count(4) == album_count
+    assert sum(group_sizes) == message_count
+    assert len(run_sync_calls) < message_count // GlobalConst.message_chunk_size * 2
+
+
+def test_prioritize_moves_only_queued_files():
+    """
+    Prioritizing moves the queued files of a viewed message to the head of the queue without queuing new ones
+    Приоритизация перемещает файлы просматриваемого сообщения из очереди в ее начало без постановки новых
+    """
+
+    download_queue = TgDownloadQueue(worker_count=1)
+    tg_files = {file_name: TgFile(0, '', 0, '', file_name, file_name, '', 100, MessageFileTypes.PHOTO)
+                for file_name in ('first', 'second', 'third', 'viewed', 'not_queued')}
+    download_order = []
+
+    async def download(tg_file: TgFile, _message) -> str:
+        download_order.append(tg_file.file_path)
+        await sleep(0.01)
+        return tg_file.file_path
+
+    async def queue_and_view() -> tuple[int, dict[str, int], list[str | None]]:
+        results = [download_queue.put(tg_files[file_name], download)
+                   for file_name in ('first', 'second', 'third', 'viewed')]
+        # The first file is being downloaded, the others are waiting / Первый файл загружается, остальные ждут
+        await sleep(0)
+        prioritized_count = download_queue.prioritize([tg_files['viewed'], tg_files['not_queued']])
+        stats = download_queue.stats
+        file_paths = list(await gather(*results))
+        # The workers of the test queue are stopped / Обработчики тестовой очереди останавливаются
+        for worker in download_queue._workers:  # pylint: disable=protected-access
+            worker.cancel()
+        return prioritized_count, stats, file_paths
+
+    prioritized_count, stats, file_paths = telegram_handler.run_sync(queue_and_view())
+    assert prioritized_count == 1
+    assert stats['queued'] == 3
+    assert download_order == ['first', 'viewed', 'second', 'third']
+    assert file_paths == ['first', 'second', 'third', 'viewed']
+
+
+def test_download_worker_survives_unexpected_error():
+    """
+    An unexpected error fails only its file, and the worker downloads the rest of the queue
+    Непредвиденная ошибка завершает неудачей только свой файл, и обработчик загружает остаток очереди
+    """
+
+    download_queue = TgDownloadQueue(worker_count=1)
+    tg_files = [TgFile(0, '', 0, '', file_name, file_name, '', 100, MessageFileTypes.PHOTO)
+                for file_name in ('broken', 'next')]
+
+    async def download(tg_file: TgFile, _message) -> str:
+        if tg_file.file_path == 'broken':
+            raise TypeError('unexpected media')
+        return tg_file.file_path
+
+    async def queue_all() -> list[str | None]:
+        file_paths = list(await gather(*[download_queue.put(tg_file, download) for tg_file in tg_files]))
+        for worker in download_queue._workers:  # pylint: disable=protected-access
+            worker.cancel()
+        return file_paths
+
+    assert telegram_handler.run_sync(queue_all()) == [None, 'next']
+    assert download_queue.stats['failed'] == 1
+
+
+def test_date_boundary_cache_merges_and_caps_anchors():
+    """
+    Anchors of received ranges are merged, boundaries are found only inside them, and their number is capped
+    Опорные точки полученных диапазонов объединяются, границы находятся только внутри них, а их число ограничено
+    """
+
+    date_boundary_cache = TgDateBoundaryCache(max_anchors=60)
+    # Message N of the dialog was sent at 10 * N seconds / Сообщение N диалога отправлено в 10 * N секунд
+    for first_id, last_id in ((50, 60), (10, 20), (30, 40), (15, 35), (70, 75)):
+        date_boundary_cache.add_anchors(0, [(10 * message_id, message_id)
+                                            for message_id in range(first_id, last_id + 1)])
+    # Received ranges 10-40, 50-60 and 70-75 / Полученные диапазоны 10-40, 50-60 и 70-75
+    for date_seconds, reverse, boundary in ((205, False, 20), (205, True, 21), (400, False, 39), (400, True, 40),
+                                            (505, True, 51), (455, True, None), (745, False, 74)):
+        assert date_boundary_cache.get_boundary(0, datetime.fromtimestamp(date_seconds, timezone.utc),
+                                                reverse) == boundary
+    # The anchors of the oldest messages are removed beyond the limit
+    # Опорные точки самых старых сообщений удаляются сверх предела
+    date_boundary_cache.add_anchors(0, [(10 * message_id, message_id) for message_id in range(80, 100)])
+    assert date_boundary_cache.get_boundary(0, datetime.fromtimestamp(155, timezone.utc), True) is None
+    assert date_boundary_cache.get_boundary(0, datetime.fromtimestamp(255, timezone.utc), True) == 26
+    assert date_boundary_cache.get_boundary(0, datetime.fromtimestamp(855, timezone.utc), False) == 85
+
+
+def test_unused_media_blobs_are_deleted_without_hard_links(tmp_path, monkeypatch):
+    """
+    Blobs without a record and content hash blobs of no remaining media are deleted, also if blobs are copies
+    Блобы без записи и блобы хэшей содержимого, не относящиеся к оставшимся медиа, удаляются, также если блобы
+    являются копиями
+    """
+
+    monkeypatch.setattr(ProjectDirs, 'media_dir', tmp_path.as_posix())
+    media_store = TgMediaStore()
+    blobs_dir = TgMediaStore.get_blob_path('saved').parent
+    blobs_dir.mkdir(parents=True, exist_ok=True)
+    for media_id, content in (('saved', b'saved media'), ('viewed', b'viewed media')):
+        TgMediaStore.get_blob_path(media_id).write_bytes(content)
+        # Copies instead of hard links / Копии вместо жестких ссылок
+        TgMediaStore.get_blob_path(
+            f'{GlobalConst.content_hash_blob_prefix}{sha256(content).hexdigest()}').write_bytes(content)
+    saved_hash = sha256(b'saved media').hexdigest()
+    deleted_count, content_hashes = media_store.delete_unused_blobs({'saved': None})
+    assert deleted_count == 2
+    assert content_hashes == {'saved': saved_hash}
+    assert sorted(blob_path.name for blob_path in blobs_dir.iterdir()) == [
+        'saved', f'{GlobalConst.content_hash_blob_prefix}{saved_hash}']
+    assert media_store.delete_unused_blobs({'saved': saved_hash}) == (0, {})
+
+
+def wait_archive_job(archive_job: TgArchiveJob) -> None:
+    """
+    Waits up to five seconds for an archive job to finish
+    Ожидает завершения задания архивации до пяти секунд
+    """
+
+    for _ in range(100):
+        if not archive_job.is_active:
+            return
+        sleep_thread(0.05)
+
+
+def test_archive_job_finishes_on_unexpected_error(dialog_id):
+    """
+    An unexpected error fails the archive job and does not block the next one
+    Непредвиденная ошибка завершает задание архивации неудачей и не блокирует следующее
+    """
+
+    def save_message_groups(_message_groups: list) -> None:
+        raise RuntimeError('Broken batch')
+
+    archive_job = tg_handler.start_archive_job(dialog_id, '', '', save_message_groups)
+    wait_archive_job(archive_job)
+    assert archive_job.status == 'failed'
+    assert 'Broken batch' in archive_job.error
+    next_archive_job = tg_handler.start_archive_job(dialog_id, '', '', lambda _message_groups: [])
+    assert next_archive_job is not archive_job
+    wait_archive_job(next_archive_job)
+    assert next_archive_job.status == 'completed'
@@ -4,13 +4,18 @@ The module contains classes, functions, and variables that are used in other mod
 class StatusMessages: a class to hold status messages for the web interface.
 parse_date_string: a function to parse a date string and return a datetime object
 clean_file_path: a function to clean a file or directory name from invalid characters
+convert_text_hyperlinks: a function for converting text hyperlinks in Markdown format [Text](URL) to HTML format
+benchmark_text_hyperlinks: a function for measuring the speed of converting text hyperlinks
 status_messages: a global instance of StatusMessages
 """
 
 import re
 from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
+from timeit import timeit
 from dateutil.parser import parse
+from configs.config import GlobalConst
 
 
 @dataclass
@@ -108,5 +113,69 @@ def clean_file_path(file_path: str | None) -> str | None:
     return clean_filepath
 
 
+def convert_text_hyperlinks(message_text: str | None) -> str | None:
+    """
+    Converting text hyperlinks of the form [Text](URL) to HTML format in one pass. The results for the last
+    GlobalConst.hyperlink_cache_size texts are memoized.
+    Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат за один проход. Результаты для последних
+    GlobalConst.hyperlink_cache_size текстов запоминаются.
+    Attributes:
+        message_text (str | None): message text
+    Returns:
+        str | None: converted message text
+    """
+    return convert_text_hyperlinks_cached(message_text) if message_text else message_text
+
+
+@lru_cache(maxsize=GlobalConst.hyperlink_cache_size)
+def convert_text_hyperlinks_cached(message_text: str) -> str:
+    """
+    Converting text hyperlinks of the form [Text](URL) to HTML format with memoization of results by text
+    Преобразование текстовых гиперссылок вида [Text](URL) в HTML формат с запоминанием результатов по тексту
+    Attributes:
+        message_text (str): message text
+    Returns:
+        str: converted message text
+    """
+    return GlobalConst.text_with_url_pattern.sub(r'<a href = "\2" target="_blank" >\1</a>', message_text)
+
+
+def benchmark_text_hyperlinks(text_count: int = 200, link_count: int = 40, repeat: int = 5) -> dict[str, float]:
+    """
+    Measuring the time of converting text hyperlinks in job posting like texts: the previous algorithm with
+    findall and a replacement per match, the single-pass conversion, and the memoized conversion
+    Измерение времени преобразования текстовых гиперссылок в текстах, похожих на вакансии: прежний алгоритм с
+    findall и заменой для каждого совпадения, однопроходное преобразование и преобразование с запоминанием
+    Attributes:
+        text_count (int): number of texts
+        link_count (int): number of hyperlinks in a text
+        repeat (int): number of passes over all texts
+    Returns:
+        dict[str, float]: time of each variant in seconds
+    """
+
+    def convert_by_replace(message_text: str) -> str:
+        for match in GlobalConst.text_with_url_pattern.findall(message_text):
+            message_text = message_text.replace(f'[{match[0]}]({match[1]})',
+                                                f'<a href = "{match[1]}" target="_blank" >{match[0]}</a>')
+        return message_text
+
+    texts = ['\n'.join(f'🔹 Position {text_id}-{link_id}: Python developer, remote, salary from {link_id} 000 USD. '
+                        f'Requirements: Flask, SQLAlchemy, asyncio. [Apply here](https://jobs.example.com/vacancy/'
+                        f'{text_id}/{link_id}?utm_source=telegram) or see [the company site](https://example.com/'
+                        f'company/{link_id})' for link_id in range(link_count // 2))
+             for text_id in range(text_count)]
+    assert all(convert_by_replace(text) == convert_text_hyperlinks_cached.__wrapped__(text) for text in texts)
+    convert_text_hyperlinks_cached.cache_clear()
+    results = {'findall_replace': timeit(lambda: [convert_by_replace(text) for text in texts], number=repeat),
+               'single_pass': timeit(lambda: [convert_text_hyperlinks_cached.__wrapped__(text) for text in texts],
+                                     number=repeat),
+               'memoized': timeit(lambda: [convert_text_hyperlinks(text) for text in texts], number=repeat)}
+    convert_text_hyperlinks_cached.cache_clear()
+    return results
+
+
 if __name__ == '__main__':
-    pass
+    # Micro-benchmark of converting text hyperlinks / Микро-бенчмарк преобразования текстовых гиперссылок
+    for variant, seconds in benchmark_text_hyperlinks().items():
+        print(f'{variant}: {seconds:.4f} s')